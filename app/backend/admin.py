@@ -9,8 +9,11 @@ Register forms for Django admin interface
 """
 
 from django.contrib import admin
-from .models import Location, LocationAdmin, Geometry, GeometryAdmin, Data, DataAdmin
+from .models import Location, LocationAdmin, Geometry, GeometryAdmin, Area, AreaAdmin, Data, DataAdmin, ConversionFactor, ConversionFactorAdmin, Profile, ProfileAdmin
 
 admin.site.register(Location, LocationAdmin)
 admin.site.register(Geometry, GeometryAdmin)
-admin.site.register(Data, DataAdmin)
\ No newline at end of file
+admin.site.register(Area, AreaAdmin)
+admin.site.register(Data, DataAdmin)
+admin.site.register(ConversionFactor, ConversionFactorAdmin)
+admin.site.register(Profile, ProfileAdmin)
@@ -0,0 +1,143 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/analysis.py
+Analysis of download size of generated geometries for each zoom level
+
+For each zoom level and area type shown at that zoom level, bytes sent by /geometries/ are estimated
+for single map tiles and for typical map viewports. As /geometries/ returns every geometry whose
+bounding box overlaps requested bounds, same bounding box test is used here.
+"""
+
+import math
+import numpy as np
+import shapely
+from django.db.models.functions import Length
+from django.contrib.gis.db.models.functions import AsGeoJSON, AsWKB
+
+from .models import Geometry
+from .simplify import MERCATORHALFWORLD
+
+# Zoom level from which each area type is shown, matching ZOOM_SHOWLEVEL_2 and ZOOM_SHOWLEVEL_3 of frontend
+typeminzoom = {'lau1': 0, 'msoa': 8, 'lsoa': 9}
+
+# Size in pixels of typical map viewport
+viewportsize = (1280, 800)
+
+# Maximum number of tiles and viewports sampled for each zoom level and area type
+maxsamples = 2000
+
+def getfeaturesizes(areatype, zoom):
+    """
+    Get bounding boxes and size in bytes of /geometries/ response for each geometry of area type at zoom level
+
+    Returns array of bounds indexed [geometry, (xmin, ymin, xmax, ymax)] and array of sizes
+    """
+
+    rows = Geometry.objects.filter(type=areatype, zoom=zoom).exclude(shape=None) \
+                .annotate(envelope=AsWKB('bbox'), jsonsize=Length(AsGeoJSON('shape__geometry'))) \
+                .values_list('name', 'code', 'envelope', 'jsonsize')
+    rows = list(rows)
+    if len(rows) == 0: return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+
+    bounds = shapely.bounds(shapely.from_wkb([bytes(row[2]) for row in rows]))
+    # Other properties and JSON punctuation of each feature, see views.Geometries
+    overhead = len('{"name": "", "code": "", "type": "", "json": ""}, ') + len(areatype)
+    sizes = np.array([row[3] + len(row[0]) + len(row[1]) + overhead for row in rows], dtype=np.int64)
+
+    return bounds, sizes
+
+def gettilebounds(tilex, tiley, zoom, width=1, height=1):
+    """
+    Get WGS84 bounds of block of map tiles with top-left tile (tilex, tiley) at zoom level
+    """
+
+    numtiles = 2 ** zoom
+    def lat(y): return math.degrees(math.atan(math.sinh(math.pi * (1 - (2 * y / numtiles)))))
+    return (tilex / numtiles * 360 - 180, lat(tiley + height), (tilex + width) / numtiles * 360 - 180, lat(tiley))
+
+def getsampletiles(bounds, zoom):
+    """
+    Get sample of tiles at zoom level containing centres of geometries, as array of (tilex, tiley)
+    """
+
+    numtiles = 2 ** zoom
+    lng = (bounds[:, 0] + bounds[:, 2]) / 2
+    lat = np.radians(np.clip((bounds[:, 1] + bounds[:, 3]) / 2, -85.0511, 85.0511))
+    tilex = np.clip(np.floor((lng + 180) / 360 * numtiles), 0, numtiles - 1).astype(np.int64)
+    tiley = np.floor((MERCATORHALFWORLD - (np.log(np.tan((math.pi / 4) + (lat / 2))) * (MERCATORHALFWORLD / math.pi))) / (2 * MERCATORHALFWORLD) * numtiles)
+    tiley = np.clip(tiley, 0, numtiles - 1).astype(np.int64)
+
+    tiles = np.unique(np.stack([tilex, tiley], axis=1), axis=0)
+    if len(tiles) > maxsamples: tiles = tiles[np.random.default_rng(0).choice(len(tiles), maxsamples, replace=False)]
+    return tiles
+
+def getresponsesizes(tree, sizes, queryboxes):
+    """
+    Get total size of geometries whose bounding boxes overlap each query box
+    """
+
+    queryindexes, featureindexes = tree.query(queryboxes, predicate='intersects')
+    return np.bincount(queryindexes, weights=sizes[featureindexes], minlength=len(queryboxes))
+
+def getpercentiles(values):
+    """
+    Get summary statistics of array of sizes in bytes
+    """
+
+    if len(values) == 0: return {'mean': 0, 'p50': 0, 'p95': 0, 'max': 0}
+    return {
+        'mean': int(np.mean(values)),
+        'p50': int(np.percentile(values, 50)),
+        'p95': int(np.percentile(values, 95)),
+        'max': int(np.max(values)),
+    }
+
+def analysezoom(areatype, zoom):
+    """
+    Analyse bytes per tile and per viewport for area type at zoom level
+    Tiles and viewports are sampled where geometries are, so empty sea is not counted
+    """
+
+    bounds, sizes = getfeaturesizes(areatype, zoom)
+    result = {'type': areatype, 'zoom': zoom, 'features': len(sizes), 'bytes': int(sizes.sum()), 'tiles': {}, 'viewports': {}}
+    if len(sizes) == 0: return result
+
+    tree = shapely.STRtree(shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]))
+    tiles = getsampletiles(bounds, zoom)
+
+    viewportwidth, viewportheight = viewportsize[0] / 256, viewportsize[1] / 256
+    tileboxes = [shapely.box(*gettilebounds(tilex, tiley, zoom)) for tilex, tiley in tiles.tolist()]
+    viewportboxes = [shapely.box(*gettilebounds(tilex + 0.5 - (viewportwidth / 2), tiley + 0.5 - (viewportheight / 2), zoom, viewportwidth, viewportheight)) for tilex, tiley in tiles.tolist()]
+
+    result['tiles'] = getpercentiles(getresponsesizes(tree, sizes, tileboxes))
+    result['viewports'] = getpercentiles(getresponsesizes(tree, sizes, viewportboxes))
+    result['samples'] = len(tiles)
+
+    return result
+
+def analysegeometries(zoomrange):
+    """
+    Analyse bytes per tile and per viewport for all zoom levels and area types shown at each zoom level
+    """
+
+    results = []
+    for zoom in range(0, zoomrange + 1):
+        for areatype in typeminzoom:
+            if zoom < typeminzoom[areatype]: continue
+            results.append(analysezoom(areatype, zoom))
+    return results
+
+def printanalysis(result):
+    """
+    Print analysis of single area type and zoom level
+    """
+
+    print(  "Zoom", str(result['zoom']).rjust(2), result['type'],
+            "features", result['features'],
+            "total", result['bytes'],
+            "bytes per tile p50/p95/max", "{p50}/{p95}/{max}".format(**result['tiles']) if result['tiles'] else "-",
+            "per viewport p50/p95/max", "{p50}/{p95}/{max}".format(**result['viewports']) if result['viewports'] else "-")
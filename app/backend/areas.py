@@ -0,0 +1,61 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/areas.py
+Per-worker cache of area attributes (name, type, parent codes, bounds) loaded from Area table
+
+Entire Area table is held in memory by each worker so area lookups never query database
+"""
+
+import time
+
+from .models import Area
+
+# Seconds after which cache is reloaded to pick up regenerated areas
+cachelifetime = 600
+
+# Minimum seconds between reloads triggered by lookups of unknown area codes
+missreloadinterval = 60
+
+_cache = {'areas': {}, 'loaded': 0}
+
+def loadareas():
+    """
+    Load all areas into cache
+    """
+
+    areas = {}
+    for code, name, type, parentcodes, xmin, ymin, xmax, ymax in Area.objects.values_list('code', 'name', 'type', 'parentcodes', 'xmin', 'ymin', 'xmax', 'ymax').iterator():
+        areas[code] = {
+            'code': code,
+            'name': name,
+            'type': type,
+            'parents': parentcodes.split(),
+            'bounds': (xmin, ymin, xmax, ymax)
+        }
+
+    _cache['areas'] = areas
+    _cache['loaded'] = time.time()
+
+def getareas():
+    """
+    Get dictionary of all areas keyed on area code, loading areas if cache has expired
+    """
+
+    if (time.time() - _cache['loaded']) > cachelifetime: loadareas()
+    return _cache['areas']
+
+def getarea(code):
+    """
+    Get attributes of area with particular code, or None if area does not exist
+    """
+
+    areas = getareas()
+    if (code not in areas) and ((time.time() - _cache['loaded']) > missreloadinterval):
+        loadareas()
+        areas = _cache['areas']
+
+    return areas.get(code)
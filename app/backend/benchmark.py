@@ -0,0 +1,522 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/benchmark.py
+Benchmarks map API views, carbon model and import tools against synthetic datasets of different sizes
+
+Benchmarks are run inside a temporary test database so live data is never touched.
+Results can be stored as a baseline and later runs compared against it to catch performance regressions.
+Startup benchmarks time imports of fresh web worker and tools.py processes using 'python -X importtime'.
+"""
+
+import os
+import sys
+import ast
+import io
+import csv
+import json
+import math
+import time
+import random
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+import contextlib
+
+if __name__ == '__main__':
+    import django
+    parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+    sys.path.append(parent_dir)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "carbonmap.settings")
+    django.setup()
+
+from django.db import connection
+from django.test import RequestFactory
+from django.contrib.gis.geos import Polygon, MultiPolygon, Point
+from backend import views, tools
+from backend.carbonmodel import retrievecarbondata, computeforecasts
+from backend.rankings import computerankings
+from backend.areas import loadareas
+from backend.models import Location, Shape, Geometry, Area, Data, Forecast, Ranking
+from backend.gis import get_shape_hash
+
+# Default dataset sizes (number of areas) to benchmark
+defaultsizes = [100, 1000, 10000]
+
+# Number of years of synthetic data to create for each area
+defaultyears = 10
+
+# Number of timed calls for each benchmark
+iterations = 50
+
+# Relative slowdown against baseline that is reported as regression
+regressionthreshold = 0.2
+
+# Bounding box of UK used to distribute synthetic areas, (lng_west, lat_south, lng_east, lat_north)
+ukbounds = (-6.0, 50.0, 2.0, 58.0)
+
+# Stored baseline results, relative to 'app' folder
+baselinefile = 'benchmark_baseline.json'
+
+# Folder containing Django project, from which startup benchmark processes are run
+appfolder = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+
+# Number of fresh processes started for each startup benchmark
+startuprepeats = 5
+
+# Number of slowest top-level imports reported for each startup benchmark
+startupheaviest = 8
+
+# Modules imported by web worker on boot and when resolving first request
+webmodules = ['carbonmap.wsgi', 'carbonmap.urls']
+
+def createsyntheticpolygon(lng, lat, size, vertices):
+    """
+    Create roughly circular polygon centred on lng/lat with specific number of vertices
+    """
+
+    points = []
+    for vertex in range(vertices):
+        angle = (2 * math.pi * vertex) / vertices
+        radius = size * (0.8 + 0.2 * ((vertex * 7919) % 5) / 4)
+        points.append((lng + radius * math.cos(angle), lat + radius * math.sin(angle)))
+    points.append(points[0])
+    return MultiPolygon(Polygon(points))
+
+def createsyntheticdata(numareas, numyears, geometrytype='lsoa', seed=1):
+    """
+    Create synthetic dataset of areas with polygons for every zoom level and electricity/gas data for a range of years
+
+    Areas are laid out on a grid across the UK with vertex counts increasing with zoom level
+    """
+
+    generator = random.Random(seed)
+    gridsize = int(numareas ** 0.5) + 1
+    cellwidth = (ukbounds[2] - ukbounds[0]) / gridsize
+    cellheight = (ukbounds[3] - ukbounds[1]) / gridsize
+    codes = []
+
+    shapes, geometries, areas, data = [], [], [], []
+    for index in range(numareas):
+        code = 'E0' + str(index).zfill(7)
+        codes.append(code)
+        lng = ukbounds[0] + (cellwidth * ((index % gridsize) + 0.5))
+        lat = ukbounds[1] + (cellheight * ((index // gridsize) + 0.5))
+        for zoom in range(0, tools.zoomrange + 1):
+            polygon = createsyntheticpolygon(lng, lat, 0.45 * min(cellwidth, cellheight), 8 + (8 * zoom))
+            shape = Shape(hash=get_shape_hash(polygon.wkb), geometry=polygon)
+            shapes.append(shape)
+            geometries.append(Geometry(name='Area ' + str(index), type=geometrytype, code=code, zoom=zoom, shape=shape, bbox=polygon.envelope))
+        xmin, ymin, xmax, ymax = polygon.extent
+        areas.append(Area(name='Area ' + str(index), type=geometrytype, code=code, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax))
+        for year in range(2019 - numyears + 1, 2020):
+            data.append(Data(type=0, year=str(year), value=generator.uniform(1e5, 1e7), meters=generator.randint(100, 2000), geometrycode=code, geometrytype=geometrytype))
+            data.append(Data(type=1, year=str(year), value=generator.uniform(1e5, 1e7), meters=generator.randint(100, 2000), geometrycode=code, geometrytype=geometrytype))
+
+    Shape.objects.bulk_create(shapes, batch_size=5000)
+    Geometry.objects.bulk_create(geometries, batch_size=5000)
+    Area.objects.bulk_create(areas, batch_size=5000)
+    loadareas()
+    Data.objects.bulk_create(data, batch_size=5000)
+    computeforecasts()
+    computerankings()
+
+    locations = []
+    for index in range(max(1, numareas // 10)):
+        lng, lat = generator.uniform(ukbounds[0], ukbounds[2]), generator.uniform(ukbounds[1], ukbounds[3])
+        locations.append(Location(shortcode='town' + str(index), town='Town ' + str(index), county='County', country='England', population=1000, longitude=lng, latitude=lat, url='', scale=15, location=Point(lng, lat)))
+    Location.objects.bulk_create(locations, batch_size=5000)
+
+    return codes
+
+def clearsyntheticdata():
+    """
+    Remove all synthetic data from test database
+    """
+
+    Geometry.objects.all().delete()
+    Shape.objects.all().delete()
+    Area.objects.all().delete()
+    Data.objects.all().delete()
+    Forecast.objects.all().delete()
+    Ranking.objects.all().delete()
+    Location.objects.all().delete()
+
+def writesyntheticfiles(folder, codes, year, seed=1):
+    """
+    Write synthetic BEIS and location files to folder so import tools can be benchmarked
+    """
+
+    generator = random.Random(seed)
+    os.makedirs(os.path.join(folder, 'BEIS'), exist_ok=True)
+    for datatypecode in ['ELEC', 'GAS']:
+        with open(os.path.join(folder, 'BEIS', 'LSOA_' + datatypecode + '_' + str(year) + '.csv'), 'w', newline='') as fileobj:
+            writer = csv.writer(fileobj)
+            writer.writerow(['LSOACode', 'KWH', 'METERS'])
+            for code in codes:
+                writer.writerow([code, round(generator.uniform(1e5, 1e7), 2), generator.randint(100, 2000)])
+
+    with open(os.path.join(folder, 'Towns_List_Extended.csv'), 'w', newline='') as fileobj:
+        writer = csv.writer(fileobj)
+        writer.writerow(['Town', 'County', 'Country', 'Population', 'Longitude', 'Latitude', 'url'])
+        for index in range(max(1, len(codes) // 10)):
+            writer.writerow([
+                'Town ' + str(index % 1000),
+                'County ' + str(index // 1000),
+                'England',
+                generator.randint(100, 2000000),
+                generator.uniform(ukbounds[0], ukbounds[2]),
+                generator.uniform(ukbounds[1], ukbounds[3]),
+                ''])
+
+def percentile(values, fraction):
+    """
+    Get percentile of sorted list of values using nearest rank
+    """
+
+    if len(values) == 0: return 0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def measure(function, count):
+    """
+    Time function over a number of calls, returning latency, throughput and peak memory statistics
+    """
+
+    # Warm up once so one-off costs such as query compilation are not measured
+    with contextlib.redirect_stdout(io.StringIO()): function(0)
+
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index in range(count):
+            start = time.perf_counter()
+            function(index)
+            timings.append(time.perf_counter() - start)
+
+    # Memory is traced on separate call as tracemalloc significantly slows execution
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()): function(0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        'calls': count,
+        'mean_ms': 1000 * total / count,
+        'p50_ms': 1000 * percentile(timings, 0.5),
+        'p95_ms': 1000 * percentile(timings, 0.95),
+        'throughput': count / total if total > 0 else 0,
+        'peak_kb': peak / 1024
+    }
+
+def getbenchmarks(codes, folder):
+    """
+    Get dictionary of named benchmark functions for dataset of area codes
+
+    Each function takes the index of the call so requests can be varied deterministically
+    """
+
+    factory = RequestFactory()
+    generator = random.Random(2)
+    areas = [generator.choice(codes) for index in range(iterations)]
+
+    def postjson(view, body):
+        return view(factory.post('/', data=json.dumps(body), content_type='application/json'))
+
+    def geometries_national(index):
+        return postjson(views.Geometries, {'geometrytype': 3, 'zoom': 6, 'xmin': ukbounds[0], 'ymin': ukbounds[1], 'xmax': ukbounds[2], 'ymax': ukbounds[3]})
+
+    def geometries_local(index):
+        lng, lat = -1.0 + (index % 10) * 0.1, 52.0 + (index % 10) * 0.1
+        return postjson(views.Geometries, {'geometrytype': 3, 'zoom': 13, 'xmin': lng, 'ymin': lat, 'xmax': lng + 0.2, 'ymax': lat + 0.1})
+
+    def data(index):
+        return postjson(views.Data, {'periodstart': 2010, 'periodend': 2050, 'area': areas[index % len(areas)]})
+
+    def geometrybounds(index):
+        return postjson(views.GeometryBounds, {'areacode': areas[index % len(areas)]})
+
+    def locationposition(index):
+        return views.LocationPosition(factory.get('/', {'location': 'Town ' + str(index % max(1, len(codes) // 10))}))
+
+    def rankings_top(index):
+        return views.Rankings(factory.get('/', {'geometrytype': 'lsoa', 'year': 2019, 'fuel': 'gas', 'metric': 'permeter', 'offset': (index % 10) * 100, 'limit': 100}))
+
+    def rankings_area(index):
+        return views.Rankings(factory.get('/', {'geometrytype': 'lsoa', 'year': 2019, 'fuel': 'gas', 'metric': 'permeter', 'area': areas[index % len(areas)]}))
+
+    def changes_national(index):
+        return views.Changes(factory.get('/', {'geometrytype': 'lsoa', 'yearfrom': 2010 + (index % 10), 'yearto': 2030}))
+
+    def carbonmodel(index):
+        return retrievecarbondata(2010, 2050, areas[index % len(areas)])
+
+    def importdata(index):
+        with workingdirectory(folder):
+            tools.importdatabygeometrytype('lsoa', 2020, index % 2)
+
+    def importlocations(index):
+        with workingdirectory(folder):
+            tools.importlocations()
+
+    return {
+        'geometries_national': (geometries_national, iterations),
+        'geometries_local': (geometries_local, iterations),
+        'data': (data, iterations),
+        'geometrybounds': (geometrybounds, iterations),
+        'locationposition': (locationposition, iterations),
+        'rankings_top': (rankings_top, iterations),
+        'rankings_area': (rankings_area, iterations),
+        'changes_national': (changes_national, iterations),
+        'retrievecarbondata': (carbonmodel, iterations),
+        'importdata': (importdata, 2),
+        'importlocations': (importlocations, 2),
+    }
+
+@contextlib.contextmanager
+def workingdirectory(folder):
+    """
+    Temporarily change working directory as import tools use relative file paths
+    """
+
+    previous = os.getcwd()
+    os.chdir(folder)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def runbenchmarks(sizes, numyears=defaultyears):
+    """
+    Run all benchmarks for each dataset size inside temporary test database
+    """
+
+    results = {}
+    olddatabasename = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    folder = tempfile.mkdtemp()
+
+    try:
+        for size in sizes:
+            print("Creating synthetic dataset with", size, "areas and", numyears, "years")
+            clearsyntheticdata()
+            codes = createsyntheticdata(size, numyears)
+            writesyntheticfiles(folder, codes, 2020)
+            benchmarks = getbenchmarks(codes, folder)
+
+            for name in benchmarks:
+                function, count = benchmarks[name]
+                result = measure(function, count)
+                results[name + ':' + str(size)] = result
+                print(  name.ljust(24),
+                        str(size).rjust(8),
+                        "mean {:9.2f} ms".format(result['mean_ms']),
+                        "p50 {:9.2f} ms".format(result['p50_ms']),
+                        "p95 {:9.2f} ms".format(result['p95_ms']),
+                        "{:9.1f} ops/s".format(result['throughput']),
+                        "peak {:9.0f} KB".format(result['peak_kb']))
+    finally:
+        shutil.rmtree(folder)
+        connection.creation.destroy_test_db(olddatabasename, verbosity=0)
+
+    return results
+
+def getstartupcode(modules):
+    """
+    Get Python code that sets up Django and imports modules, as started by web worker or tools.py
+    """
+
+    lines = [   'import os, sys',
+                'sys.path.insert(0, ' + repr(appfolder) + ')',
+                "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'carbonmap.settings')",
+                'import django',
+                'django.setup()']
+    return '\n'.join(lines + ['import ' + module for module in modules])
+
+def parseimporttimes(output):
+    """
+    Parse output of 'python -X importtime' into list of (module, self microseconds, cumulative microseconds, depth)
+    """
+
+    imports = []
+    for line in output.splitlines():
+        if (not line.startswith('import time:')) or ('self [us]' in line): continue
+        selftime, cumulative, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(selftime), int(cumulative), depth))
+    return imports
+
+def getimportedmodules(node):
+    """
+    Get names of modules imported by import statements within syntax tree node
+    """
+
+    modules = []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Import): modules += [alias.name for alias in child.names]
+        # 'from backend import simplify' imports module backend.simplify
+        if isinstance(child, ast.ImportFrom):
+            modules += [child.module + '.' + alias.name for alias in child.names] if child.module == 'backend' else [child.module]
+    return modules
+
+def gettoolcommandmodules():
+    """
+    Get modules each tools.py subcommand imports on top of tools.py, read from tools.py itself
+
+    Subcommands are branches testing primaryargument, and their modules are those imported within
+    branch and within every tools.py function it calls, directly or indirectly
+    """
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools.py')) as f:
+        tree = ast.parse(f.read())
+
+    functions = {node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)}
+
+    def getmodules(node, visited):
+        modules = getimportedmodules(node)
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and (child.func.id in functions) and (child.func.id not in visited):
+                visited.add(child.func.id)
+                modules += getmodules(functions[child.func.id], visited)
+        return modules
+
+    commandmodules = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and isinstance(node.test.left, ast.Name) and \
+            (node.test.left.id == 'primaryargument') and isinstance(node.test.comparators[0], ast.Constant):
+            modules = []
+            for statement in node.body: modules += getmodules(statement, set())
+            commandmodules[node.test.comparators[0].value] = sorted(set(modules))
+
+    return commandmodules
+
+def measurestartup(modules):
+    """
+    Time imports of fresh process importing modules, returning import time statistics and slowest top-level imports
+    """
+
+    totals, walltimes = [], []
+    for repeat in range(startuprepeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', getstartupcode(modules)], cwd=appfolder, capture_output=True, text=True)
+        walltimes.append(time.perf_counter() - start)
+        imports = parseimporttimes(process.stderr)
+        if process.returncode != 0: raise RuntimeError("Startup benchmark failed: " + process.stderr.strip().splitlines()[-1])
+        totals.append(sum([selftime for name, selftime, cumulative, depth in imports]) / 1000)
+
+    totals.sort()
+    walltimes.sort()
+    toplevel = sorted([(cumulative, name) for name, selftime, cumulative, depth in imports if depth == 0], reverse=True)
+    return {
+        'calls': startuprepeats,
+        'mean_ms': sum(totals) / len(totals),
+        'p50_ms': percentile(totals, 0.5),
+        'p95_ms': percentile(totals, 0.95),
+        'wall_ms': 1000 * percentile(walltimes, 0.5),
+        'heaviest': [{'module': name, 'ms': cumulative / 1000} for cumulative, name in toplevel[:startupheaviest]]
+    }
+
+def runstartupbenchmarks():
+    """
+    Run startup benchmarks for web worker, tools.py and each tools.py subcommand
+    """
+
+    benchmarks = {'startup:web': webmodules, 'startup:tools': ['backend.tools']}
+    toolcommandmodules = gettoolcommandmodules()
+    for command in toolcommandmodules: benchmarks['startup:tools ' + command] = ['backend.tools'] + toolcommandmodules[command]
+
+    results = {}
+    for name in benchmarks:
+        result = measurestartup(benchmarks[name])
+        results[name] = result
+        print(  name.ljust(40),
+                "imports p50 {:9.2f} ms".format(result['p50_ms']),
+                "p95 {:9.2f} ms".format(result['p95_ms']),
+                "process {:9.2f} ms".format(result['wall_ms']))
+        print(' ' * 40, ', '.join([heavy['module'] + " {:.0f} ms".format(heavy['ms']) for heavy in result['heaviest']]))
+
+    return results
+
+def savebaseline(results):
+    """
+    Store results in baseline, keeping stored results of other benchmarks
+    """
+
+    baseline = {}
+    if os.path.isfile(baselinefile):
+        with open(baselinefile) as f:
+            baseline = json.load(f)
+    baseline.update(results)
+    with open(baselinefile, 'w') as f:
+        json.dump(baseline, f, indent=2)
+    print("Stored baseline in", baselinefile)
+
+def comparebaseline(results, baseline):
+    """
+    Compare results against baseline, returning list of regressions
+    """
+
+    regressions = []
+    for key in results:
+        if key not in baseline: continue
+        previous, current = baseline[key]['p50_ms'], results[key]['p50_ms']
+        if previous <= 0: continue
+        change = (current - previous) / previous
+        status = "REGRESSION" if change > regressionthreshold else "ok"
+        print(key.ljust(34), "baseline {:9.2f} ms".format(previous), "current {:9.2f} ms".format(current), "{:+7.1%}".format(change), status)
+        if change > regressionthreshold: regressions.append(key)
+
+    return regressions
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 1:
+        print("""
+****** Carbon Map Benchmarks *******
+
+Possible arguments are:
+
+run [size1] [size2] ...
+  Runs benchmarks for datasets with specified numbers of areas and compares against stored baseline
+  Exits with error status if any benchmark is slower than baseline by more than threshold
+
+baseline [size1] [size2] ...
+  Runs benchmarks and stores results as new baseline
+
+startup
+  Times imports of web worker, tools.py and each tools.py subcommand in fresh processes using 'python -X importtime'
+  and compares against stored baseline, exiting with error status if any is slower than baseline by more than threshold
+
+startupbaseline
+  Runs startup benchmarks and stores results as new baseline
+
+Default sizes are """ + ' '.join([str(size) for size in defaultsizes]) + """
+""")
+
+    else:
+        primaryargument = sys.argv[1]
+        sizes = [int(size) for size in sys.argv[2:]]
+        if len(sizes) == 0: sizes = defaultsizes
+
+        if primaryargument in ["run", "startup"]:
+            if primaryargument == "run": results = runbenchmarks(sizes)
+            else: results = runstartupbenchmarks()
+            if os.path.isfile(baselinefile):
+                with open(baselinefile) as f:
+                    baseline = json.load(f)
+                regressions = comparebaseline(results, baseline)
+                if len(regressions) > 0:
+                    print("Regressions found:", ', '.join(regressions))
+                    sys.exit(1)
+            else:
+                print("No baseline found at", baselinefile, "- run 'baseline' to create one")
+
+        if primaryargument == "baseline":
+            savebaseline(runbenchmarks(sizes))
+        if primaryargument == "startupbaseline":
+            savebaseline(runstartupbenchmarks())
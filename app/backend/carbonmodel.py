@@ -1,168 +1,337 @@
 """
 Copyright (c) Open Carbon, 2020
- 
+
 This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 
 backend/carbonmodel.py
 Functions used to calculate emissions predictions based on existing data
+
+Forecasting coefficients for every area are precomputed from all existing data and stored as
+compact NumPy arrays in the Forecast table. Each worker loads the latest arrays once and evaluates
+any forecasting model, conversion factor trajectory and year range for any number of areas vectorially.
 """
 
+import io
+import itertools
+import time
 import numpy as np
-import json
-import datetime
-from django.contrib.gis.geos import GEOSGeometry
-from random import random
 
-from .models import Data
-from .conversionfactors import converter_kg_electricity, converter_kg_gas
+from .models import Data, Forecast
+from .factors import getfactortable, fitfromyear
 
-def calculatebaseparameters(areadata):
-    """
-    Calculate base parameters from existing energy data using simple linear regression
+# Fuels in order of Data.type
+FUELS = ['electricity', 'gas']
+
+# Available models for forecasting energy use
+# linear: first order linear regression of energy use against year
+# loglinear: first order linear regression of log of energy use against year, ie. constant annual rate of change
+# cappeddecline: constant annual rate of change from last recorded value, never increasing and declining by no more than maxannualdecline
+MODELS = ['linear', 'loglinear', 'cappeddecline']
+
+# Available trajectories for forecasting conversion factors beyond published years
+# linear: first order linear regression of published conversion factors against year
+# constant: latest published conversion factors remain unchanged
+# netzero2050: electricity conversion factor declines linearly to zero in 2050, gas conversion factor remains unchanged
+TRAJECTORIES = ['linear', 'constant', 'netzero2050']
+
+# Maximum annual decline used by 'cappeddecline' model
+maxannualdecline = 0.05
+
+# Seconds between checks for newer precomputed forecasts
+storecheckinterval = 60
+
+_cache = {'store': None, 'id': None, 'checked': 0}
+
+class ForecastStore:
     """
+    Energy use and forecasting coefficients for set of areas held as NumPy arrays
 
-    years_electricity, years_gas, electricity, gas = [], [], [], []
-    for areadataitem in areadata:
-        year = int(areadataitem.year)
-        if areadataitem.type == 0:
-            years_electricity.append(year)
-            electricity.append(float(areadataitem.value))
-        if areadataitem.type == 1: 
-            years_gas.append(year)
-            gas.append(float(areadataitem.value))
+    Arrays are indexed [area, fuel] and, for energy use, [area, fuel, year]
+    """
 
-    converter_years_electricity, converter_years_gas, converter_electricity, converter_gas = [], [], [], []
+    def __init__(self, codes, geometrytypes, years, consumption):
+        self.codes = np.asarray(codes)
+        self.geometrytypes = np.asarray(geometrytypes)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.consumption = np.asarray(consumption, dtype=np.float64)
+        self.index = {code: index for index, code in enumerate(self.codes.tolist())}
+        self.calculatecoefficients()
+
+    def calculatecoefficients(self):
+        """
+        Calculate linear and log-linear regression coefficients and last recorded values for all areas at once
+        """
+
+        recorded = ~np.isnan(self.consumption)
+        values = np.where(recorded, self.consumption, 0)
+        self.linear = regress(self.years, values, recorded)
+
+        positive = recorded & (values > 0)
+        self.loglinear = regress(self.years, np.log(np.where(positive, values, 1)), positive)
+
+        self.haspositive = positive.any(axis=2)
+
+        # Last recorded year and value for each area and fuel, zero where no data
+        self.lastyear = np.zeros(recorded.shape[:2], dtype=np.int64)
+        self.lastvalue = np.zeros(recorded.shape[:2])
+        if len(self.years) > 0:
+            lastindex = recorded.shape[2] - 1 - np.argmax(recorded[:, :, ::-1], axis=2)
+            hasdata = recorded.any(axis=2)
+            self.lastyear = np.where(hasdata, self.years[lastindex], 0)
+            self.lastvalue = np.where(hasdata, np.take_along_axis(values, lastindex[:, :, None], axis=2)[:, :, 0], 0)
+
+        # Predictions start after last year recorded for any fuel
+        self.arealastyear = self.lastyear.max(axis=1)
+
+    def tobytes(self):
+        """
+        Serialize energy use arrays, from which coefficients are recalculated on loading
+        """
+
+        output = io.BytesIO()
+        np.savez_compressed(output, codes=self.codes.astype(str), geometrytypes=self.geometrytypes.astype(str), years=self.years, consumption=self.consumption)
+        return output.getvalue()
+
+    @classmethod
+    def frombytes(cls, data):
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        return cls(arrays['codes'], arrays['geometrytypes'], arrays['years'], arrays['consumption'])
+
+    def without(self, codes):
+        """
+        Get copy of store without particular area codes
+        """
+
+        keep = ~np.isin(self.codes, list(codes))
+        return ForecastStore(self.codes[keep], self.geometrytypes[keep], self.years, self.consumption[keep])
+
+def regress(years, values, mask):
+    """
+    First order least squares regression of values against years for all areas and fuels at once, using only masked values
 
-    for year in converter_kg_electricity.keys():
-        converter_years_electricity.append(int(year))
-        converter_electricity.append(converter_kg_electricity[year])
+    Returns array of [slope, intercept] indexed [area, fuel]
+    """
 
-    # We skip first two values for gas as these are copied from 2012 and might distort estimates
-    # However we use these values for final carbon conversion as they are conservative estimates
-    for year in range(2012, 2021):
-        converter_years_gas.append(year)
-        converter_gas.append(converter_kg_gas[str(year)])
+    count = mask.sum(axis=2)
+    safecount = np.maximum(count, 1)
+    xmean = (mask * years).sum(axis=2) / safecount
+    ymean = (mask * values).sum(axis=2) / safecount
+    xdiff = np.where(mask, years - xmean[:, :, None], 0)
+    sxx = (xdiff ** 2).sum(axis=2)
+    sxy = (xdiff * np.where(mask, values - ymean[:, :, None], 0)).sum(axis=2)
+    slope = np.where(sxx > 0, sxy / np.where(sxx > 0, sxx, 1), 0)
+    intercept = ymean - (slope * xmean)
 
-    # Calculate slope/intercept for electricity, gas, converter-electricity, converter-gas
+    return np.stack([slope, intercept], axis=2)
 
-    slope_electricity, intercept_electricity, slope_gas, intercept_gas = 0, 0, 0, 0    
-    slope_converter_electricity, intercept_converter_electricity, slope_converter_gas, intercept_converter_gas = 0, 0, 0, 0
+def buildstore(datarows):
+    """
+    Build forecast store from iterable of (geometrycode, geometrytype, type, year, value) data rows
+    """
 
-    if len(years_electricity) > 0:
-        x = np.array(years_electricity)
-        y = np.array(electricity)
-        slope_electricity, intercept_electricity = np.polyfit(x, y, 1)
+    rows = list(datarows)
+    codes = sorted(set([row[0] for row in rows]))
+    index = {code: position for position, code in enumerate(codes)}
+    geometrytypes = [''] * len(codes)
+    years = [int(row[3]) for row in rows]
+    firstyear, lastyear = (min(years), max(years)) if len(years) > 0 else (0, -1)
 
-    if len(years_gas) > 0:
-        x = np.array(years_gas)
-        y = np.array(gas)
-        slope_gas, intercept_gas = np.polyfit(x, y, 1)
+    consumption = np.full((len(codes), len(FUELS), lastyear - firstyear + 1), np.nan)
+    for geometrycode, geometrytype, datatype, year, value in rows:
+        geometrytypes[index[geometrycode]] = geometrytype
+        consumption[index[geometrycode], datatype, int(year) - firstyear] = float(value)
 
-    if len(converter_years_electricity) > 0:
-        x = np.array(converter_years_electricity)
-        y = np.array(converter_electricity)
-        slope_converter_electricity, intercept_converter_electricity = np.polyfit(x, y, 1)
+    return ForecastStore(codes, geometrytypes, np.arange(firstyear, lastyear + 1), consumption)
 
-    if len(converter_years_gas) > 0:
-        x = np.array(converter_years_gas)
-        y = np.array(converter_gas)
-        slope_converter_gas, intercept_converter_gas = np.polyfit(x, y, 1)
+def mergestores(first, second):
+    """
+    Merge two stores with different areas into single store covering years of both
+    """
 
-    # print("Electricity", slope_electricity, intercept_electricity)
-    # print("Gas", slope_gas, intercept_gas)
-    # print("Converter electricity", slope_converter_electricity, intercept_converter_electricity)
-    # print("Converter gas", slope_converter_gas, intercept_converter_gas)
+    allyears = np.concatenate([first.years, second.years])
+    if len(allyears) == 0: return first
+    years = np.arange(allyears.min(), allyears.max() + 1)
 
-    return { 
-        'electricity': {'slope': slope_electricity, 'intercept': intercept_electricity},        
-        'gas': {'slope': slope_gas, 'intercept': intercept_gas},        
-        'converter_electricity': {'slope': slope_converter_electricity, 'intercept': intercept_converter_electricity},        
-        'converter_gas': {'slope': slope_converter_gas, 'intercept': intercept_converter_gas}        
-    }
+    def expand(store):
+        consumption = np.full((len(store.codes), len(FUELS), len(years)), np.nan)
+        if len(store.years) > 0: consumption[:, :, store.years[0] - years[0]:store.years[-1] - years[0] + 1] = store.consumption
+        return consumption
 
+    return ForecastStore(
+        np.concatenate([first.codes.astype(str), second.codes.astype(str)]),
+        np.concatenate([first.geometrytypes.astype(str), second.geometrytypes.astype(str)]),
+        years,
+        np.concatenate([expand(first), expand(second)]))
 
-def makeprediction(baseparameters, prediction_year):        
+def getdatarows(codes=None):
     """
-    Make predictions for electricity and gas use and electricity and gas conversion factors using base parameters for a particular year
+    Get data rows used to build forecast store, for all areas or particular area codes
+    """
+
+    data = Data.objects.all()
+    if codes is not None: data = data.filter(geometrycode__in=list(codes))
+    return data.values_list('geometrycode', 'geometrytype', 'type', 'year', 'value').iterator()
 
-    As we're using simple linear regression, it's just a case of (slope * time) + intercept
+def computeforecasts(codes=None):
     """
+    Precompute forecasts and store them in database
 
-    predicted_electricity = (baseparameters['electricity']['slope'] * prediction_year) + baseparameters['electricity']['intercept']
-    predicted_gas = (baseparameters['gas']['slope'] * prediction_year) + baseparameters['gas']['intercept']
+    If codes provided, only forecasts for those areas are recalculated and the rest kept from latest stored forecasts
+    """
 
-    if str(prediction_year) in converter_kg_electricity:
-        predicted_converter_electricity = converter_kg_electricity[str(prediction_year)]
+    latest = Forecast.objects.order_by('-id').first()
+    if (codes is None) or (latest is None):
+        store = buildstore(getdatarows())
     else:
-        predicted_converter_electricity = (baseparameters['converter_electricity']['slope'] * prediction_year) + baseparameters['converter_electricity']['intercept']
-    
-    if str(prediction_year) in converter_kg_gas:
-        predicted_converter_gas = converter_kg_gas[str(prediction_year)]
+        codes = list(codes)
+        # Rows of changed areas are read in chunks, keeping queries small, but merged into stored forecasts once
+        datarows = itertools.chain.from_iterable(getdatarows(codes[start:start + 1000]) for start in range(0, len(codes), 1000))
+        store = mergestores(ForecastStore.frombytes(bytes(latest.data)).without(codes), buildstore(datarows))
+
+    forecast = Forecast.objects.create(data=store.tobytes())
+    Forecast.objects.exclude(id=forecast.id).delete()
+    _cache.update({'store': store, 'id': forecast.id, 'checked': time.time()})
+
+    return store
+
+def getstore():
+    """
+    Get latest precomputed forecast store, checking for newer forecasts periodically
+    Returns None if no forecasts have been precomputed
+    """
+
+    now = time.time()
+    if (now - _cache['checked']) > storecheckinterval:
+        _cache['checked'] = now
+        latestid = Forecast.objects.order_by('-id').values_list('id', flat=True).first()
+        if latestid != _cache['id']:
+            _cache['store'] = None
+            if latestid is not None:
+                _cache['store'] = ForecastStore.frombytes(bytes(Forecast.objects.get(id=latestid).data))
+            _cache['id'] = latestid
+
+    return _cache['store']
+
+def calculateconversionfactors(table, fuels, years, trajectory):
+    """
+    Calculate conversion factors (kg CO2e per kWh) for fuels and array of years using particular trajectory
+    Published factors are used where available and trajectory otherwise
+
+    Returns array indexed [fuel, year]
+    """
+
+    factors = table.lookup(fuels, years)
+
+    for position, fuel in enumerate(fuels):
+        knownyears, knownfactors = table.published(fuel)
+        if len(knownyears) == 0:
+            factors[position] = 0
+            continue
+
+        if trajectory == 'constant':
+            predicted = np.full(len(years), knownfactors[-1])
+        elif (trajectory == 'netzero2050') and (fuel == 'electricity'):
+            predicted = np.interp(years, [knownyears[-1], 2050], [knownfactors[-1], 0])
+        elif trajectory == 'netzero2050':
+            predicted = np.full(len(years), knownfactors[-1])
+        else:
+            # Factors before fitfromyear are still used for final carbon conversion as they are conservative estimates
+            fitted = knownyears >= fitfromyear.get(fuel, knownyears[0])
+            if fitted.sum() < 2: fitted[:] = True
+            if len(knownyears) < 2: slope, intercept = 0, knownfactors[0]
+            else: slope, intercept = np.polyfit(knownyears[fitted], knownfactors[fitted], 1)
+            predicted = (slope * years) + intercept
+
+        factors[position] = np.where(np.isnan(factors[position]), np.maximum(predicted, 0), factors[position])
+
+    return factors
+
+def getconversionfactors(years, trajectory='linear', fuels=FUELS):
+    """
+    Get conversion factors (kg CO2e per kWh) of latest version for fuels and array of years using particular trajectory
+    Factors are cached for each version, trajectory and year range
+
+    Returns array indexed [fuel, year]
+    """
+
+    return getfactortable().trajectory(fuels, years, trajectory, calculateconversionfactors)
+
+def predictconsumption(store, indexes, years, model='linear'):
+    """
+    Predict energy use (kWh) of areas for array of years using particular model
+
+    Returns array indexed [area, fuel, year]
+    """
+
+    years = np.asarray(years, dtype=np.float64)[None, None, :]
+
+    if model == 'loglinear':
+        coefficients = store.loglinear[indexes]
+        predicted = np.exp((coefficients[:, :, 0:1] * years) + coefficients[:, :, 1:2])
+        predicted = np.where(store.haspositive[indexes][:, :, None], predicted, 0)
+    elif model == 'cappeddecline':
+        rate = np.clip(store.loglinear[indexes][:, :, 0], np.log(1 - maxannualdecline), 0)
+        elapsed = np.maximum(years - store.lastyear[indexes][:, :, None], 0)
+        predicted = store.lastvalue[indexes][:, :, None] * np.exp(rate[:, :, None] * elapsed)
     else:
-        predicted_converter_gas = (baseparameters['converter_gas']['slope'] * prediction_year) + baseparameters['converter_gas']['intercept']
+        coefficients = store.linear[indexes]
+        predicted = (coefficients[:, :, 0:1] * years) + coefficients[:, :, 1:2]
 
-    if predicted_electricity < 0: predicted_electricity = 0
-    if predicted_gas < 0: predicted_gas = 0
-    if predicted_converter_electricity < 0: predicted_converter_electricity = 0
-    if predicted_converter_gas < 0: predicted_converter_gas = 0
+    return np.maximum(predicted, 0)
 
-    return {
-        'predicted_electricity': predicted_electricity,
-        'predicted_gas': predicted_gas,
-        'predicted_converter_electricity': predicted_converter_electricity,
-        'predicted_converter_gas': predicted_converter_gas
-    }
+def calculateconsumption(store, indexes, years, model='linear'):
+    """
+    Calculate energy use (kWh) for areas and array of years
 
-def calculateemissions(predictionarray):
+    Recorded energy use is used up to last recorded year of each area and predicted energy use afterwards
+    Returns array indexed [area, fuel, year] and boolean array indexed [area, year] of which values are predicted
     """
-    Combine the predicted electricity, gas, electricity conversion factor, gas conversion factor to produce overall CO2 emissions
+
+    indexes = np.asarray(indexes, dtype=np.int64)
+    years = np.asarray(years, dtype=np.int64)
+
+    recorded = np.zeros((len(indexes), len(FUELS), len(years)))
+    if len(store.years) > 0:
+        withinrecorded = (years >= store.years[0]) & (years <= store.years[-1])
+        positions = np.clip(years - store.years[0], 0, len(store.years) - 1)
+        recorded = np.where(withinrecorded[None, None, :], store.consumption[indexes][:, :, positions], 0)
+        recorded = np.nan_to_num(recorded)
+
+    predicted = predictconsumption(store, indexes, years, model)
+    isprediction = years[None, :] > store.arealastyear[indexes][:, None]
+
+    return np.where(isprediction[:, None, :], predicted, recorded), isprediction
+
+def calculateemissions(store, indexes, years, model='linear', trajectory='linear'):
     """
+    Calculate electricity and gas CO2 emissions (tonnes) for areas and array of years
 
-    emissions_gas = int(predictionarray['predicted_gas'] * predictionarray['predicted_converter_gas'] / 1000)
-    emissions_electricity = int(predictionarray['predicted_electricity'] * predictionarray['predicted_converter_electricity'] / 1000)
+    Recorded energy use is used up to last recorded year of each area and predicted energy use afterwards
+    Returns array indexed [area, fuel, year]
+    """
 
-    return {'gas': emissions_gas, 'electricity': emissions_electricity}
+    consumption = calculateconsumption(store, indexes, years, model)[0]
 
+    # Factors are kg per kWh so convert to tonnes
+    return consumption * (getconversionfactors(years, trajectory) / 1000)[None, :, :]
 
-def retrievecarbondata(periodstart, periodend, geometrycode):
+def retrievecarbondata(periodstart, periodend, geometrycode, model='linear', trajectory='linear'):
     """
     Retrieve carbon data for specific area and make predictions where necessary
     """
 
-    # Calculate base parameters from all area data
-    # This uses numeric equations to calculate linear trends
-    now = datetime.datetime.now()
-    areadata = Data.objects.filter(geometrycode=geometrycode).order_by('year')
-    if areadata.exists() is False: return {}
-    baseparameters = calculatebaseparameters(areadata)
+    store = getstore()
+    if (store is None) or (geometrycode not in store.index):
+        # Forecasts not yet precomputed for area so calculate from area's data directly
+        store = buildstore(getdatarows([geometrycode]))
+    if geometrycode not in store.index: return {}
+
+    years = np.arange(int(periodstart), 1 + int(periodend))
+    emissions = np.rint(calculateemissions(store, [store.index[geometrycode]], years, model, trajectory)[0]).astype(np.int64)
 
-    # Create blank array for all years in requested range
     data = {}
-    for year in range(int(periodstart), 1 + int(periodend)):
-        year = str(year)
-        data[year] = {'electricity': 0, 'gas': 0}
-
-    # Populate blank array with existing data where it exists
-    maxyear = 0
-    for areadataitem in areadata:
-        year = areadataitem.year
-        if int(year) > maxyear: maxyear = int(year)
-        if year in data:
-            if areadataitem.type == 0: 
-                key = 'electricity'
-                conversionfactor = converter_kg_electricity[year] / 1000
-            if areadataitem.type == 1: 
-                key = 'gas'
-                conversionfactor = converter_kg_gas[year] / 1000
-            data[year][key] = int(conversionfactor * float(areadataitem.value))
-
-    # For years outside provided data, estimate using base parameters
-    if maxyear < int(periodend):
-        extrastart = maxyear + 1
-        if extrastart < int(periodstart): extrastart = int(periodstart)
-        for year in range(extrastart, 1 + int(periodend)):
-            predictionarray = makeprediction(baseparameters, year)
-            data[year] = calculateemissions(predictionarray)
- 
+    for position, year in enumerate(years.tolist()):
+        data[str(year)] = {FUELS[fuel]: int(emissions[fuel, position]) for fuel in range(len(FUELS))}
+
     return data
@@ -0,0 +1,91 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/changes.py
+Change in emissions of all areas of particular type between two years
+
+Emissions of both years, recorded or predicted, are calculated for all areas at once from precomputed
+forecast store, so change map needs single request rather than one request for each area. Values are
+returned as base64-encoded little-endian typed arrays, which browsers read directly into Float32Array
+and Uint8Array, in same order as list of area codes.
+"""
+
+import base64
+import numpy as np
+
+from .areas import getareas
+from .carbonmodel import FUELS, getstore, calculateconsumption, getconversionfactors
+
+# Columns of value arrays, one row per area
+COLUMNS = FUELS + ['total']
+
+_cache = {'key': None, 'bounds': None}
+
+def getareabounds(store):
+    """
+    Get bounds of areas of store as array indexed [area, (xmin, ymin, xmax, ymax)], NaN where area is unknown
+    Bounds are cached until store or areas are reloaded
+    """
+
+    areas = getareas()
+    key = (id(store), id(areas))
+    if _cache['key'] != key:
+        bounds = np.full((len(store.codes), 4), np.nan)
+        for index, code in enumerate(store.codes.tolist()):
+            if code in areas: bounds[index] = areas[code]['bounds']
+        _cache['key'], _cache['bounds'] = key, bounds
+
+    return _cache['bounds']
+
+def encodearray(values, dtype):
+    """
+    Encode array as base64 string of little-endian values
+    """
+
+    return base64.b64encode(np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()).decode('ascii')
+
+def getchanges(geometrytype, yearfrom, yearto, model='linear', trajectory='linear', bbox=None):
+    """
+    Get emissions (tonnes) of areas of geometry type in two years with absolute and percentage change between them
+
+    If bbox (xmin, ymin, xmax, ymax) provided, only areas whose bounds overlap it are included
+    Returns dictionary with 'codes' list and base64-encoded arrays, or None if forecasts have not been precomputed
+    Value arrays are float32 indexed [area, column] with columns in order of COLUMNS, and percentage change
+    is NaN where emissions in first year are zero. 'predicted' is uint8 indexed [area, year] and is 1 where value is predicted
+    """
+
+    store = getstore()
+    if store is None: return None
+
+    selected = store.geometrytypes == geometrytype
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        bounds = getareabounds(store)
+        # Comparisons with NaN bounds are False, so areas without bounds are excluded
+        selected &= (bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin)
+    indexes = np.nonzero(selected)[0]
+
+    years = np.array([int(yearfrom), int(yearto)])
+    consumption, isprediction = calculateconsumption(store, indexes, years, model)
+    emissions = consumption * (getconversionfactors(years, trajectory) / 1000)[None, :, :]
+    # Append total of all fuels, giving array indexed [area, column, year]
+    emissions = np.concatenate([emissions, emissions.sum(axis=1, keepdims=True)], axis=1)
+
+    start, end = emissions[:, :, 0], emissions[:, :, 1]
+    change = end - start
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentchange = np.where(start > 0, 100 * change / start, np.nan)
+
+    return {
+        'count': len(indexes),
+        'columns': COLUMNS,
+        'codes': store.codes[indexes].astype(str).tolist(),
+        'from': encodearray(start, 'f4'),
+        'to': encodearray(end, 'f4'),
+        'change': encodearray(change, 'f4'),
+        'percentchange': encodearray(percentchange, 'f4'),
+        'predicted': encodearray(isprediction, 'u1'),
+    }
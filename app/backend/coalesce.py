@@ -0,0 +1,139 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/coalesce.py
+Coalescing of concurrent identical requests so only one request computes response
+
+Requests are identified by key. Within worker, first request for key computes response while
+concurrent requests for same key wait for and share its result, which only applies to workers
+running several threads, eg. gunicorn --threads. Across workers, if shared memcached cache is
+configured (see COALESCE_CACHE_LOCATION in carbonmap/settings.py), first worker to take lock for
+key computes response and stores it briefly in shared cache, while other workers wait for it
+rather than repeating same query and serialization.
+
+With default deployment, gunicorn sync workers each handling one request at a time and no shared
+cache, neither applies and every request computes its own response.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+
+# Seconds result is kept in shared cache for requests arriving while or just after it is computed
+resultlifetime = 10
+
+# Seconds after which lock in shared cache expires, in case worker holding it dies
+locklifetime = 60
+
+# Seconds between checks for result computed by other worker
+pollinterval = 0.05
+
+# Seconds to wait for other worker before computing result anyway
+maxwait = 30
+
+_flights = {}
+_lock = threading.Lock()
+
+class Flight:
+    """
+    Single computation within worker that concurrent identical requests wait for
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result, self.error = None, None
+
+def getkey(*parts):
+    """
+    Get key identifying request from JSON-serialisable parts of request
+    """
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def getsharedcache():
+    """
+    Get shared cache used to coalesce requests across workers, or None if disabled
+    """
+
+    if not getattr(settings, 'COALESCE_ACROSS_WORKERS', False): return None
+    return caches['shared']
+
+def waitforresult(cache, resultkey, lockkey):
+    """
+    Wait for other worker holding lock to store result
+
+    Returns None if other worker releases lock without storing result or takes too long
+    """
+
+    deadline = time.time() + maxwait
+    while time.time() < deadline:
+        time.sleep(pollinterval)
+        result = cache.get(resultkey)
+        if result is not None: return result
+        if cache.get(lockkey) is None: return cache.get(resultkey)
+    return None
+
+def computeshared(key, compute):
+    """
+    Get result of compute(), sharing single computation between workers using shared cache
+    """
+
+    cache = getsharedcache()
+    if cache is None: return compute()
+
+    resultkey, lockkey = 'coalesce-result-' + key, 'coalesce-lock-' + key
+    try:
+        result = cache.get(resultkey)
+        if result is not None: return result
+        locked = cache.add(lockkey, 1, locklifetime)
+        if not locked:
+            result = waitforresult(cache, resultkey, lockkey)
+            if result is not None: return result
+    except Exception:
+        # Shared cache unavailable, eg. memcached not running, so coalesce within worker only
+        return compute()
+
+    try:
+        result = compute()
+        cache.set(resultkey, result, resultlifetime)
+    finally:
+        if locked: cache.delete(lockkey)
+
+    return result
+
+def coalesce(key, compute):
+    """
+    Get result of compute() for request key, sharing single computation between concurrent identical requests
+
+    Result must not be None and should be serialised response, so waiting requests skip serialisation too
+    """
+
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            _flights[key] = flight
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None: raise flight.error
+        return flight.result
+
+    try:
+        flight.result = computeshared(key, compute)
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+
+    return flight.result
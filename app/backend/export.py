@@ -0,0 +1,175 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/export.py
+Bulk export of recorded and predicted energy use and emissions of all areas as CSV or Parquet
+
+Areas are exported in fixed-size chunks so memory use does not grow with number of areas.
+Chunks are calculated from precomputed forecast store or, if forecasts have not been precomputed,
+from Data table read through server-side cursor one chunk of areas at a time.
+"""
+
+import csv
+import io
+import importlib.util
+import numpy as np
+
+from .models import Data
+from .areas import getareas
+from .carbonmodel import FUELS, getstore, buildstore, calculateconsumption, getconversionfactors
+
+# Available export formats
+EXPORTFORMATS = ['csv', 'parquet']
+
+# Number of areas calculated and written at once
+exportchunksize = 2000
+
+# Exported columns
+COLUMNS = ['code', 'name', 'type', 'year', 'predicted'] + [fuel + '_kwh' for fuel in FUELS] + [fuel + '_tonnes' for fuel in FUELS]
+
+def getstorechunks(geometrytype):
+    """
+    Get stores and indexes of areas of geometry type in chunks
+
+    Yields (store, indexes) for each chunk
+    """
+
+    store = getstore()
+    if store is not None:
+        indexes = np.nonzero(store.geometrytypes == geometrytype)[0]
+        for start in range(0, len(indexes), exportchunksize):
+            yield store, indexes[start:start + exportchunksize]
+        return
+
+    # No precomputed forecasts so build store for each chunk of areas from data ordered by area
+    rows, codes = [], set()
+    data = Data.objects.filter(geometrytype=geometrytype).order_by('geometrycode')
+    for row in data.values_list('geometrycode', 'geometrytype', 'type', 'year', 'value').iterator(chunk_size=10000):
+        if (row[0] not in codes) and (len(codes) == exportchunksize):
+            chunkstore = buildstore(rows)
+            yield chunkstore, np.arange(len(chunkstore.codes))
+            rows, codes = [], set()
+        rows.append(row)
+        codes.add(row[0])
+
+    if len(rows) > 0:
+        chunkstore = buildstore(rows)
+        yield chunkstore, np.arange(len(chunkstore.codes))
+
+def getexportchunks(geometrytype, yearstart, yearend, model='linear', trajectory='linear'):
+    """
+    Get recorded and predicted energy use and emissions of all areas of geometry type for year range in chunks
+
+    Yields dictionary of column arrays for each chunk, with one row per area and year
+    """
+
+    years = np.arange(int(yearstart), 1 + int(yearend))
+    factors = getconversionfactors(years, trajectory) / 1000
+    areas = getareas()
+
+    for store, indexes in getstorechunks(geometrytype):
+        if len(indexes) == 0: continue
+        consumption, isprediction = calculateconsumption(store, indexes, years, model)
+        emissions = consumption * factors[None, :, :]
+        codes = store.codes[indexes].astype(str)
+        names = np.array([areas[code]['name'] if code in areas else '' for code in codes.tolist()])
+
+        chunk = {
+            'code': np.repeat(codes, len(years)),
+            'name': np.repeat(names, len(years)),
+            'type': np.full(len(indexes) * len(years), geometrytype),
+            'year': np.tile(years, len(indexes)),
+            'predicted': isprediction.reshape(-1),
+        }
+        for fuel in range(len(FUELS)):
+            chunk[FUELS[fuel] + '_kwh'] = np.round(consumption[:, fuel, :], 2).reshape(-1)
+            chunk[FUELS[fuel] + '_tonnes'] = np.round(emissions[:, fuel, :], 3).reshape(-1)
+
+        yield chunk
+
+def streamcsv(chunks):
+    """
+    Convert chunks of column arrays into CSV text, yielding text for header and each chunk
+    """
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    yield output.getvalue()
+
+    for chunk in chunks:
+        output.seek(0)
+        output.truncate()
+        writer.writerows(zip(*[chunk[column].tolist() for column in COLUMNS]))
+        yield output.getvalue()
+
+class StreamSink:
+    """
+    Write-only file object that collects written bytes until they are taken
+    Allows Parquet file to be streamed as it is written
+    """
+
+    def __init__(self):
+        self.parts, self.position, self.closed = [], 0, False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def streamparquet(chunks):
+    """
+    Convert chunks of column arrays into Parquet file, yielding bytes as each chunk is written as row group
+
+    Requires pyarrow
+    """
+
+    import pyarrow
+    import pyarrow.parquet
+
+    fields = [(column, pyarrow.string()) for column in COLUMNS[0:3]] + [('year', pyarrow.int64()), ('predicted', pyarrow.bool_())]
+    schema = pyarrow.schema(fields + [(column, pyarrow.float64()) for column in COLUMNS[5:]])
+
+    sink = StreamSink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'), schema, compression='snappy')
+    for chunk in chunks:
+        writer.write_table(pyarrow.table({column: chunk[column] for column in COLUMNS}, schema=schema))
+        yield sink.take()
+
+    writer.close()
+    yield sink.take()
+
+def isformatavailable(exportformat):
+    """
+    Whether export format can be used, as Parquet export requires optional pyarrow package
+    """
+
+    if exportformat not in EXPORTFORMATS: return False
+    if exportformat == 'parquet': return importlib.util.find_spec('pyarrow') is not None
+    return True
+
+def streamexport(exportformat, geometrytype, yearstart, yearend, model='linear', trajectory='linear'):
+    """
+    Stream export of geometry type for year range in particular format, yielding text (CSV) or bytes (Parquet)
+    """
+
+    chunks = getexportchunks(geometrytype, yearstart, yearend, model, trajectory)
+    if exportformat == 'parquet': return streamparquet(chunks)
+    return streamcsv(chunks)
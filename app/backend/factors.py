@@ -0,0 +1,148 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/factors.py
+Versioned GHG conversion factors held as year-indexed NumPy arrays
+
+Conversion factors are imported into the ConversionFactor table as complete versions so factors
+can be updated without code changes. Each worker loads the latest version once into a FactorTable
+and falls back to factors in conversionfactors.py if none have been imported.
+"""
+
+import time
+import numpy as np
+from django.db import transaction
+
+from .models import ConversionFactor
+from .conversionfactors import converter_kg_electricity, converter_kg_gas
+
+# Version name used for factors in conversionfactors.py
+DEFAULTVERSION = 'default'
+
+# Earliest year of each fuel's factors to use when fitting trends
+# First two values for gas are copied from 2012 and might distort estimates
+fitfromyear = {'gas': 2012}
+
+# Seconds between checks for newer version of conversion factors
+versioncheckinterval = 60
+
+# Maximum number of trajectories cached for each version
+maxcachedtrajectories = 1000
+
+_cache = {'table': None, 'version': None, 'checked': 0}
+
+class FactorTable:
+    """
+    Conversion factors (kg CO2e per kWh) for set of fuels held as array indexed [fuel, year]
+    Years are contiguous from first year, with NaN where no factor is published
+    """
+
+    def __init__(self, version, factors):
+        """
+        factors is dictionary of {fuel: {year: value}}
+        """
+
+        self.version = version
+        self.fuels = sorted(factors.keys())
+        allyears = [int(year) for fuel in self.fuels for year in factors[fuel].keys()]
+        self.firstyear = min(allyears) if len(allyears) > 0 else 0
+        numyears = (max(allyears) - self.firstyear + 1) if len(allyears) > 0 else 0
+        self.values = np.full((len(self.fuels), numyears), np.nan)
+        for fuel, fuelfactors in enumerate([factors[fuel] for fuel in self.fuels]):
+            for year, value in fuelfactors.items():
+                self.values[fuel, int(year) - self.firstyear] = value
+        self.fuelindex = {fuel: index for index, fuel in enumerate(self.fuels)}
+        self._trajectories = {}
+
+    def lookup(self, fuels, years):
+        """
+        Get published factors for fuels and array of years as array indexed [fuel, year], with NaN where not published
+        """
+
+        years = np.asarray(years, dtype=np.int64)
+        factors = np.full((len(fuels), len(years)), np.nan)
+        positions = years - self.firstyear
+        withinrange = (positions >= 0) & (positions < self.values.shape[1])
+        for position, fuel in enumerate(fuels):
+            if fuel not in self.fuelindex: continue
+            factors[position, withinrange] = self.values[self.fuelindex[fuel], positions[withinrange]]
+        return factors
+
+    def published(self, fuel):
+        """
+        Get arrays of years with published factors and their factors for single fuel
+        """
+
+        if fuel not in self.fuelindex: return np.zeros(0, dtype=np.int64), np.zeros(0)
+        values = self.values[self.fuelindex[fuel]]
+        known = ~np.isnan(values)
+        return np.arange(self.firstyear, self.firstyear + len(values))[known], values[known]
+
+    def trajectory(self, fuels, years, trajectory, calculate):
+        """
+        Get cached factors for fuels, years and trajectory, calling calculate(table, fuels, years, trajectory) if not cached
+        """
+
+        years = np.asarray(years, dtype=np.int64)
+        key = (tuple(fuels), trajectory, years.tobytes())
+        if key not in self._trajectories:
+            if len(self._trajectories) >= maxcachedtrajectories: self._trajectories = {}
+            self._trajectories[key] = calculate(self, fuels, years, trajectory)
+        return self._trajectories[key]
+
+def getdefaultfactors():
+    """
+    Get factors from conversionfactors.py as dictionary of {fuel: {year: value}}
+    """
+
+    return {
+        'electricity': {int(year): value for year, value in converter_kg_electricity.items()},
+        'gas': {int(year): value for year, value in converter_kg_gas.items()},
+    }
+
+def getlatestversion():
+    """
+    Get name of most recently imported version of conversion factors, or None if none imported
+    """
+
+    return ConversionFactor.objects.order_by('-id').values_list('version', flat=True).first()
+
+def loadfactors(version):
+    """
+    Load particular version of conversion factors as dictionary of {fuel: {year: value}}
+    """
+
+    factors = {}
+    for fuel, year, value in ConversionFactor.objects.filter(version=version).values_list('fuel', 'year', 'value').iterator():
+        factors.setdefault(fuel, {})[year] = value
+    return factors
+
+def getfactortable():
+    """
+    Get table of latest version of conversion factors, reloading if newer version has been imported
+    """
+
+    now = time.time()
+    if (_cache['table'] is None) or ((now - _cache['checked']) > versioncheckinterval):
+        _cache['checked'] = now
+        version = getlatestversion()
+        if (_cache['table'] is None) or (version != _cache['version']):
+            if version is None: _cache['table'] = FactorTable(DEFAULTVERSION, getdefaultfactors())
+            else: _cache['table'] = FactorTable(version, loadfactors(version))
+            _cache['version'] = version
+
+    return _cache['table']
+
+def savefactors(version, factors):
+    """
+    Save complete version of conversion factors from dictionary of {fuel: {year: value}}, replacing any existing version with same name
+    """
+
+    rows = [ConversionFactor(version=version, fuel=fuel, year=int(year), value=value) for fuel in factors for year, value in factors[fuel].items()]
+    with transaction.atomic():
+        ConversionFactor.objects.filter(version=version).delete()
+        ConversionFactor.objects.bulk_create(rows, batch_size=1000)
+    _cache['table'] = None
@@ -0,0 +1,162 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/fastadmin.py
+Helpers keeping Django admin usable for tables with millions of rows
+
+Unfiltered change lists are paginated using table size estimated by PostgreSQL rather than exact
+COUNT(*), and filtered change lists fall back to query planner's estimate if exact count takes too
+long. Admin search uses case-insensitive trigram indexes created after migrations, see
+createsearchindexes, and maps are rendered as small SVG previews of area's lowest zoom geometry
+rather than loading full resolution geometry into map widget.
+"""
+
+import json
+import math
+from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections, transaction, DatabaseError, OperationalError
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+
+# Tables with more rows than this are paginated using estimated count
+estimatedcountminimum = 50000
+
+# Milliseconds exact count of filtered change list may take before estimated count is used instead
+counttimeout = 1000
+
+# Width and height of geometry previews in pixels
+previewsize = 240
+
+# Decimal places of coordinates in geometry previews
+previewprecision = 4
+
+def gettableestimate(connection, table):
+    """
+    Get number of rows in table estimated by PostgreSQL statistics, or None if table has never been analysed
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        row = cursor.fetchone()
+
+    if (row is None) or (row[0] < 0): return None
+    return int(row[0])
+
+def getplanestimate(connection, queryset):
+    """
+    Get number of rows queryset is estimated to return by query planner
+    """
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str): plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def getcount(queryset):
+    """
+    Get number of rows in queryset, estimated where exact count would be slow
+    """
+
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql': return queryset.count()
+
+    if not queryset.query.where:
+        estimate = gettableestimate(connection, queryset.model._meta.db_table)
+        if (estimate is not None) and (estimate > estimatedcountminimum): return estimate
+        return queryset.count()
+
+    try:
+        with transaction.atomic(using=queryset.db):
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", [counttimeout])
+            return queryset.count()
+    except OperationalError:
+        # Count cancelled by statement timeout
+        return getplanestimate(connection, queryset)
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting rows with getcount, so large tables are not counted row by row
+    """
+
+    @cached_property
+    def count(self):
+        return getcount(self.object_list)
+
+class FastAdmin(admin.ModelAdmin):
+    """
+    Admin options for large tables, paginating with estimated counts and skipping count of unfiltered table
+    """
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+class YearListFilter(admin.SimpleListFilter):
+    """
+    Filter by year listing range of years between first and last year in table
+    Unlike filtering on field, which lists distinct values of every row, only reads ends of year index
+    """
+
+    title = 'year'
+    parameter_name = 'year'
+
+    def lookups(self, request, model_admin):
+        years = model_admin.model.objects.order_by('year').values_list('year', flat=True)
+        firstyear, lastyear = years.first(), years.reverse().first()
+        if firstyear is None: return []
+        return [(str(year), str(year)) for year in range(int(lastyear), int(firstyear) - 1, -1)]
+
+    def queryset(self, request, queryset):
+        if self.value() is None: return queryset
+        return queryset.filter(year=self.value())
+
+def getpreview(geometries):
+    """
+    Get SVG preview of lowest zoom, and so most simplified, geometry among Geometry queryset
+    """
+
+    from django.contrib.gis.db.models.functions import AsSVG
+
+    geometry = geometries.filter(shape__isnull=False).order_by('zoom') \
+        .annotate(svg=AsSVG('shape__geometry', precision=previewprecision)).values('svg', 'bbox', 'zoom').first()
+    if (geometry is None) or (geometry['bbox'] is None): return '-'
+
+    xmin, ymin, xmax, ymax = geometry['bbox'].extent
+    # Scale longitude to match latitude in distance at middle of area, as in map
+    scale = math.cos(math.radians((ymin + ymax) / 2))
+    width, height = max((xmax - xmin) * scale, 1e-6), max(ymax - ymin, 1e-6)
+    # SVG paths from PostGIS have latitude negated so north is up
+    viewbox = "{} {} {} {}".format(xmin * scale, -ymax, width, height)
+
+    return format_html(
+        '<svg width="{}" height="{}" viewBox="{}" preserveAspectRatio="xMidYMid meet">'
+        '<path d="{}" transform="scale({} 1)" fill="#88c" fill-opacity="0.5" stroke="#226" stroke-width="1" vector-effect="non-scaling-stroke"/>'
+        '</svg><br/>Zoom {}',
+        previewsize, previewsize, viewbox, geometry['svg'], scale, geometry['zoom'])
+
+def createsearchindexes(connection, searchindexes):
+    """
+    Create trigram indexes used by admin search, matching UPPER(field) expression of case-insensitive lookups
+    searchindexes maps model to list of fields to index
+    """
+
+    if connection.vendor != 'postgresql': return
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for model, fields in searchindexes.items():
+                table = model._meta.db_table
+                for field in fields:
+                    column = model._meta.get_field(field).column
+                    cursor.execute("CREATE INDEX IF NOT EXISTS {} ON {} USING gin (UPPER({}::text) gin_trgm_ops)".format(
+                        connection.ops.quote_name(table + '_' + column + '_trgm'), connection.ops.quote_name(table), connection.ops.quote_name(column)))
+    except DatabaseError as error:
+        print("Unable to create admin search indexes, admin search will not be indexed:", error)
@@ -0,0 +1,202 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/geocode.py
+Batch geocoding of postcodes and town names
+
+Towns are resolved from per-worker index of Location table and postcodes from Postcode table
+in batched queries. Postcodes missing from Postcode table are looked up with remote API using
+limited number of concurrent requests, each with timeout and all within overall deadline, and saved
+so later lookups are local. Postcodes remote API could not find are remembered by each worker for
+a while so they are not looked up again on every request. Containing areas of all resolved points
+are found in single spatial index query, see lookup.py
+"""
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from ukpostcodeutils import validation
+
+from .models import Location, Postcode
+from .gis import get_postcode_point
+from .lookup import lookuppoints
+
+# Seconds after which town index is reloaded
+cachelifetime = 600
+
+# Number of postcodes queried from Postcode table at once
+postcodebatchsize = 5000
+
+# Maximum number of concurrent requests to remote postcode API
+maxremoterequests = 8
+
+# Maximum number of postcodes looked up with remote API for single batch
+maxremotelookups = 1000
+
+# Seconds to wait for response to single remote postcode lookup
+remotetimeout = 5
+
+# Seconds all remote postcode lookups of single batch must complete within, well below gunicorn worker timeout
+remotedeadline = 15
+
+# Seconds postcode not found by remote API is not looked up again
+notfoundlifetime = 3600
+
+# Seconds postcode is not looked up again after remote API failed or timed out
+unavailablelifetime = 300
+
+# Reasons postcode was not resolved
+# notfound: remote API has no such postcode
+# unavailable: remote API failed or timed out
+# limit: too many postcodes to look up remotely in single batch, or deadline reached before postcode was looked up
+UNRESOLVEDREASONS = ['notfound', 'unavailable', 'limit']
+
+# Zoom level used for postcodes
+postcodezoom = 15
+
+_cache = {'towns': {}, 'loaded': 0, 'unresolved': {}}
+
+def normalisepostcode(text):
+    """
+    Convert text to postcode format used for lookups, ie. upper case without spaces
+    """
+
+    return re.sub("[^0-9a-zA-Z]+", "", text).upper()
+
+def loadtowns():
+    """
+    Load index of lower case town name to (lng, lat, zoom), keeping first town by county where names are shared
+    """
+
+    towns = {}
+    for town, location, scale in Location.objects.exclude(location=None).order_by('county', 'town').values_list('town', 'location', 'scale').iterator():
+        towns.setdefault(town.lower(), (location[0], location[1], scale))
+
+    _cache['towns'] = towns
+    _cache['loaded'] = time.time()
+
+def gettowns():
+    """
+    Get town index, loading index if cache has expired
+    """
+
+    if (time.time() - _cache['loaded']) > cachelifetime: loadtowns()
+    return _cache['towns']
+
+def getremotepostcodepoint(postcode):
+    """
+    Get (lng, lat) of postcode using remote API
+
+    Returns 'notfound' if postcode not found or 'unavailable' if API failed or timed out
+    """
+
+    try:
+        point = get_postcode_point(postcode, timeout=remotetimeout)
+    except Exception:
+        return 'unavailable'
+    if point is None: return 'notfound'
+    return (point[0], point[1])
+
+def getcachedunresolved(postcode, now):
+    """
+    Get reason postcode recently could not be resolved remotely, or None if it should be looked up
+    """
+
+    unresolved = _cache['unresolved'].get(postcode)
+    if (unresolved is None) or (now > unresolved[1]): return None
+    return unresolved[0]
+
+def getremotepostcodepoints(postcodes):
+    """
+    Look up postcodes with remote API within deadline
+
+    Returns dictionary of postcode to (lng, lat) or reason postcode was not resolved
+    """
+
+    executor = ThreadPoolExecutor(max_workers=maxremoterequests)
+    futures = {postcode: executor.submit(getremotepostcodepoint, postcode) for postcode in postcodes}
+    wait(list(futures.values()), timeout=remotedeadline)
+    # Lookups not yet started are cancelled and running lookups end within remotetimeout, so request need not wait for them
+    for future in futures.values(): future.cancel()
+    executor.shutdown(wait=False)
+
+    return {postcode: (future.result() if future.done() and not future.cancelled() else 'limit') for postcode, future in futures.items()}
+
+def getpostcodepoints(postcodes):
+    """
+    Get dictionary of postcode to (lng, lat) for set of normalised postcodes, and dictionary of unresolved postcode to reason
+
+    Postcodes not in Postcode table are looked up with remote API and saved
+    """
+
+    postcodes = list(postcodes)
+    points, unresolved = {}, {}
+    for start in range(0, len(postcodes), postcodebatchsize):
+        for postcode, longitude, latitude in Postcode.objects.filter(postcode__in=postcodes[start:start + postcodebatchsize]).values_list('postcode', 'longitude', 'latitude'):
+            points[postcode] = (longitude, latitude)
+
+    now = time.time()
+    missing = []
+    for postcode in postcodes:
+        if postcode in points: continue
+        reason = getcachedunresolved(postcode, now)
+        if reason is not None: unresolved[postcode] = reason
+        elif len(missing) < maxremotelookups: missing.append(postcode)
+        else: unresolved[postcode] = 'limit'
+    if len(missing) == 0: return points, unresolved
+
+    remotepoints = getremotepostcodepoints(missing)
+
+    found = []
+    for postcode, point in remotepoints.items():
+        if isinstance(point, tuple):
+            found.append(Postcode(postcode=postcode, longitude=point[0], latitude=point[1]))
+            continue
+        unresolved[postcode] = point
+        if point == 'notfound': _cache['unresolved'][postcode] = (point, now + notfoundlifetime)
+        elif point == 'unavailable': _cache['unresolved'][postcode] = (point, now + unavailablelifetime)
+
+    Postcode.objects.bulk_create(found, ignore_conflicts=True)
+    points.update({postcode.postcode: (postcode.longitude, postcode.latitude) for postcode in found})
+
+    return points, unresolved
+
+def geocode(locations, includeareas=True):
+    """
+    Geocode list of postcodes and town names
+
+    Returns list of results in same order as locations, each with 'result' of 'success' or 'failure'
+    Successful results contain 'lat', 'lng', 'zoom' and, if includeareas set, 'areas' with codes of containing areas of every type
+    Failed postcode results contain 'reason', see UNRESOLVEDREASONS
+    """
+
+    texts = [str(location).strip() for location in locations]
+    postcodes = [normalisepostcode(text) for text in texts]
+    ispostcode = [validation.is_valid_postcode(postcode) for postcode in postcodes]
+
+    postcodepoints, unresolved = getpostcodepoints(set([postcode for postcode, valid in zip(postcodes, ispostcode) if valid]))
+    towns = gettowns()
+
+    results, resolved = [], []
+    for index, text in enumerate(texts):
+        if ispostcode[index]: point = postcodepoints.get(postcodes[index])
+        else: point = towns.get(text.lower())
+
+        if point is None:
+            results.append({'result': 'failure'})
+            if ispostcode[index]: results[-1]['reason'] = unresolved.get(postcodes[index], 'notfound')
+            continue
+
+        zoom = postcodezoom if ispostcode[index] else point[2]
+        results.append({'result': 'success', 'lat': point[1], 'lng': point[0], 'zoom': zoom})
+        resolved.append(index)
+
+    if includeareas and (len(resolved) > 0):
+        codes = lookuppoints([results[index]['lng'] for index in resolved], [results[index]['lat'] for index in resolved])
+        for position, index in enumerate(resolved):
+            results[index]['areas'] = {areatype: codes[areatype][position] for areatype in codes}
+
+    return results
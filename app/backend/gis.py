@@ -8,10 +8,11 @@ backend/gis.py
 GIS-related functions
 """
 
-import urllib
+import urllib.parse
+import urllib.request
 import json
-import requests
 import math
+import hashlib
 
 from django.contrib.gis.geos import Point
 
@@ -33,6 +34,23 @@ def get_meters_per_pixel(zoom):
 
     return d
 
+def get_mercator_meters_per_pixel(zoom):
+    """
+    Get Web Mercator meters per pixel at particular zoom level
+
+    Unlike ground distance, Web Mercator distance per pixel is the same at every latitude
+    so is used to simplify geometries projected into Web Mercator
+
+    Formula is:
+    d = C / 2^(zoom + 8)
+    where C = 40075016.686 (equatorial circumference)
+    """
+
+    C = 40075016.686
+    d = C / (2 ** (zoom + 8))
+
+    return d
+
 def get_degrees_per_pixel(zoom):
     """
     Get degrees per pixel in order to determine appropriate 
@@ -49,9 +67,16 @@ def get_degrees_per_pixel(zoom):
 
     return d
 
-def get_postcode_point(postcode):
+def get_shape_hash(wkb):
+    """
+    Get fingerprint of shape from its WKB, used to store identical shapes once
+    """
+
+    return hashlib.sha256(bytes(wkb)).hexdigest()
+
+def get_postcode_point(postcode, timeout=10):
     """
-    Gets coordinates of postcode using public api 
+    Gets coordinates of postcode using public api, waiting no more than timeout seconds for response
 
     Very kindly provided by http://api.getthedata.com/
     """
@@ -61,7 +86,7 @@ def get_postcode_point(postcode):
 
     url = 'http://api.getthedata.com/postcode/' + urllib.parse.quote_plus(postcode)
     req =  urllib.request.Request(url)
-    response = urllib.request.urlopen(req)
+    response = urllib.request.urlopen(req, timeout=timeout)
     result = json.loads(response.read().decode())
 
     if result['status'] and result['status'] == 'match':
@@ -0,0 +1,117 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/lookup.py
+Per-worker spatial index for finding areas containing points
+
+Full resolution (zoom 15) geometries of each area type are loaded once into shapely STRtree
+so containing areas of any number of points are found in single vectorised query without database access.
+Index is rebuilt when generated geometries change. Shapely is imported on first lookup so it is not
+loaded by web workers that never serve lookups.
+"""
+
+import time
+import numpy as np
+from django.db.models import Count, Max
+from django.contrib.gis.db.models.functions import AsWKB
+
+from .models import Geometry, GEOMETRY_CHOICES
+
+# Zoom level of geometries used for lookups
+lookupzoom = 15
+
+# Seconds between checks for regenerated geometries
+versioncheckinterval = 60
+
+# Area types in order of size, largest first
+AREATYPES = ['lau1', 'msoa', 'lsoa']
+
+_cache = {'indexes': None, 'version': None, 'checked': 0}
+
+class AreaIndex:
+    """
+    STRtree of prepared geometries of single area type, with code of each geometry
+    """
+
+    def __init__(self, codes, geometries):
+        import shapely
+
+        self.codes = np.asarray(codes, dtype=object)
+        self.geometries = geometries
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def query(self, points):
+        """
+        Get code of area containing each point, or None where no area contains point
+        Points on shared boundary are assigned to one area only
+        """
+
+        codes = np.full(len(points), None, dtype=object)
+        if len(self.codes) == 0: return codes
+        pointindexes, geometryindexes = self.tree.query(points, predicate='intersects')
+        # Where point is on boundary of several areas, earliest match is assigned last so is kept
+        codes[pointindexes[::-1]] = self.codes[geometryindexes[::-1]]
+        return codes
+
+def getversion():
+    """
+    Get fingerprint of lookup geometries, which changes whenever geometries are regenerated
+    """
+
+    version = Geometry.objects.filter(zoom=lookupzoom).aggregate(Max('id'), Count('id'))
+    return (version['id__max'], version['id__count'])
+
+def buildindexes():
+    """
+    Build area index for each area type from lookup geometries
+    """
+
+    import shapely
+
+    rows = {areatype: ([], []) for areatype, description in GEOMETRY_CHOICES}
+    geometries = Geometry.objects.filter(zoom=lookupzoom).exclude(shape=None).annotate(wkb=AsWKB('shape__geometry')).values_list('type', 'code', 'wkb')
+    for areatype, code, wkb in geometries.iterator():
+        rows[areatype][0].append(code)
+        rows[areatype][1].append(bytes(wkb))
+
+    return {areatype: AreaIndex(codes, shapely.from_wkb(wkbs)) for areatype, (codes, wkbs) in rows.items()}
+
+def getindexes():
+    """
+    Get area indexes, rebuilding if geometries have been regenerated since they were built
+    """
+
+    now = time.time()
+    if (_cache['indexes'] is None) or ((now - _cache['checked']) > versioncheckinterval):
+        _cache['checked'] = now
+        version = getversion()
+        if (_cache['indexes'] is None) or (version != _cache['version']):
+            _cache['indexes'] = buildindexes()
+            _cache['version'] = version
+
+    return _cache['indexes']
+
+def lookuppoints(lngs, lats):
+    """
+    Get codes of areas of every type containing each of array of points
+
+    Returns dictionary of area type to array of codes, with None where no area of type contains point
+    """
+
+    import shapely
+
+    points = shapely.points(np.asarray(lngs, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+    indexes = getindexes()
+    return {areatype: indexes[areatype].query(points) for areatype in AREATYPES if areatype in indexes}
+
+def lookuppoint(lng, lat):
+    """
+    Get codes of areas of every type containing single point, with None where no area of type contains point
+    """
+
+    codes = lookuppoints([lng], [lat])
+    return {areatype: codes[areatype][0] for areatype in codes}
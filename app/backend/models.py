@@ -11,9 +11,16 @@ Django models
 from django.db import models
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import GEOSGeometry, Point
+from django.contrib import admin
 from django.contrib.gis.admin import OSMGeoAdmin
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
+from django.urls import reverse
+from django.utils.html import format_html
+from django.db import connections
+from django.db.migrations.operations import AlterField
+from django.db.models.signals import pre_save, pre_migrate, post_migrate
+
+from .fastadmin import FastAdmin, YearListFilter, getpreview, createsearchindexes
 
 # Range of possible geographical geometries
 GEOMETRY_CHOICES = (
@@ -37,9 +44,9 @@ class Location(models.Model):
     town = models.CharField(max_length=100)
     county = models.CharField(max_length=100)
     country = models.CharField(max_length=100)
-    population = models.CharField(max_length=100)
-    latitude = models.CharField(max_length=100)
-    longitude = models.CharField(max_length=100)
+    population = models.IntegerField(null=True, blank=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
     url = models.CharField(max_length=100)
     location = models.PointField(null=True, blank=True)
 
@@ -58,8 +65,30 @@ def update_location(sender, instance, *args, **kwargs):
     """
     Whenever location is updated, update its GIS 'location' field baed on long/lat values
     """
-    if (instance.longitude != '') and (instance.latitude != ''):
-        instance.location = Point(float(instance.longitude), float(instance.latitude))
+    if (instance.longitude is not None) and (instance.latitude is not None):
+        instance.location = Point(instance.longitude, instance.latitude)
+
+@receiver(pre_migrate)
+def clear_text_locations(sender, using, plan=None, **kwargs):
+    """
+    Before migration changes Location population, latitude and longitude from text to numbers, delete all locations
+    Text values such as '' can't be cast to numbers, and importlocations recreates locations with numbers
+    """
+    if (sender.name != 'backend') or (plan is None): return
+
+    fields = ['population', 'latitude', 'longitude']
+    altered = [operation.name for migration, backwards in plan if not backwards for operation in migration.operations \
+                if isinstance(operation, AlterField) and (operation.model_name == 'location') and (operation.name in fields)]
+    if len(altered) == 0: return
+
+    connection, table = connections[using], Location._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor): return
+        columns = {column.name: column for column in connection.introspection.get_table_description(cursor, table)}
+        texttypes = ['CharField', 'TextField']
+        if not any([(name in columns) and (connection.introspection.get_field_type(columns[name].type_code, columns[name]) in texttypes) for name in altered]): return
+        cursor.execute("DELETE FROM " + connection.ops.quote_name(table))
+        print("Deleted locations stored as text so they can be migrated to numbers - run 'tools.py importlocations' to import them again")
 
 class LocationAdmin(OSMGeoAdmin):
     """
@@ -71,19 +100,43 @@ class LocationAdmin(OSMGeoAdmin):
         'shortcode',
     )
 
+class Postcode(models.Model):
+    """
+    Stores coordinates of postcodes for local geocoding, from imported postcode directory or remote lookups
+    postcode is upper case without spaces
+    """
+    postcode = models.CharField(max_length = 10, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    def __str__(self):
+        return self.postcode
+
+class Shape(models.Model):
+    """
+    Stores unique geographical shapes
+    Identical shapes, eg. same area at several zoom levels, are stored once and shared by Geometry rows
+    hash is SHA-256 fingerprint of shape's WKB, see gis.get_shape_hash
+    """
+    hash = models.CharField(max_length = 64, unique=True)
+    geometry = models.GeometryField(null=True, blank=True)
+
 class Geometry(models.Model):
     """
     Stores geographical geometries, eg. LAU1, MSOA, IG, LSOA, DZ polygons
     Uses zoom-specific resolutions to minimise download size to user
+    Each row maps area and zoom level to its shape, with shape's bounding box stored for spatial queries
     """
     type = models.CharField(max_length = 200, choices=GEOMETRY_CHOICES)
     name = models.CharField(max_length = 200)
     code = models.CharField(max_length = 200)
     zoom = models.IntegerField(default = 0)
-    geometry = models.GeometryField(null=True, blank=True)
+    shape = models.ForeignKey(Shape, on_delete=models.PROTECT, null=True, blank=True)
+    bbox = models.GeometryField(null=True, blank=True)
 
     def _get_geometry(self):
-        return self.geometry
+        if self.shape is None: return None
+        return self.shape.geometry
 
     geom = property(_get_geometry)
     
@@ -92,21 +145,114 @@ class Geometry(models.Model):
             models.Index(fields=['type',]),
             models.Index(fields=['code',]),
             models.Index(fields=['zoom']),
-            models.Index(fields=['geometry',]),
+            models.Index(fields=['bbox',]),
         ]
 
-class GeometryAdmin(OSMGeoAdmin):
+class GeometryAdmin(FastAdmin, OSMGeoAdmin):
     """
     Admin class for managing geometries through admin interface
+    Shapes are shown as preview of area's lowest zoom geometry rather than loaded into map
     """
     list_display = ['name', 'type', 'code', 'zoom']
+    list_filter = ['type']
+    raw_id_fields = ['shape']
+    readonly_fields = ['preview']
 
     search_fields = (
         'name',
-        'type',
-        'code'
+        '^code'
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('bbox')
+
+    def preview(self, geometry):
+        return getpreview(Geometry.objects.filter(type=geometry.type, code=geometry.code))
+
+class Area(models.Model):
+    """
+    Stores attributes of geographical areas without their polygons
+    Allows area lookups without reading the much larger Geometry table
+    parentcodes stores space-separated codes of areas containing this area, largest first
+    """
+    type = models.CharField(max_length = 200, choices=GEOMETRY_CHOICES)
+    name = models.CharField(max_length = 200)
+    code = models.CharField(max_length = 200)
+    parentcodes = models.CharField(max_length = 400, blank=True)
+    xmin = models.FloatField(default = 0)
+    ymin = models.FloatField(default = 0)
+    xmax = models.FloatField(default = 0)
+    ymax = models.FloatField(default = 0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['type',]),
+            models.Index(fields=['code',]),
+        ]
+
+    def __str__(self):
+        return self.name + " (" + self.code + ")"
+
+class AreaAdmin(OSMGeoAdmin):
+    """
+    Admin class for managing areas through admin interface
+    """
+    list_display = ['name', 'type', 'code', 'parentcodes']
+    list_filter = ['type']
+
+    search_fields = (
+        'name',
+        '^code'
+    )
+
+class GeometryStaging(models.Model):
+    """
+    Stores newly generated geometries before they are swapped into Geometry table
+    Allows geometry generation to be interrupted and resumed without live site seeing partial dataset
+    """
+    sourcefile = models.CharField(max_length = 200)
+    type = models.CharField(max_length = 200, choices=GEOMETRY_CHOICES)
+    name = models.CharField(max_length = 200)
+    code = models.CharField(max_length = 200)
+    zoom = models.IntegerField(default = 0)
+    geometry = models.GeometryField(null=True, blank=True)
+    hash = models.CharField(max_length = 64)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sourcefile',]),
+        ]
+
+class GeometrySource(models.Model):
+    """
+    Stores fingerprints of boundary source files and their individual features
+    Used to regenerate only those geometries whose source has changed
+    Fingerprint of whole file is stored with blank code
+    """
+    sourcefile = models.CharField(max_length = 200)
+    type = models.CharField(max_length = 200, choices=GEOMETRY_CHOICES)
+    code = models.CharField(max_length = 200, blank=True)
+    hash = models.CharField(max_length = 64)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sourcefile',]),
+        ]
+
+class GeometryCheckpoint(models.Model):
+    """
+    Records zoom levels already staged for particular version of source file
+    Used to resume interrupted geometry generation
+    """
+    sourcefile = models.CharField(max_length = 200)
+    hash = models.CharField(max_length = 64)
+    zoom = models.IntegerField(default = 0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sourcefile',]),
+        ]
+
 class Data(models.Model):
     """
     Stores geometry-related emissions data
@@ -130,13 +276,123 @@ class Data(models.Model):
     def __str__(self):
         return str(self.geometrytype) + ": " + self.geometrycode
 
-class DataAdmin(OSMGeoAdmin):
+class DataAdmin(FastAdmin, OSMGeoAdmin):
     """
     Admin class for managing data objects through admin interface
+    Year is chosen with filter rather than search, so search only uses index of geometry codes
     """
     list_display = ['geometrytype', 'geometrycode', 'type', 'year', 'value', 'meters']
+    list_filter = ['geometrytype', 'type', YearListFilter]
+    readonly_fields = ['preview']
+
+    search_fields = (
+        '^geometrycode',
+    )
+
+    def preview(self, data):
+        return getpreview(Geometry.objects.filter(type=data.geometrytype, code=data.geometrycode))
+
+# Fields searched in admin, given trigram indexes by createsearchindexes
+SEARCH_INDEXES = {
+    Geometry: ['name', 'code'],
+    Area: ['name', 'code'],
+    Data: ['geometrycode'],
+}
+
+@receiver(post_migrate)
+def create_search_indexes(sender, using, **kwargs):
+    """
+    After backend migrations, create trigram indexes used by admin search
+    Indexes are on UPPER(field) expression, which Django 3.1 model indexes cannot express
+    """
+    if sender.name != 'backend': return
+    createsearchindexes(connections[using], SEARCH_INDEXES)
+
+@receiver(post_migrate)
+def check_geometry_shapes(sender, using, **kwargs):
+    """
+    After backend migrations, warn if geometries have no shapes, eg. after upgrading from version storing geometries in Geometry table
+    Migrating drops old geometries, so map is empty until generategeometries regenerates them
+    """
+    if sender.name != 'backend': return
+    if Geometry.objects.using(using).filter(shape__isnull=True).exists():
+        print("Geometries have no shapes and will not be shown on map - run 'tools.py generategeometries' to regenerate them")
+
+class Forecast(models.Model):
+    """
+    Stores precomputed energy use of all areas as compressed NumPy arrays, from which forecasts are calculated
+    Only the most recent forecast is kept
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField()
+
+class Ranking(models.Model):
+    """
+    Stores recorded energy use and meters of all areas of one geometry type as compressed NumPy arrays,
+    with areas sorted by energy use and by energy use per meter for each fuel and year
+    Only the most recent ranking of each geometry type is kept
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    geometrytype = models.CharField(max_length = 200, choices=GEOMETRY_CHOICES)
+    data = models.BinaryField()
+
+class ConversionFactor(models.Model):
+    """
+    Stores GHG conversion factors (kg CO2e per kWh) for each fuel and year
+    Each version is complete set of factors for all fuels and years, most recently imported version is used
+    """
+    version = models.CharField(max_length = 100)
+    fuel = models.CharField(max_length = 100)
+    year = models.IntegerField()
+    value = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['version',]),
+        ]
+
+    def __str__(self):
+        return self.version + ": " + self.fuel + " " + str(self.year)
+
+class ConversionFactorAdmin(OSMGeoAdmin):
+    """
+    Admin class for managing conversion factors through admin interface
+    """
+    list_display = ['version', 'fuel', 'year', 'value']
 
     search_fields = (
-        'year',
-        'geometrycode'
+        'version',
+        'fuel'
     )
+
+class Profile(models.Model):
+    """
+    Stores sampling profile of single request, as folded stacks for flamegraph tools and timings of SQL queries
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    method = models.CharField(max_length = 10)
+    path = models.CharField(max_length = 200)
+    reason = models.CharField(max_length = 20)
+    duration = models.FloatField()
+    querytime = models.FloatField()
+    samples = models.IntegerField()
+    stacks = models.TextField()
+    queries = models.TextField()
+
+    def __str__(self):
+        return self.method + " " + self.path + " " + str(self.created)
+
+class ProfileAdmin(admin.ModelAdmin):
+    """
+    Admin class for viewing request profiles through admin interface
+    """
+    list_display = ['created', 'method', 'path', 'reason', 'duration', 'querytime', 'samples', 'downloads']
+    exclude = ['stacks', 'queries']
+    readonly_fields = ['created', 'method', 'path', 'reason', 'duration', 'querytime', 'samples', 'downloads']
+
+    search_fields = (
+        'path',
+    )
+
+    def downloads(self, profile):
+        return format_html('<a href="{}">stacks</a> <a href="{}">queries</a>', reverse('profilestacks', args=[profile.id]), reverse('profilequeries', args=[profile.id]))
@@ -0,0 +1,193 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/pipeline.py
+Runs full import as stages with dependencies, running independent stages in parallel
+
+Locations, geometries of each area type and data of each area type and year are imported by separate
+stages running in parallel worker processes. Stages that depend on others, such as special cases,
+area parents, forecasts and rankings, start once their dependencies have completed. Status, timing
+and row count of each stage are recorded in state file after each stage, so interrupted or failed
+pipeline can be resumed, rerunning only stages that did not complete.
+"""
+
+import os
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+from django.db import connections
+
+from backend import tools
+from backend.models import Location, Geometry, Area, Data, Ranking, GEOMETRY_CHOICES
+
+# Default state file recording progress of pipeline, relative to 'app' folder
+statefile = 'pipeline.json'
+
+class Stage:
+    """
+    Single stage of pipeline, with function that runs stage and returns number of rows it produced
+    """
+
+    def __init__(self, function, dependencies=()):
+        self.function = function
+        self.dependencies = list(dependencies)
+
+def importgeometries(areatype):
+    """
+    Generate geometries for all boundary files of area type, excluding Scottish LAU1s replaced in special cases
+    """
+
+    codefilter = tools.is_not_scottish_code if areatype == 'lau1' else None
+    for areafile in tools.subregions[areatype]:
+        tools.generategeometriesforfile(areafile, areatype, codefilter=codefilter)
+    return Geometry.objects.filter(type=areatype).count()
+
+def importspecialcases():
+    tools.processspecialcases()
+    return Geometry.objects.filter(type='lau1', code__startswith='S').count()
+
+def importareaparents():
+    tools.updateareaparents()
+    return Area.objects.count()
+
+def importlocations():
+    tools.importlocations()
+    return Location.objects.count()
+
+def importyear(geometrytype, year):
+    """
+    Import data of all fuels for area type and year
+    """
+
+    for datatype, description in tools.DATATYPES_CHOICES:
+        tools.importdatabygeometrytype(geometrytype, year, datatype)
+    return Data.objects.filter(geometrytype=geometrytype, year=str(year)).count()
+
+def computeforecasts():
+    from backend.carbonmodel import computeforecasts
+    return len(computeforecasts().codes)
+
+def computerankings():
+    from backend.rankings import computerankings
+    computerankings()
+    return Ranking.objects.count()
+
+def writesnapshots():
+    tools.precompressstatic()
+    return len(os.listdir(os.path.join(settings.STATIC_ROOT, tools.precompress.snapshotfolder)))
+
+def getstages(yearstart, yearend):
+    """
+    Get dictionary of stage name to stage for import of data for year range
+    """
+
+    areatypes = [areatype for areatype, description in GEOMETRY_CHOICES]
+    years = range(int(yearstart), 1 + int(yearend))
+    datastages = ['data-' + areatype + '-' + str(year) for areatype in areatypes for year in years]
+
+    stages = {'locations': Stage(importlocations)}
+    for areatype in areatypes:
+        stages['geometries-' + areatype] = Stage(lambda areatype=areatype: importgeometries(areatype))
+    stages['specialcases'] = Stage(importspecialcases, ['geometries-lau1'])
+    stages['areaparents'] = Stage(importareaparents, ['geometries-' + areatype for areatype in areatypes] + ['specialcases'])
+    stages['snapshots'] = Stage(writesnapshots, ['areaparents'])
+    for areatype in areatypes:
+        for year in years:
+            stages['data-' + areatype + '-' + str(year)] = Stage(lambda areatype=areatype, year=year: importyear(areatype, year))
+    stages['forecasts'] = Stage(computeforecasts, datastages)
+    stages['rankings'] = Stage(computerankings, datastages)
+
+    return stages
+
+def runstage(name, yearstart, yearend):
+    """
+    Run single stage within worker process, returning duration and number of rows produced
+    """
+
+    start = time.time()
+    rows = getstages(yearstart, yearend)[name].function()
+    return {'duration': time.time() - start, 'rows': rows}
+
+def loadstate(filepath):
+    with open(filepath) as f:
+        return json.load(f)
+
+def savestate(filepath, state):
+    temporarypath = filepath + '.tmp'
+    with open(temporarypath, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(temporarypath, filepath)
+
+def printstate(state):
+    """
+    Print status, timing and row count of each stage
+    """
+
+    for name, stage in state['stages'].items():
+        duration = "{:9.1f}s".format(stage['duration']) if 'duration' in stage else ' ' * 10
+        rows = str(stage['rows']).rjust(10) if 'rows' in stage else ' ' * 10
+        print(name.ljust(24), stage['status'].ljust(10), duration, rows, stage.get('error', ''))
+
+def runpipeline(yearstart=None, yearend=None, filepath=statefile, resume=False, processes=None):
+    """
+    Run all stages of pipeline, running each stage once its dependencies have completed
+
+    If resume set, year range is read from state file and stages that completed in previous run are skipped
+    Returns number of stages that failed or could not run as dependencies failed
+    """
+
+    if resume:
+        if not os.path.isfile(filepath):
+            print("No pipeline to resume, state file not found:", filepath)
+            return 1
+        state = loadstate(filepath)
+        yearstart, yearend = state['yearstart'], state['yearend']
+    else:
+        state = {'yearstart': int(yearstart), 'yearend': int(yearend), 'stages': {}}
+
+    stages = getstages(yearstart, yearend)
+    for name in stages:
+        if state['stages'].get(name, {}).get('status') != 'completed': state['stages'][name] = {'status': 'waiting'}
+    completed = set([name for name in stages if state['stages'][name]['status'] == 'completed'])
+    if len(completed) > 0: print("Resuming pipeline, stages already completed:", ', '.join(sorted(completed)))
+
+    # Worker processes must open their own database connections
+    connections.close_all()
+    running, failed = {}, set()
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+        while True:
+            for name, stage in stages.items():
+                if (name in completed) or (name in failed) or (name in running.values()): continue
+                if any([dependency in failed for dependency in stage.dependencies]):
+                    failed.add(name)
+                    state['stages'][name] = {'status': 'skipped', 'error': 'dependency failed'}
+                elif all([dependency in completed for dependency in stage.dependencies]):
+                    print("Starting stage", name)
+                    running[executor.submit(runstage, name, yearstart, yearend)] = name
+                    state['stages'][name] = {'status': 'running', 'started': time.time()}
+            savestate(filepath, state)
+            if len(running) == 0: break
+
+            finished, pending = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failed.add(name)
+                    state['stages'][name].update({'status': 'failed', 'error': repr(error)})
+                    print("Stage", name, "failed:", repr(error))
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    continue
+                completed.add(name)
+                state['stages'][name].update({'status': 'completed', 'finished': time.time(), 'duration': result['duration'], 'rows': result['rows']})
+                print("Completed stage", name, "in", "{:.1f}s".format(result['duration']), "rows", result['rows'])
+
+    printstate(state)
+    return len(failed)
@@ -0,0 +1,109 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/precompress.py
+Build step that writes snapshots of hottest API responses and precompresses static files
+
+Snapshots of national-zoom LAU1 geometries are written as static JSON files, skipping zoom levels
+without geometries so frontend falls back to API rather than showing empty map. Every compressible
+static file then has gzip variant written alongside it so nginx can serve it directly using
+gzip_static without compressing on each request or involving Django.
+"""
+
+import gzip
+import json
+import os
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.gis.db.models.functions import AsGeoJSON
+
+from .models import Geometry
+
+# Folder within static folder that snapshots are written to
+snapshotfolder = 'snapshots'
+
+# Snapshots of LAU1 geometries are written for zoom levels below this, matching ZOOM_SHOWLEVEL_2 of frontend
+snapshotzoomlimit = 8
+
+# Extensions of files worth compressing
+compressibleextensions = ('.js', '.css', '.html', '.json', '.svg', '.map', '.txt', '.ico', '.xml')
+
+# Files smaller than this many bytes are not compressed
+minimumsize = 256
+
+def writefile(filepath, content):
+    """
+    Write file atomically so web server never serves partially written file
+    """
+
+    temporarypath = filepath + '.tmp'
+    with open(temporarypath, 'wb') as f:
+        f.write(content)
+    os.replace(temporarypath, filepath)
+
+def writesnapshots(staticfolder):
+    """
+    Write snapshots of national-zoom LAU1 geometries to static folder
+    Geometry snapshots use same format as /geometries/ response but contain every geometry
+    Zoom levels without geometries get no snapshot and any other files in snapshot folder are removed
+
+    Returns list of snapshot files written
+    """
+
+    folder = os.path.join(staticfolder, snapshotfolder)
+    os.makedirs(folder, exist_ok=True)
+    written = []
+
+    for zoom in range(0, snapshotzoomlimit):
+        allfeatures = list(Geometry.objects.filter(zoom=zoom, type='lau1').annotate(json=AsGeoJSON('shape__geometry')).values('name', 'code', 'type', 'json'))
+        if len(allfeatures) == 0: continue
+        filepath = os.path.join(folder, 'geometries-lau1-' + str(zoom) + '.json')
+        writefile(filepath, json.dumps(allfeatures, cls=DjangoJSONEncoder).encode())
+        written.append(filepath)
+
+    # Remove snapshots of zoom levels that no longer have geometries and files of earlier versions, with their compressed variants
+    for filename in os.listdir(folder):
+        filepath = os.path.join(folder, filename)
+        if (filepath not in written) and (filepath[:-len('.gz')] not in written): os.remove(filepath)
+
+    return written
+
+def compressfile(filepath):
+    """
+    Write gzip variant of file unless it is already up to date
+
+    Returns number of variants written
+    """
+
+    variantpath = filepath + '.gz'
+    sourcetime = os.path.getmtime(filepath)
+    if os.path.exists(variantpath) and (os.path.getmtime(variantpath) >= sourcetime): return 0
+
+    with open(filepath, 'rb') as f:
+        content = f.read()
+
+    writefile(variantpath, gzip.compress(content, compresslevel=9, mtime=0))
+    # Match modification time so web server sends same Last-Modified header for both variants
+    os.utime(variantpath, (sourcetime, sourcetime))
+
+    return 1
+
+def compressfolder(staticfolder):
+    """
+    Write compressed variants of all compressible files within static folder
+
+    Returns number of files checked and number of variants written
+    """
+
+    checked, written = 0, 0
+    for folder, subfolders, filenames in os.walk(staticfolder):
+        for filename in filenames:
+            filepath = os.path.join(folder, filename)
+            if not filename.lower().endswith(compressibleextensions): continue
+            if os.path.getsize(filepath) < minimumsize: continue
+            checked += 1
+            written += compressfile(filepath)
+
+    return checked, written
@@ -0,0 +1,191 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/profiling.py
+On-demand sampling profiler for production requests
+
+Request is profiled if it has valid signed 'X-Profile-Token' header (see 'tools.py profiletoken'),
+if it is made by staff user who has enabled profiling at /profiles/?enable=1, or if it is picked
+by 1-in-N sampling set by PROFILE_SAMPLE_RATE. Stack of request thread is sampled at fixed interval
+by background thread and timing of every SQL query recorded, and both are saved to Profile table.
+Stacks are saved in folded format used by flamegraph.pl and speedscope.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+
+from .models import Profile
+
+# Seconds between stack samples
+sampleinterval = 0.005
+
+# Number of most recent profiles kept
+maxprofiles = 200
+
+# Maximum length of SQL text saved for each query
+maxsqllength = 2000
+
+# Request header containing signed profiling token
+tokenheader = 'HTTP_X_PROFILE_TOKEN'
+
+# Salt used to sign profiling tokens, so no other signed value is accepted as token
+tokensalt = 'backend.profiling'
+
+# Path of profile list and downloads
+profilespath = '/profiles/'
+
+# Session key set for staff users who have enabled profiling of their requests
+sessionkey = 'profile'
+
+class Sampler(threading.Thread):
+    """
+    Background thread counting stacks of another thread at fixed interval
+    """
+
+    def __init__(self, threadid, interval=sampleinterval):
+        super().__init__(daemon=True)
+        self.threadid, self.interval = threadid, interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadid)
+            if frame is not None: self.stacks[getstack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class QueryRecorder:
+    """
+    Database execute wrapper recording duration of each SQL query
+    """
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'database': self.alias, 'sql': sql[:maxsqllength], 'duration': time.perf_counter() - start, 'many': many})
+
+def getframename(frame):
+    """
+    Get name of frame as function name with shortened source file name
+    """
+
+    filename = frame.f_code.co_filename
+    if filename.startswith(settings.BASE_DIR): filename = os.path.relpath(filename, settings.BASE_DIR)
+    else: filename = filename.rsplit('site-packages' + os.sep, 1)[-1]
+    return frame.f_code.co_name + ' (' + filename + ':' + str(frame.f_code.co_firstlineno) + ')'
+
+def getstack(frame):
+    """
+    Get stack of frame in folded format, outermost frame first and frames separated by ';'
+    """
+
+    names = []
+    while frame is not None:
+        names.append(getframename(frame).replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def createtoken(hours=24):
+    """
+    Create signed token enabling profiling of requests sending it in 'X-Profile-Token' header until it expires
+    """
+
+    return signing.Signer(salt=tokensalt).sign(str(int(time.time() + (hours * 3600))))
+
+def checktoken(token):
+    """
+    Whether profiling token is correctly signed and has not expired
+    """
+
+    try:
+        expiry = int(signing.Signer(salt=tokensalt).unsign(token))
+    except (signing.BadSignature, ValueError):
+        return False
+    return time.time() < expiry
+
+def getprofilereason(request):
+    """
+    Get reason request should be profiled, or None if it should not be profiled
+    """
+
+    # Downloading profiles is not profiled
+    if request.path.startswith(profilespath): return None
+    token = request.META.get(tokenheader)
+    if (token is not None) and checktoken(token): return 'token'
+    samplerate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+    if (samplerate > 0) and (random.randrange(samplerate) == 0): return 'sample'
+    # Only look up user of requests with session cookie, so anonymous requests never query sessions
+    if (settings.SESSION_COOKIE_NAME in request.COOKIES) and request.user.is_staff and request.session.get(sessionkey, False): return 'staff'
+    return None
+
+def saveprofile(request, reason, duration, stacks, queries):
+    """
+    Save profile of request and delete oldest profiles beyond maximum number kept
+    """
+
+    folded = '\n'.join([stack + ' ' + str(count) for stack, count in stacks.most_common()])
+    profile = Profile.objects.create(
+        method=request.method,
+        path=request.path[:200],
+        reason=reason,
+        duration=duration,
+        querytime=sum([query['duration'] for query in queries]),
+        samples=sum(stacks.values()),
+        stacks=folded,
+        queries=json.dumps(queries))
+
+    oldest = Profile.objects.order_by('-id').values_list('id', flat=True)[maxprofiles:maxprofiles + 1]
+    if len(oldest) > 0: Profile.objects.filter(id__lte=oldest[0]).delete()
+
+    return profile
+
+class ProfilingMiddleware:
+    """
+    Middleware profiling requests chosen by getprofilereason
+    Must come after AuthenticationMiddleware so staff users can be identified
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reason = getprofilereason(request)
+        if reason is None: return self.get_response(request)
+
+        recorders = [QueryRecorder(alias) for alias in connections]
+        sampler = Sampler(threading.get_ident())
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            with contextlib.ExitStack() as stack:
+                for recorder in recorders: stack.enter_context(connections[recorder.alias].execute_wrapper(recorder))
+                response = self.get_response(request)
+        finally:
+            sampler.stop()
+        duration = time.perf_counter() - start
+
+        queries = [query for recorder in recorders for query in recorder.queries]
+        profile = saveprofile(request, reason, duration, sampler.stacks, queries)
+        response['X-Profile-Id'] = str(profile.id)
+        return response
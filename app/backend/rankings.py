@@ -0,0 +1,221 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/rankings.py
+Precomputed rankings and percentiles of areas by recorded energy use and energy use per meter
+
+For each geometry type, recorded energy use and meters of all areas are held as NumPy arrays
+together with order of areas, largest first, for each fuel and year and for both total energy use
+and energy use per meter. Rankings are computed after data is imported and stored in Ranking table,
+from which each worker loads them once, so pages of top areas and rank of any area are served from
+sorted arrays without querying Data table. Emissions are ranked in same order as energy use
+as all areas share same conversion factor for each fuel and year.
+"""
+
+import io
+import time
+import numpy as np
+
+from .models import Data, Ranking, GEOMETRY_CHOICES
+from .areas import getareas
+from .carbonmodel import FUELS, getconversionfactors
+
+# Available ranking metrics
+# total: recorded energy use of area
+# permeter: recorded energy use of area divided by number of meters, only for areas with meters
+METRICS = ['total', 'permeter']
+
+# Seconds between checks for newer rankings
+rankingcheckinterval = 60
+
+_cache = {'stores': {}, 'ids': {}, 'checked': {}}
+
+class RankingStore:
+    """
+    Recorded energy use and meters of all areas of one geometry type with areas sorted by each metric
+
+    Energy use and meters are indexed [area, fuel, year], with NaN where area has no data
+    Orders are indexed [fuel, year, position] with area indexes largest first, padded with -1
+    """
+
+    def __init__(self, codes, years, consumption, meters, orders=None):
+        self.codes = np.asarray(codes)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.consumption = np.asarray(consumption, dtype=np.float64)
+        self.meters = np.asarray(meters, dtype=np.float64)
+        self.index = {code: position for position, code in enumerate(self.codes.tolist())}
+        self.orders = orders if orders is not None else {metric: self.sortareas(self.getvalues(metric)) for metric in METRICS}
+        self.counts = {metric: (self.orders[metric] >= 0).sum(axis=2) for metric in METRICS}
+
+    def getvalues(self, metric, fuel=slice(None), yearindex=slice(None)):
+        """
+        Get values of metric indexed [area, fuel, year], or [area] for single fuel and year, with NaN where area is not ranked
+        """
+
+        consumption, meters = self.consumption[:, fuel, yearindex], self.meters[:, fuel, yearindex]
+        if metric == 'total': return consumption
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(meters > 0, consumption / meters, np.nan)
+
+    @staticmethod
+    def sortareas(values):
+        """
+        Get indexes of areas with values for each fuel and year, largest value first, padded with -1
+        """
+
+        # NaN sorts last in ascending order, so negate values to put largest first and areas without values last
+        orders = np.argsort(-np.moveaxis(values, 0, 2), axis=2, kind='stable').astype(np.int32)
+        counts = (~np.isnan(values)).sum(axis=0)
+        orders[np.arange(orders.shape[2])[None, None, :] >= counts[:, :, None]] = -1
+        return orders
+
+    def tobytes(self):
+        output = io.BytesIO()
+        np.savez_compressed(output, codes=self.codes.astype(str), years=self.years, consumption=self.consumption, meters=self.meters,
+                            **{'order_' + metric: self.orders[metric] for metric in METRICS})
+        return output.getvalue()
+
+    @classmethod
+    def frombytes(cls, data):
+        arrays = np.load(io.BytesIO(data), allow_pickle=False)
+        orders = {metric: arrays['order_' + metric] for metric in METRICS}
+        return cls(arrays['codes'], arrays['years'], arrays['consumption'], arrays['meters'], orders)
+
+    def getranks(self, indexes, fuel, yearindex, metric):
+        """
+        Get rank (1 is largest) and percentile (100 is largest, 0 smallest) of areas for fuel, year and metric
+        Areas with equal values share same rank
+        """
+
+        values = self.getvalues(metric, fuel, yearindex)
+        count = self.counts[metric][fuel, yearindex]
+        sortedvalues = values[self.orders[metric][fuel, yearindex, :count]]
+        ranks = 1 + np.searchsorted(-sortedvalues, -values[indexes], side='left')
+        percentiles = np.round(100 * (count - ranks) / max(count - 1, 1), 1)
+        return ranks, percentiles
+
+    def describe(self, indexes, fuel, yearindex, metric):
+        """
+        Get ranking of areas for fuel, year and metric as list of dictionaries
+        """
+
+        areas = getareas()
+        ranks, percentiles = self.getranks(indexes, fuel, yearindex, metric)
+        factor = float(getconversionfactors(self.years[yearindex:yearindex + 1])[fuel, 0]) / 1000
+
+        results = []
+        for position, index in enumerate(np.asarray(indexes).tolist()):
+            code = str(self.codes[index])
+            consumption, meters = float(self.consumption[index, fuel, yearindex]), float(self.meters[index, fuel, yearindex])
+            permeter = (consumption / meters) if meters > 0 else None
+            results.append({
+                'code': code,
+                'name': areas[code]['name'] if code in areas else '',
+                'rank': int(ranks[position]),
+                'percentile': float(percentiles[position]),
+                'kwh': round(consumption, 2),
+                'meters': meters,
+                'kwhpermeter': round(permeter, 2) if permeter is not None else None,
+                'emissions': round(consumption * factor, 3),
+                'emissionspermeter': round(permeter * factor, 6) if permeter is not None else None,
+            })
+
+        return results
+
+def buildrankingstore(datarows):
+    """
+    Build ranking store from iterable of (geometrycode, type, year, value, meters) data rows
+    """
+
+    rows = list(datarows)
+    codes = sorted(set([row[0] for row in rows]))
+    index = {code: position for position, code in enumerate(codes)}
+    years = [int(row[2]) for row in rows]
+    firstyear, lastyear = (min(years), max(years)) if len(years) > 0 else (0, -1)
+
+    consumption = np.full((len(codes), len(FUELS), lastyear - firstyear + 1), np.nan)
+    meters = np.full(consumption.shape, np.nan)
+    for geometrycode, datatype, year, value, metercount in rows:
+        consumption[index[geometrycode], datatype, int(year) - firstyear] = float(value)
+        meters[index[geometrycode], datatype, int(year) - firstyear] = float(metercount)
+
+    return RankingStore(codes, np.arange(firstyear, lastyear + 1), consumption, meters)
+
+def computerankings(geometrytypes=None):
+    """
+    Precompute rankings of all areas of each geometry type, or particular geometry types, and store them in database
+    """
+
+    if geometrytypes is None: geometrytypes = [geometrytype for geometrytype, description in GEOMETRY_CHOICES]
+
+    for geometrytype in geometrytypes:
+        data = Data.objects.filter(geometrytype=geometrytype).values_list('geometrycode', 'type', 'year', 'value', 'meters')
+        store = buildrankingstore(data.iterator())
+        ranking = Ranking.objects.create(geometrytype=geometrytype, data=store.tobytes())
+        Ranking.objects.filter(geometrytype=geometrytype).exclude(id=ranking.id).delete()
+        _cache['stores'][geometrytype], _cache['ids'][geometrytype], _cache['checked'][geometrytype] = store, ranking.id, time.time()
+
+def getrankingstore(geometrytype):
+    """
+    Get latest ranking store of geometry type, checking for newer rankings periodically
+    Returns None if rankings have not been computed
+    """
+
+    now = time.time()
+    if (now - _cache['checked'].get(geometrytype, 0)) > rankingcheckinterval:
+        _cache['checked'][geometrytype] = now
+        latestid = Ranking.objects.filter(geometrytype=geometrytype).order_by('-id').values_list('id', flat=True).first()
+        if latestid != _cache['ids'].get(geometrytype):
+            _cache['stores'][geometrytype] = None
+            if latestid is not None:
+                _cache['stores'][geometrytype] = RankingStore.frombytes(bytes(Ranking.objects.get(id=latestid).data))
+            _cache['ids'][geometrytype] = latestid
+
+    return _cache['stores'].get(geometrytype)
+
+def getyearindex(store, year):
+    """
+    Get index of year within store, or None if store has no data for year
+    """
+
+    year = int(year)
+    if (len(store.years) == 0) or (year < store.years[0]) or (year > store.years[-1]): return None
+    return year - int(store.years[0])
+
+def gettopareas(geometrytype, year, fuel, metric, offset=0, limit=100):
+    """
+    Get page of areas of geometry type ranked by metric for fuel and year, largest first
+
+    Returns dictionary with total 'count' of ranked areas and 'data' list of areas, or None if no rankings for year
+    """
+
+    store = getrankingstore(geometrytype)
+    if store is None: return None
+    yearindex = getyearindex(store, year)
+    if yearindex is None: return None
+
+    fuelindex = FUELS.index(fuel)
+    count = int(store.counts[metric][fuelindex, yearindex])
+    indexes = store.orders[metric][fuelindex, yearindex, offset:min(offset + limit, count)]
+    return {'count': count, 'offset': offset, 'data': store.describe(indexes, fuelindex, yearindex, metric)}
+
+def getarearanking(geometrytype, code, year, fuel, metric):
+    """
+    Get rank and percentile of single area among areas of geometry type by metric for fuel and year
+
+    Returns dictionary with total 'count' of ranked areas and 'data' for area, or None if area is not ranked
+    """
+
+    store = getrankingstore(geometrytype)
+    if (store is None) or (code not in store.index): return None
+    yearindex = getyearindex(store, year)
+    if yearindex is None: return None
+
+    fuelindex = FUELS.index(fuel)
+    index = store.index[code]
+    if np.isnan(store.getvalues(metric, fuelindex, yearindex)[index]): return None
+    count = int(store.counts[metric][fuelindex, yearindex])
+    return {'count': count, 'data': store.describe([index], fuelindex, yearindex, metric)[0]}
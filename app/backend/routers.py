@@ -0,0 +1,144 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/routers.py
+Database router sending reads of read-only API views to replicas
+
+Replicas are configured with SQL_REPLICA_HOSTS, see carbonmap/settings.py. Reads of backend models
+are sent to replica only within views decorated with readreplica, so tools.py and all writes always
+use primary. Replication lag of each replica is checked periodically by each worker and replicas
+that lag by more than SQL_REPLICA_MAXLAG seconds or cannot be reached are skipped, falling back
+to primary if no replica is usable.
+"""
+
+import contextvars
+import functools
+import random
+import time
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+# Seconds between checks of replication lag of each replica
+lagcheckinterval = 10
+
+# Seconds an unreachable replica is skipped before it is checked again
+failureinterval = 30
+
+# Alias of database chosen for reads of current request, or None outside readreplica views
+_readdatabase = contextvars.ContextVar('readdatabase', default=None)
+
+_cache = {}
+
+def getreplicas():
+    """
+    Get aliases of configured replica databases
+    """
+
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+def getreplicalag(alias):
+    """
+    Get replication lag of replica in seconds, which is zero if replica is up to date or is not a replica
+    """
+
+    connection = connections[alias]
+    if connection.vendor != 'postgresql': return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+        SELECT pg_is_in_recovery(),
+            CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+        """)
+        inrecovery, lag = cursor.fetchone()
+
+    if (not inrecovery) or (lag is None): return 0
+    return float(lag)
+
+def isreplicausable(alias):
+    """
+    Whether replica is reachable and within maximum lag, checking at most once every lagcheckinterval seconds
+    """
+
+    now = time.time()
+    state = _cache.get(alias)
+    if (state is not None) and (now < state['nextcheck']): return state['usable']
+
+    try:
+        usable = getreplicalag(alias) <= settings.SQL_REPLICA_MAXLAG
+        nextcheck = now + lagcheckinterval
+    except DatabaseError:
+        # Discard broken connection so next check reconnects
+        connections[alias].close()
+        usable = False
+        nextcheck = now + failureinterval
+
+    _cache[alias] = {'usable': usable, 'nextcheck': nextcheck}
+    return usable
+
+def getreaddatabase():
+    """
+    Get alias of usable replica chosen at random, or primary if no replica is usable
+    """
+
+    replicas = [alias for alias in getreplicas() if isreplicausable(alias)]
+    if len(replicas) == 0: return 'default'
+    return random.choice(replicas)
+
+def readreplica(view):
+    """
+    Decorator for read-only views, sending reads of backend models made by view to replica
+    Single database is chosen for each request so all its reads are consistent
+    Streaming responses read from same database while they are streamed too
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if len(getreplicas()) == 0: return view(request, *args, **kwargs)
+        database = getreaddatabase()
+        token = _readdatabase.set(database)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _readdatabase.reset(token)
+        if response.streaming: response.streaming_content = streamfromdatabase(response.streaming_content, database)
+        return response
+
+    return wrapper
+
+def streamfromdatabase(content, database):
+    """
+    Stream content, sending reads of backend models made while producing each part to database
+    """
+
+    iterator = iter(content)
+    while True:
+        token = _readdatabase.set(database)
+        try:
+            part = next(iterator, None)
+        finally:
+            _readdatabase.reset(token)
+        if part is None: return
+        yield part
+
+class ReplicaRouter:
+    """
+    Sends reads of backend models within readreplica views to replica, and everything else to primary
+    """
+
+    def db_for_read(self, model, **hints):
+        database = _readdatabase.get()
+        if (model._meta.app_label != 'backend') or (database is None): return 'default'
+        return database
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -0,0 +1,265 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/simplify.py
+Simplification of boundary geometries for each zoom level using shapely/GEOS
+
+All features of a boundary file are split into arcs at junctions between neighbouring areas and
+each arc is simplified once, so shared boundaries between neighbouring areas are simplified
+identically. Every feature is guaranteed an output geometry, and tolerance is increased a limited
+number of times to keep vertex count of each map tile within budget. Zoom levels still over budget
+after that are reported in their statistics rather than simplified further.
+
+Geometries are simplified in Web Mercator coordinates, where map pixels are the same size
+at every latitude, so tolerance of one pixel is correct everywhere rather than only at
+the UK's northernmost latitude.
+"""
+
+import json
+import math
+import numpy as np
+import shapely
+
+# Version of simplification and geometry storage, included in source fingerprints so changes regenerate geometries
+SIMPLIFICATIONVERSION = 4
+
+# Half circumference of Web Mercator world in meters
+MERCATORHALFWORLD = 20037508.342789244
+
+# Maximum number of vertices allowed within single 256 x 256 pixel map tile
+tilevertexbudget = 20000
+
+# Factor tolerance is increased by when tile vertex budget is exceeded
+tolerancestep = 1.5
+
+# Maximum number of times tolerance is increased for zoom level
+maxtoleranceincreases = 8
+
+def loadgeometries(features):
+    """
+    Load GeoJSON features into array of valid shapely geometries
+    """
+
+    geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features])
+    invalid = ~shapely.is_valid(geometries)
+    if invalid.any(): geometries[invalid] = [getpolygonal(geometry) for geometry in shapely.make_valid(geometries[invalid])]
+    return geometries
+
+def getpolygonal(geometry):
+    """
+    Get polygonal parts of geometry, as repairing invalid polygons can also produce lines and points
+    """
+
+    if geometry.geom_type in ('Polygon', 'MultiPolygon'): return geometry
+    parts = [part for part in shapely.get_parts(geometry) if part.geom_type in ('Polygon', 'MultiPolygon')]
+    if len(parts) == 0: return shapely.Polygon()
+    return shapely.union_all(parts)
+
+def tomercator(geometries):
+    """
+    Project array of WGS84 geometries into Web Mercator (meters)
+    """
+
+    def project(coordinates):
+        x = np.radians(coordinates[:, 0]) * (MERCATORHALFWORLD / math.pi)
+        y = np.log(np.tan((math.pi / 4) + (np.radians(np.clip(coordinates[:, 1], -85.0511, 85.0511)) / 2))) * (MERCATORHALFWORLD / math.pi)
+        return np.stack([x, y], axis=1)
+
+    return shapely.transform(geometries, project)
+
+def frommercator(geometries):
+    """
+    Unproject array of Web Mercator geometries into WGS84
+    """
+
+    def unproject(coordinates):
+        lng = np.degrees(coordinates[:, 0] * (math.pi / MERCATORHALFWORLD))
+        lat = np.degrees((2 * np.arctan(np.exp(coordinates[:, 1] * (math.pi / MERCATORHALFWORLD)))) - (math.pi / 2))
+        return np.stack([lng, lat], axis=1)
+
+    return shapely.transform(geometries, unproject)
+
+class Topology:
+    """
+    Rings of array of polygonal geometries split into arcs at junctions, where boundaries of neighbouring geometries meet or part
+
+    Boundary shared by neighbouring geometries becomes single arc referenced by both, so simplifying each arc once
+    simplifies shared boundaries identically. Neighbouring geometries must share identical vertices along shared boundaries.
+    Each ring is list of (arc, reversed) pairs, rings are indexed by polygon and polygons by geometry
+    """
+
+    def __init__(self, geometries):
+        self.geometries = geometries
+        polygons, self.polygongeometry = shapely.get_parts(geometries, return_index=True)
+        rings, self.ringpolygon = shapely.get_rings(polygons, return_index=True)
+        # First ring of each polygon is its exterior
+        self.isexterior = np.ones(len(rings), dtype=bool)
+        self.isexterior[1:] = self.ringpolygon[1:] != self.ringpolygon[:-1]
+
+        coordinates, ringindex = shapely.get_coordinates(rings, return_index=True)
+        ringsizes = np.bincount(ringindex, minlength=len(rings))
+        # Drop closing coordinate of each ring, which repeats its first
+        keep = np.ones(len(coordinates), dtype=bool)
+        keep[np.cumsum(ringsizes)[ringsizes > 0] - 1] = False
+        coordinates, ringindex, ringsizes = coordinates[keep], ringindex[keep], np.maximum(ringsizes - 1, 0)
+        ringstarts = np.concatenate([[0], np.cumsum(ringsizes)[:-1]]).astype(np.int64)
+
+        self.vertices, vertexids = np.unique(coordinates, axis=0, return_inverse=True)
+        vertexids = vertexids.reshape(-1)
+        self.arcs, self.rings = [], []
+        if len(vertexids) == 0: return
+
+        # Vertex is junction if it has more than two distinct neighbours across all rings
+        position = np.arange(len(vertexids))
+        following = np.where(position + 1 < ringstarts[ringindex] + ringsizes[ringindex], position + 1, ringstarts[ringindex])
+        neighbours = np.concatenate([np.stack([vertexids, vertexids[following]], axis=1), np.stack([vertexids[following], vertexids], axis=1)])
+        neighbours = np.unique(neighbours, axis=0)
+        isjunction = np.bincount(neighbours[:, 0], minlength=len(self.vertices)) > 2
+
+        arcindex = {}
+        for ring in range(len(rings)):
+            ids = vertexids[ringstarts[ring]:ringstarts[ring] + ringsizes[ring]]
+            junctions = np.nonzero(isjunction[ids])[0]
+            # Ring without junctions is single closed arc starting at its smallest vertex, so rings sharing it split it identically
+            ids = np.roll(ids, -(junctions[0] if len(junctions) > 0 else int(np.argmin(ids))))
+            splits = (junctions - junctions[0]).tolist() if len(junctions) > 0 else [0]
+            ids = np.append(ids, ids[0]).tolist()
+
+            ringarcs = []
+            for first, last in zip(splits, splits[1:] + [len(ids) - 1]):
+                arc = tuple(ids[first:last + 1])
+                reverse = arc[::-1] < arc
+                key = arc[::-1] if reverse else arc
+                if key not in arcindex:
+                    arcindex[key] = len(self.arcs)
+                    self.arcs.append(np.array(key, dtype=np.int64))
+                ringarcs.append((arcindex[key], reverse))
+            self.rings.append(ringarcs)
+
+    def simplify(self, tolerance):
+        """
+        Simplify all arcs once with tolerance and rebuild geometries from them
+
+        Rings that collapse are dropped, along with their polygon if ring is exterior, so geometries may be empty
+        """
+
+        output = np.array([shapely.Polygon()] * len(self.geometries), dtype=object)
+        if len(self.arcs) == 0: return output
+
+        arclines = shapely.linestrings(self.vertices[np.concatenate(self.arcs)], indices=np.repeat(np.arange(len(self.arcs)), [len(arc) for arc in self.arcs]))
+        arccoordinates = [shapely.get_coordinates(line) for line in shapely.simplify(arclines, tolerance, preserve_topology=True)]
+
+        candidates, droppedpolygons = [], set()
+        for ring, ringarcs in enumerate(self.rings):
+            # Consecutive arcs share junction vertex, so first vertex of each arc is dropped and ring closed with its last
+            coordinates = np.concatenate([(arccoordinates[arc][::-1] if reverse else arccoordinates[arc])[1:] for arc, reverse in ringarcs])
+            if len(coordinates) < 3:
+                if self.isexterior[ring]: droppedpolygons.add(int(self.ringpolygon[ring]))
+                continue
+            candidates.append((ring, np.concatenate([coordinates[-1:], coordinates])))
+
+        kept = [(ring, coordinates) for ring, coordinates in candidates if int(self.ringpolygon[ring]) not in droppedpolygons]
+        if len(kept) == 0: return output
+
+        rings = shapely.linearrings(np.concatenate([coordinates for ring, coordinates in kept]), indices=np.repeat(np.arange(len(kept)), [len(coordinates) for ring, coordinates in kept]))
+        polygonids, ringpolygon = np.unique(self.ringpolygon[[ring for ring, coordinates in kept]], return_inverse=True)
+        polygons = shapely.polygons(rings, indices=ringpolygon.reshape(-1))
+        polygongeometry = self.polygongeometry[polygonids]
+        shapely.multipolygons(polygons, indices=polygongeometry, out=output)
+
+        # Geometries with single polygon are kept as polygons
+        single = np.bincount(polygongeometry, minlength=len(output)) == 1
+        output[single] = shapely.get_geometry(output[single], 0)
+        return output
+
+def ensureallfeatures(geometries, simplified, tolerance):
+    """
+    Ensure every feature has valid non-empty simplified geometry
+
+    Features that simplification collapsed or made invalid are simplified separately and, failing that, kept unsimplified
+    Returns geometries and number of features that needed fallback
+    """
+
+    failed = shapely.is_empty(simplified) | ~shapely.is_valid(simplified)
+    if not failed.any(): return simplified, 0
+
+    simplified = simplified.copy()
+    fallback = shapely.simplify(geometries[failed], tolerance, preserve_topology=True)
+    stillfailed = shapely.is_empty(fallback) | ~shapely.is_valid(fallback)
+    fallback[stillfailed] = geometries[failed][stillfailed]
+    simplified[failed] = fallback
+
+    return simplified, int(failed.sum())
+
+def gettilevertexcounts(geometries, zoom):
+    """
+    Get number of vertices within each map tile at zoom level for Web Mercator geometries
+    """
+
+    coordinates = shapely.get_coordinates(geometries)
+    if len(coordinates) == 0: return np.zeros(0, dtype=np.int64)
+
+    numtiles = 2 ** zoom
+    tilex = np.floor((coordinates[:, 0] + MERCATORHALFWORLD) / (2 * MERCATORHALFWORLD) * numtiles).astype(np.int64)
+    tiley = np.floor((MERCATORHALFWORLD - coordinates[:, 1]) / (2 * MERCATORHALFWORLD) * numtiles).astype(np.int64)
+    tilex, tiley = np.clip(tilex, 0, numtiles - 1), np.clip(tiley, 0, numtiles - 1)
+
+    return np.unique((tiley * numtiles) + tilex, return_counts=True)[1]
+
+def getmaxtilevertices(geometries, zoom):
+    """
+    Get largest number of vertices within any single map tile at zoom level
+    """
+
+    tilecounts = gettilevertexcounts(geometries, zoom)
+    if len(tilecounts) == 0: return 0
+    return int(tilecounts.max())
+
+def simplifyforzoom(topology, tolerance, zoom):
+    """
+    Simplify topology of Web Mercator geometries for zoom level with tolerance in meters, see get_mercator_meters_per_pixel
+    Tolerance is increased until no map tile exceeds vertex budget, at most maxtoleranceincreases times, so budget
+    may still be exceeded, eg. where features kept unsimplified by ensureallfeatures are dense, and 'over_budget' is then True
+
+    Returns simplified Web Mercator geometries and statistics for zoom level
+    """
+
+    geometries = topology.geometries
+    basetolerance = tolerance
+    for increase in range(maxtoleranceincreases + 1):
+        simplified = topology.simplify(tolerance)
+        if getmaxtilevertices(simplified, zoom) <= tilevertexbudget: break
+        if increase < maxtoleranceincreases: tolerance *= tolerancestep
+
+    simplified, fallbacks = ensureallfeatures(geometries, simplified, tolerance)
+
+    stats = {
+        'zoom': zoom,
+        'features': len(geometries),
+        'tolerance': tolerance,
+        'tolerance_increase': tolerance / basetolerance,
+        'vertices_original': int(shapely.get_num_coordinates(geometries).sum()),
+        'vertices': int(shapely.get_num_coordinates(simplified).sum()),
+        'max_tile_vertices': getmaxtilevertices(simplified, zoom),
+        'fallbacks': fallbacks,
+    }
+    stats['over_budget'] = stats['max_tile_vertices'] > tilevertexbudget
+
+    return simplified, stats
+
+def printstats(stats):
+    """
+    Print vertex count statistics for single zoom level
+    """
+
+    print(  "Zoom", str(stats['zoom']).rjust(2),
+            "features", stats['features'],
+            "vertices", stats['vertices_original'], "->", stats['vertices'],
+            "max per tile", stats['max_tile_vertices'],
+            "tolerance {:.2f}m".format(stats['tolerance']),
+            "(x{:.2f})".format(stats['tolerance_increase']) if stats['tolerance_increase'] > 1 else "",
+            "fallbacks", stats['fallbacks'],
+            "- over tile vertex budget of " + str(tilevertexbudget) if stats['over_budget'] else "")
@@ -1,3 +1,886 @@
-from django.test import TestCase
+"""
+Copyright (c) Open Carbon, 2020
 
-# Create your tests here.
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/tests.py
+Tests of backend modules and views
+
+Run with './manage.py test backend'
+"""
+
+import base64
+import contextlib
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import shapely
+from unittest import mock
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections
+from django.db.migrations.operations import AlterField
+from django.db.models import IntegerField
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import areas, coalesce, geocode, pipeline, profiling, routers, simplify, tools, validation, views
+from .carbonmodel import ForecastStore, regress, predictconsumption, calculateconsumption
+from .changes import encodearray
+from .factors import FactorTable
+from .models import Area, Data, Geometry, GeometryCheckpoint, GeometrySource, GeometryStaging, Location, Postcode, Profile, Shape, check_geometry_shapes, clear_text_locations
+from .precompress import compressfile
+from .rankings import RankingStore
+
+@contextlib.contextmanager
+def workingdirectory(folder):
+    previous = os.getcwd()
+    os.chdir(folder)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+class CarbonModelTests(SimpleTestCase):
+    """
+    Vectorised forecasts compared with per-area np.polyfit regression used before forecasts were precomputed
+    """
+
+    def setUp(self):
+        self.years = np.arange(2010, 2016)
+        self.consumption = np.array([
+            [[100, 110, 125, 130, 150, 155], [500, 480, 470, 450, 440, 400]],
+            [[200, np.nan, 180, 170, np.nan, np.nan], [np.nan] * 6],
+            [[50, 40, 30, 20, 10, 5], [1000, 1000, 1000, 1000, 1000, 1000]],
+        ], dtype=np.float64)
+        self.store = ForecastStore(['A', 'B', 'C'], ['lsoa'] * 3, self.years, self.consumption)
+
+    def getpolyfit(self, area, fuel):
+        recorded = ~np.isnan(self.consumption[area, fuel])
+        if not recorded.any(): return 0, 0
+        return np.polyfit(self.years[recorded], self.consumption[area, fuel][recorded], 1)
+
+    def test_regress_matches_polyfit(self):
+        coefficients = regress(self.years, np.nan_to_num(self.consumption), ~np.isnan(self.consumption))
+        for area in range(2):
+            for fuel in range(2):
+                slope, intercept = self.getpolyfit(area, fuel)
+                self.assertAlmostEqual(coefficients[area, fuel, 0], slope, places=6)
+                self.assertAlmostEqual(coefficients[area, fuel, 1], intercept, places=3)
+
+    def test_linear_prediction_matches_polyfit_clipped_at_zero(self):
+        years = np.array([2016, 2020, 2030])
+        predicted = predictconsumption(self.store, [0, 1, 2], years, 'linear')
+        for area in range(3):
+            for fuel in range(2):
+                slope, intercept = self.getpolyfit(area, fuel)
+                expected = np.maximum((slope * years) + intercept, 0)
+                np.testing.assert_allclose(predicted[area, fuel], expected, rtol=1e-6, atol=1e-6)
+
+    def test_cappeddecline_never_increases(self):
+        predicted = predictconsumption(self.store, [0, 1, 2], np.arange(2016, 2030), 'cappeddecline')
+        self.assertTrue((np.diff(predicted, axis=2) <= 1e-9).all())
+
+    def test_calculateconsumption_uses_recorded_then_predicted(self):
+        years = np.arange(2012, 2020)
+        consumption, isprediction = calculateconsumption(self.store, [0, 1], years)
+
+        # Recorded values up to last recorded year of each area, with zero where fuel has no data that year
+        np.testing.assert_array_equal(consumption[0, :, 0:4], self.consumption[0, :, 2:6])
+        np.testing.assert_array_equal(consumption[1, 0, 0:2], [180, 170])
+        np.testing.assert_array_equal(consumption[1, 1, 0:2], [0, 0])
+
+        # Area B last recorded 2013, so later years are predicted like years after area A's last recorded year
+        np.testing.assert_array_equal(isprediction[0], years > 2015)
+        np.testing.assert_array_equal(isprediction[1], years > 2013)
+        slope, intercept = self.getpolyfit(1, 0)
+        np.testing.assert_allclose(consumption[1, 0, 2:], np.maximum((slope * years[2:]) + intercept, 0), rtol=1e-6)
+
+    def test_store_roundtrip(self):
+        store = ForecastStore.frombytes(self.store.tobytes())
+        np.testing.assert_array_equal(store.codes, self.store.codes)
+        np.testing.assert_array_equal(store.consumption, self.store.consumption)
+        np.testing.assert_array_equal(store.linear, self.store.linear)
+
+class FactorTableTests(SimpleTestCase):
+
+    def setUp(self):
+        self.table = FactorTable('test', {'electricity': {2018: 0.3, 2020: 0.2}, 'gas': {2019: 0.18}})
+
+    def test_values_indexed_by_fuel_and_year(self):
+        self.assertEqual(self.table.fuels, ['electricity', 'gas'])
+        self.assertEqual(self.table.firstyear, 2018)
+        np.testing.assert_array_equal(self.table.values, [[0.3, np.nan, 0.2], [np.nan, 0.18, np.nan]])
+
+    def test_lookup(self):
+        factors = self.table.lookup(['gas', 'electricity', 'lpg'], [2017, 2018, 2019, 2020, 2021])
+        np.testing.assert_array_equal(factors, [
+            [np.nan, np.nan, 0.18, np.nan, np.nan],
+            [np.nan, 0.3, np.nan, 0.2, np.nan],
+            [np.nan] * 5,
+        ])
+
+    def test_published(self):
+        years, values = self.table.published('electricity')
+        np.testing.assert_array_equal(years, [2018, 2020])
+        np.testing.assert_array_equal(values, [0.3, 0.2])
+        self.assertEqual(len(self.table.published('coal')[0]), 0)
+
+    def test_trajectory_is_cached(self):
+        calculate = mock.Mock(return_value=np.zeros((2, 2)))
+        self.table.trajectory(['electricity', 'gas'], [2030, 2031], 'linear', calculate)
+        self.table.trajectory(['electricity', 'gas'], np.array([2030, 2031]), 'linear', calculate)
+        self.table.trajectory(['electricity', 'gas'], [2030, 2031], 'constant', calculate)
+        self.assertEqual(calculate.call_count, 2)
+
+class SimplifyTests(SimpleTestCase):
+    """
+    Simplification of Web Mercator geometries in meters, with neighbouring areas sharing identical boundary vertices
+    """
+
+    def setUp(self):
+        # Irregular boundary near x=1000 shared by left and right areas
+        # Simplifying each area separately with tolerance of 15m leaves gaps and overlaps between them
+        generator = random.Random(1)
+        shared = [(1000 + generator.uniform(-20, 20), y) for y in range(0, 1001, 10)]
+        self.left = shapely.Polygon([(0, 0)] + shared + [(0, 1000)])
+        self.right = shapely.Polygon(shared + [(2000, 1000), (2000, 0)])
+
+    def test_shared_boundaries_simplify_identically(self):
+        simplified = simplify.Topology(np.array([self.left, self.right])).simplify(15)
+        left, right = simplified
+        self.assertLess(shapely.get_num_coordinates(left), shapely.get_num_coordinates(self.left))
+        # No overlap or gap between neighbours, so their union is single polygon without holes
+        self.assertAlmostEqual(shapely.intersection(left, right).area, 0)
+        union = shapely.union(left, right)
+        self.assertEqual(union.geom_type, 'Polygon')
+        self.assertEqual(len(union.interiors), 0)
+        self.assertAlmostEqual(union.area, left.area + right.area)
+
+    def test_holes_and_multipolygons_survive(self):
+        square = lambda x, y, size: [(x, y), (x + size, y), (x + size, y + size), (x, y + size)]
+        island = shapely.Polygon(square(400, 400, 200))
+        lake = shapely.Polygon(square(0, 0, 1000), holes=[square(400, 400, 200)])
+        archipelago = shapely.MultiPolygon([shapely.Polygon(square(2000, 0, 100)), shapely.Polygon(square(2200, 0, 100))])
+        lake, island, archipelago = simplify.Topology(np.array([lake, island, archipelago])).simplify(5)
+
+        self.assertEqual(lake.geom_type, 'Polygon')
+        self.assertEqual(len(lake.interiors), 1)
+        self.assertAlmostEqual(lake.area, 1000 * 1000 - 200 * 200)
+        # Island fills lake's hole exactly, as hole and island share single arc
+        self.assertTrue(shapely.equals(shapely.Polygon(lake.interiors[0]), island))
+        self.assertEqual(archipelago.geom_type, 'MultiPolygon')
+        self.assertEqual(len(archipelago.geoms), 2)
+
+    def test_collapsed_features_fall_back(self):
+        # Neighbouring 1m squares each reduce to their shared edge and collapse
+        first = shapely.Polygon([(5000, 5000), (5001, 5000), (5001, 5001), (5000, 5001)])
+        second = shapely.Polygon([(5001, 5000), (5002, 5000), (5002, 5001), (5001, 5001)])
+        geometries = np.array([self.left, first, second])
+        simplified = simplify.Topology(geometries).simplify(10)
+        self.assertEqual(shapely.is_empty(simplified).tolist(), [False, True, True])
+        simplified, fallbacks = simplify.ensureallfeatures(geometries, simplified, 10)
+        self.assertEqual(fallbacks, 2)
+        self.assertFalse(shapely.is_empty(simplified).any())
+        self.assertTrue(shapely.is_valid(simplified).all())
+
+    def test_tolerance_increased_to_meet_tile_budget(self):
+        # Circle within single zoom 10 tile, which is about 39km across
+        circle = shapely.Point(19568, 19568).buffer(10000, quad_segs=500)
+        with mock.patch.object(simplify, 'tilevertexbudget', 100):
+            simplified, stats = simplify.simplifyforzoom(simplify.Topology(np.array([circle])), 1, 10)
+        self.assertGreater(stats['tolerance_increase'], 1)
+        self.assertLessEqual(stats['max_tile_vertices'], 100)
+        self.assertFalse(stats['over_budget'])
+
+    def test_budget_exceeded_after_maximum_increases_is_reported(self):
+        circle = shapely.Point(19568, 19568).buffer(10000, quad_segs=500)
+        with mock.patch.object(simplify, 'tilevertexbudget', 3):
+            simplified, stats = simplify.simplifyforzoom(simplify.Topology(np.array([circle])), 1, 10)
+        self.assertAlmostEqual(stats['tolerance_increase'], simplify.tolerancestep ** simplify.maxtoleranceincreases)
+        self.assertTrue(stats['over_budget'])
+        self.assertFalse(shapely.is_empty(simplified[0]))
+
+class GeometryGenerationTests(TestCase):
+    """
+    Incremental geometry generation of boundary file with zoom levels 0 and 1 only
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.areafile = os.path.join(self.folder, 'areas.json')
+        self.zoomrange = mock.patch.object(tools, 'zoomrange', 1)
+        self.zoomrange.start()
+
+    def tearDown(self):
+        self.zoomrange.stop()
+        shutil.rmtree(self.folder)
+
+    def writeareas(self, areas):
+        """
+        Write boundary file of squares, areas maps code to (west, width) of square in degrees
+        """
+
+        features = []
+        for code in areas:
+            west, width = areas[code]
+            coordinates = [[west, 52], [west + width, 52], [west + width, 52.01], [west, 52.01], [west, 52]]
+            features.append({'type': 'Feature', 'properties': {'code': code, 'name': 'Area ' + code}, 'geometry': {'type': 'Polygon', 'coordinates': [coordinates]}})
+        with open(self.areafile, 'w') as f: json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+    def generate(self, force=False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            tools.generategeometriesforfile(self.areafile, 'lsoa', force=force)
+
+    def getgeometries(self):
+        return sorted(Geometry.objects.values_list('code', 'zoom'))
+
+    def test_generates_every_zoom_level_and_area(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01), 'C': (-0.98, 0.01)})
+        self.generate()
+        self.assertEqual(self.getgeometries(), [(code, zoom) for code in 'ABC' for zoom in range(2)])
+        self.assertEqual(sorted(Area.objects.values_list('code', flat=True)), ['A', 'B', 'C'])
+        self.assertEqual(GeometryStaging.objects.count(), 0)
+        self.assertEqual(GeometryCheckpoint.objects.count(), 0)
+        self.assertEqual(sorted(GeometrySource.objects.values_list('code', flat=True)), ['', 'A', 'B', 'C'])
+
+    def test_unchanged_file_is_skipped(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01)})
+        self.generate()
+        with mock.patch.object(tools, 'stagegeometries') as stagegeometries, mock.patch.object(tools, 'swapgeometries') as swapgeometries:
+            self.generate()
+        stagegeometries.assert_not_called()
+        swapgeometries.assert_not_called()
+
+    def test_changed_file_restages_all_areas_and_removes_dropped_areas(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01), 'C': (-0.98, 0.01)})
+        self.generate()
+        unchangedsource = GeometrySource.objects.get(code='B').hash
+
+        # A grows away from B and C is dropped, and B is unchanged but restaged with rest of file
+        self.writeareas({'A': (-1.01, 0.02), 'B': (-0.99, 0.01)})
+        with mock.patch.object(tools, 'stagegeometries', wraps=tools.stagegeometries) as stagegeometries:
+            self.generate()
+        self.assertTrue(all([call[0][4] == ['A', 'B'] for call in stagegeometries.call_args_list]))
+
+        self.assertEqual(self.getgeometries(), [(code, zoom) for code in 'AB' for zoom in range(2)])
+        self.assertEqual(sorted(Area.objects.values_list('code', flat=True)), ['A', 'B'])
+        self.assertAlmostEqual(Area.objects.get(code='A').xmin, -1.01)
+        self.assertEqual(sorted(GeometrySource.objects.values_list('code', flat=True)), ['', 'A', 'B'])
+        self.assertEqual(GeometrySource.objects.get(code='B').hash, unchangedsource)
+
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01)})
+        stagegeometries = tools.stagegeometries
+
+        def interrupt(areafile, areatype, filehash, zoom, codes, names, geometries):
+            if zoom == 1: raise RuntimeError("Interrupted")
+            stagegeometries(areafile, areatype, filehash, zoom, codes, names, geometries)
+
+        with mock.patch.object(tools, 'stagegeometries', side_effect=interrupt), self.assertRaises(RuntimeError):
+            self.generate()
+        self.assertEqual(list(GeometryCheckpoint.objects.values_list('zoom', flat=True)), [0])
+        self.assertEqual(Geometry.objects.count(), 0)
+
+        with mock.patch.object(tools, 'stagegeometries', wraps=stagegeometries) as resumed:
+            self.generate()
+        self.assertEqual([call[0][3] for call in resumed.call_args_list], [1])
+        self.assertEqual(self.getgeometries(), [(code, zoom) for code in 'AB' for zoom in range(2)])
+
+    def test_stale_staged_geometries_are_discarded(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01)})
+        self.generate()
+        stagegeometries = tools.stagegeometries
+
+        def interrupt(areafile, areatype, filehash, zoom, codes, names, geometries):
+            if zoom == 1: raise RuntimeError("Interrupted")
+            stagegeometries(areafile, areatype, filehash, zoom, codes, names, geometries)
+
+        with mock.patch.object(tools, 'stagegeometries', side_effect=interrupt), self.assertRaises(RuntimeError):
+            self.generate(force=True)
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.02)})
+        self.generate()
+        self.assertEqual(self.getgeometries(), [(code, zoom) for code in 'AB' for zoom in range(2)])
+        self.assertEqual(GeometryStaging.objects.count(), 0)
+
+    def test_identical_shapes_stored_once(self):
+        # Squares are too small to simplify further, so are identical at both zoom levels
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01)})
+        self.generate()
+        self.assertEqual(Geometry.objects.count(), 4)
+        self.assertEqual(Shape.objects.count(), 2)
+        self.assertEqual(Geometry.objects.filter(code='A').values('shape').distinct().count(), 1)
+
+    def test_shapes_no_longer_used_are_removed(self):
+        self.writeareas({'A': (-1, 0.01), 'B': (-0.99, 0.01)})
+        self.generate()
+        oldshapes = set(Geometry.objects.filter(code='A').values_list('shape__hash', flat=True))
+        self.writeareas({'A': (-1.01, 0.02), 'B': (-0.99, 0.01)})
+        self.generate()
+        self.assertFalse(Shape.objects.filter(hash__in=oldshapes).exists())
+        self.assertEqual(Shape.objects.count(), Geometry.objects.values('shape').distinct().count())
+
+    def test_migrate_warns_about_geometries_without_shapes(self):
+        sender = apps.get_app_config('backend')
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            check_geometry_shapes(sender, DEFAULT_DB_ALIAS)
+        self.assertEqual(output.getvalue(), '')
+        Geometry.objects.create(type='lsoa', name='Area A', code='A', zoom=0)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            check_geometry_shapes(sender, DEFAULT_DB_ALIAS)
+        self.assertIn('generategeometries', output.getvalue())
+
+class GeometrySwapLockTests(TransactionTestCase):
+    """
+    Swaps of geometries wait for advisory lock held by swaps of other files
+    """
+
+    def test_swap_waits_for_lock(self):
+        def swap():
+            try:
+                tools.swapgeometries('areas.json', 'lsoa', 'hash', {'A': 'hash'}, set(), [])
+            finally:
+                connections.close_all()
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", [tools.swaplockid])
+            thread = threading.Thread(target=swap)
+            thread.start()
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(GeometrySource.objects.count(), 0)
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [tools.swaplockid])
+
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(GeometrySource.objects.values_list('code', flat=True)), ['', 'A'])
+
+class AreaRegistryTests(TestCase):
+    """
+    Per-worker cache of Area table
+    """
+
+    def setUp(self):
+        areas._cache.update({'areas': {}, 'loaded': 0})
+        Area.objects.create(type='lau1', name='Area A', code='A', xmin=-1, ymin=51, xmax=0, ymax=52)
+        Area.objects.create(type='lsoa', name='Area B', code='B', parentcodes='A M', xmin=-0.5, ymin=51.5, xmax=-0.4, ymax=51.6)
+
+    def age(self, seconds):
+        areas._cache['loaded'] -= seconds + 1
+
+    def test_contents(self):
+        self.assertEqual(sorted(areas.getareas()), ['A', 'B'])
+        self.assertEqual(areas.getarea('B'), {'code': 'B', 'name': 'Area B', 'type': 'lsoa', 'parents': ['A', 'M'], 'bounds': (-0.5, 51.5, -0.4, 51.6)})
+        self.assertEqual(areas.getarea('A')['parents'], [])
+        with self.assertNumQueries(0):
+            self.assertEqual(areas.getarea('B')['name'], 'Area B')
+            self.assertIsNone(areas.getarea('C'))
+
+    def test_regenerated_areas_loaded_after_cache_expires(self):
+        areas.getareas()
+        Area.objects.filter(code='A').delete()
+        Area.objects.filter(code='B').update(name='Area B renamed')
+        self.assertEqual(sorted(areas.getareas()), ['A', 'B'])
+        self.age(areas.cachelifetime)
+        self.assertEqual(sorted(areas.getareas()), ['B'])
+        self.assertEqual(areas.getarea('B')['name'], 'Area B renamed')
+
+    def test_unknown_area_reloads_at_most_once_per_interval(self):
+        areas.getareas()
+        Area.objects.create(type='lsoa', name='Area C', code='C')
+        with self.assertNumQueries(0):
+            self.assertIsNone(areas.getarea('C'))
+        self.age(areas.missreloadinterval)
+        self.assertEqual(areas.getarea('C')['name'], 'Area C')
+
+class ValidationTests(TestCase):
+    """
+    Checks of generated geometries, see tools.py checkgeometries
+    """
+
+    square = 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'
+    bowtie = 'POLYGON((0 0, 1 1, 1 0, 0 1, 0 0))'
+
+    def addgeometries(self, code, zooms, wkt):
+        shape = Shape.objects.create(hash=code, geometry=None if wkt is None else GEOSGeometry(wkt, srid=4326))
+        for zoom in zooms: Geometry.objects.create(type='lsoa', name='Area ' + code, code=code, zoom=zoom, shape=shape)
+
+    def checkchunks(self):
+        problems, checked = [], 0
+        for chunk in validation.getchunks(2000):
+            chunkproblems, chunkchecked = validation.checkchunk(chunk)
+            problems += chunkproblems
+            checked += chunkchecked
+        return sorted([(problem['code'], problem['zoom'], problem['check']) for problem in problems]), checked
+
+    def test_shared_shape_validated_once(self):
+        self.addgeometries('A', [0, 1, 2], self.square)
+        with mock.patch.object(validation.shapely, 'is_valid_reason', wraps=shapely.is_valid_reason) as isvalidreason:
+            self.assertEqual(self.checkchunks(), ([], 3))
+        self.assertEqual(isvalidreason.call_count, 1)
+        self.assertEqual(len(isvalidreason.call_args[0][0]), 1)
+
+    def test_problems_reported_for_each_geometry_using_shape(self):
+        self.addgeometries('A', [0, 1], self.bowtie)
+        self.addgeometries('B', [0], None)
+        self.addgeometries('C', [0, 1], self.square)
+        with mock.patch.object(validation, 'maxvertices', {zoom: 4 if zoom == 0 else 100 for zoom in range(16)}):
+            problems, checked = self.checkchunks()
+        self.assertEqual(checked, 5)
+        self.assertEqual(problems, [('A', 0, 'selfintersection'), ('A', 0, 'vertices'), ('A', 1, 'selfintersection'), ('B', 0, 'null'), ('C', 0, 'vertices')])
+
+    def test_geometries_without_shape(self):
+        Geometry.objects.create(type='lsoa', name='Area A', code='A', zoom=0)
+        problems, checked = validation.checknullshapes()
+        self.assertEqual(checked, 1)
+        self.assertEqual([(problem['code'], problem['check']) for problem in problems], [('A', 'null')])
+        self.assertEqual(self.checkchunks(), ([], 0))
+
+    def test_missing_zoom_levels_found_in_single_query(self):
+        self.addgeometries('A', [0, 1, 2], self.square)
+        self.addgeometries('B', [0, 2], self.bowtie)
+        self.addgeometries('C', [1], None)
+        with self.assertNumQueries(1):
+            problems = validation.checkzoomlevels(2)
+        self.assertEqual(sorted([(problem['code'], problem['missing']) for problem in problems]), [('B', [1]), ('C', [0, 2])])
+
+class CoalesceTests(SimpleTestCase):
+    """
+    Concurrent identical requests share single computation
+    """
+
+    def runconcurrently(self, compute, count):
+        """
+        Call coalesce from count threads while first call's compute is blocked, returning results or errors in order
+        """
+
+        started, release = threading.Event(), threading.Event()
+        outcomes = [None] * count
+
+        def blockedcompute():
+            started.set()
+            release.wait(5)
+            return compute()
+
+        def request(index):
+            try:
+                outcomes[index] = coalesce.coalesce('key', blockedcompute)
+            except Exception as error:
+                outcomes[index] = error
+
+        threads = [threading.Thread(target=request, args=(index,)) for index in range(count)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]: thread.start()
+        # Let followers reach wait for leader's result before releasing leader
+        time.sleep(0.2)
+        release.set()
+        for thread in threads: thread.join(5)
+        return outcomes
+
+    def test_followers_share_leader_result(self):
+        compute = mock.Mock(return_value='response')
+        self.assertEqual(self.runconcurrently(compute, 5), ['response'] * 5)
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(coalesce._flights, {})
+
+    def test_leader_error_reaches_followers(self):
+        error = ValueError("Query failed")
+        compute = mock.Mock(side_effect=error)
+        self.assertEqual(self.runconcurrently(compute, 5), [error] * 5)
+        self.assertEqual(compute.call_count, 1)
+        # Later request computes again rather than reusing failure
+        self.assertEqual(coalesce.coalesce('key', lambda: 'response'), 'response')
+
+    @override_settings(COALESCE_ACROSS_WORKERS=True, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_waits_for_result_of_other_worker(self):
+        cache = coalesce.getsharedcache()
+        cache.add('coalesce-lock-key', 1)
+        other = threading.Timer(0.2, lambda: cache.set('coalesce-result-key', 'other response'))
+        other.start()
+        compute = mock.Mock(return_value='response')
+        self.assertEqual(coalesce.coalesce('key', compute), 'other response')
+        compute.assert_not_called()
+        other.join()
+
+class PipelineTests(SimpleTestCase):
+    """
+    Pipeline of stub stages, which log when they start and finish to file shared by worker processes
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.folder, 'log.txt')
+        self.statefile = os.path.join(self.folder, 'pipeline.json')
+        self.failing = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getstages(self, yearstart, yearend):
+        def stage(name, dependencies=()):
+            def function():
+                with open(self.logfile, 'a') as f: f.write('start ' + name + '\n')
+                time.sleep(0.05)
+                if name in self.failing: raise ValueError("Stage failed")
+                with open(self.logfile, 'a') as f: f.write('finish ' + name + '\n')
+                return 1
+            return pipeline.Stage(function, dependencies)
+
+        return {'a': stage('a'), 'b': stage('b'), 'c': stage('c', ['a', 'b']), 'd': stage('d', ['c']), 'e': stage('e', ['a'])}
+
+    def runpipeline(self, resume=False):
+        # Worker processes are forked so inherit stub stages
+        with mock.patch.object(pipeline, 'getstages', self.getstages), contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return pipeline.runpipeline(2015, 2015, filepath=self.statefile, resume=resume, processes=2)
+
+    def getlog(self):
+        if not os.path.isfile(self.logfile): return []
+        with open(self.logfile) as f: return f.read().split('\n')[:-1]
+
+    def test_stages_start_after_dependencies_finish(self):
+        self.assertEqual(self.runpipeline(), 0)
+        log = self.getlog()
+        for name, dependencies in [('c', ['a', 'b']), ('d', ['c']), ('e', ['a'])]:
+            for dependency in dependencies:
+                self.assertLess(log.index('finish ' + dependency), log.index('start ' + name))
+        state = pipeline.loadstate(self.statefile)
+        self.assertEqual(set([stage['status'] for stage in state['stages'].values()]), {'completed'})
+
+    def test_failed_stage_skips_dependents_and_resume_runs_only_incomplete_stages(self):
+        self.failing = {'b'}
+        self.assertEqual(self.runpipeline(), 3)
+        statuses = {name: stage['status'] for name, stage in pipeline.loadstate(self.statefile)['stages'].items()}
+        self.assertEqual(statuses, {'a': 'completed', 'b': 'failed', 'c': 'skipped', 'd': 'skipped', 'e': 'completed'})
+        self.assertNotIn('start c', self.getlog())
+
+        self.failing = set()
+        os.remove(self.logfile)
+        self.assertEqual(self.runpipeline(resume=True), 0)
+        self.assertEqual(sorted([line.split()[1] for line in self.getlog() if line.startswith('start')]), ['b', 'c', 'd'])
+
+    def test_resume_without_state_file_fails(self):
+        self.assertEqual(self.runpipeline(resume=True), 1)
+
+class DataImportTests(TestCase):
+    """
+    Imports only write rows that are new, changed or removed
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.folder, 'BEIS'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def importrows(self, rows):
+        with open(os.path.join(self.folder, 'BEIS', 'LSOA_ELEC_2015.csv'), 'w') as f:
+            f.write('LSOACode,KWH,METERS\n')
+            for code, value, meters in rows: f.write(code + ',' + value + ',' + meters + '\n')
+        with workingdirectory(self.folder), contextlib.redirect_stdout(io.StringIO()):
+            return tools.importdatabygeometrytype('lsoa', 2015, 0)
+
+    def test_data_hash_matches_stored_precision(self):
+        self.assertEqual(tools.get_data_hash('100.00', 10), tools.get_data_hash(100.004, 10.0))
+        self.assertNotEqual(tools.get_data_hash(100.00, 10), tools.get_data_hash(100.01, 10))
+        self.assertNotEqual(tools.get_data_hash(100.00, 10), tools.get_data_hash(100.00, 11))
+
+    def test_reimport_only_changes_differences(self):
+        self.assertEqual(self.importrows([('E1', '100.00', '10'), ('E2', '200.00', '20')]), {'E1', 'E2'})
+        self.assertEqual(self.importrows([('E1', '100.004', '10'), ('E2', '200', '20.0')]), set())
+        self.assertEqual(self.importrows([('E1', '150.00', '10'), ('E3', '300.00', '30')]), {'E1', 'E2', 'E3'})
+
+        values = {code: float(value) for code, value in Data.objects.filter(geometrytype='lsoa', year='2015', type=0).values_list('geometrycode', 'value')}
+        self.assertEqual(values, {'E1': 150.0, 'E3': 300.0})
+
+class LocationImportTests(SimpleTestCase):
+
+    def test_deduplicateshortcodes(self):
+        locations = [Location(shortcode='newport', county='Gwent'), Location(shortcode='newport', county='Isle of Wight'), Location(shortcode='leeds', county='West Yorkshire')]
+        tools.deduplicateshortcodes(locations)
+        self.assertEqual([location.shortcode for location in locations], ['newportgwent', 'newportisleofwight', 'leeds'])
+
+    def test_parsenumber(self):
+        self.assertEqual(tools.parsenumber(' 1,234 ', int), 1234)
+        self.assertEqual(tools.parsenumber('-2.5', float), -2.5)
+        self.assertIsNone(tools.parsenumber('', int))
+        self.assertIsNone(tools.parsenumber('   ', float))
+        with self.assertRaises(ValueError): tools.parsenumber('n/a', int)
+
+class LocationMigrationTests(TestCase):
+    """
+    Locations stored as text are deleted before migrating their numbers, as blank text can't be cast
+    """
+
+    def setUp(self):
+        Location.objects.create(shortcode='leeds', town='Leeds', county='West Yorkshire', country='England', population=100, latitude=53.8, longitude=-1.5, url='')
+        migration = mock.Mock(operations=[AlterField('location', 'population', IntegerField(null=True, blank=True))])
+        self.plan = [(migration, False)]
+        self.sender = apps.get_app_config('backend')
+
+    def test_numeric_columns_are_kept(self):
+        clear_text_locations(self.sender, DEFAULT_DB_ALIAS, plan=self.plan)
+        self.assertEqual(Location.objects.count(), 1)
+
+    def test_text_columns_are_cleared(self):
+        with mock.patch.object(connection.introspection, 'get_field_type', return_value='CharField'), contextlib.redirect_stdout(io.StringIO()):
+            clear_text_locations(self.sender, DEFAULT_DB_ALIAS, plan=[(migration, True) for migration, backwards in self.plan])
+            self.assertEqual(Location.objects.count(), 1)
+            clear_text_locations(self.sender, DEFAULT_DB_ALIAS, plan=self.plan)
+        self.assertEqual(Location.objects.count(), 0)
+
+class GeocodeTests(TestCase):
+    """
+    Geocoding of postcodes with remote postcode API replaced by mock
+    """
+
+    def setUp(self):
+        geocode._cache.update({'towns': {}, 'loaded': 0, 'unresolved': {}})
+        self.remote = mock.patch.object(geocode, 'get_postcode_point')
+        self.getpostcodepoint = self.remote.start()
+
+    def tearDown(self):
+        self.remote.stop()
+
+    def geocode(self, locations):
+        return geocode.geocode(locations, includeareas=False)
+
+    def test_local_postcode_not_looked_up_remotely(self):
+        Postcode.objects.create(postcode='SW1A1AA', longitude=-0.14, latitude=51.5)
+        self.assertEqual(self.geocode(['sw1a 1aa']), [{'result': 'success', 'lat': 51.5, 'lng': -0.14, 'zoom': geocode.postcodezoom}])
+        self.getpostcodepoint.assert_not_called()
+
+    def test_remote_postcode_saved(self):
+        self.getpostcodepoint.return_value = (-0.1, 51.52)
+        self.assertEqual(self.geocode(['EC1A 1BB']), [{'result': 'success', 'lat': 51.52, 'lng': -0.1, 'zoom': geocode.postcodezoom}])
+        self.getpostcodepoint.assert_called_once_with('EC1A1BB', timeout=geocode.remotetimeout)
+        self.assertTrue(Postcode.objects.filter(postcode='EC1A1BB').exists())
+        self.geocode(['EC1A 1BB'])
+        self.assertEqual(self.getpostcodepoint.call_count, 1)
+
+    def test_failure_reasons(self):
+        def getpostcodepoint(postcode, timeout):
+            if postcode == 'W1A0AX': raise OSError("timed out")
+            return None
+
+        self.getpostcodepoint.side_effect = getpostcodepoint
+        results = self.geocode(['EC1A 1BB', 'W1A 0AX', 'Nowhere'])
+        self.assertEqual(results, [{'result': 'failure', 'reason': 'notfound'}, {'result': 'failure', 'reason': 'unavailable'}, {'result': 'failure'}])
+        self.assertEqual(Postcode.objects.count(), 0)
+
+        # Unresolved postcodes are not looked up again straight away
+        self.assertEqual(self.geocode(['EC1A 1BB', 'W1A 0AX']), results[:2])
+        self.assertEqual(self.getpostcodepoint.call_count, 2)
+
+        with mock.patch.object(geocode, 'maxremotelookups', 0):
+            self.assertEqual(self.geocode(['M1 1AE']), [{'result': 'failure', 'reason': 'limit'}])
+
+    def test_lookups_unfinished_by_deadline_reach_limit(self):
+        release = threading.Event()
+
+        def getpostcodepoint(postcode, timeout):
+            if postcode == 'W1A0AX': release.wait(10)
+            return (-0.1, 51.52)
+
+        self.getpostcodepoint.side_effect = getpostcodepoint
+        start = time.time()
+        with mock.patch.object(geocode, 'remotedeadline', 0.2):
+            results = self.geocode(['EC1A 1BB', 'W1A 0AX'])
+        release.set()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(results[0]['result'], 'success')
+        self.assertEqual(results[1], {'result': 'failure', 'reason': 'limit'})
+        self.assertEqual(list(Postcode.objects.values_list('postcode', flat=True)), ['EC1A1BB'])
+
+class RankingStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        # Areas A-D for single year, electricity has tie between B and C and no data for D
+        consumption = np.array([[[10], [5]], [[30], [5]], [[30], [5]], [[np.nan], [5]]], dtype=np.float64)
+        meters = np.array([[[1], [1]], [[3], [0]], [[2], [1]], [[np.nan], [1]]], dtype=np.float64)
+        self.store = RankingStore(['A', 'B', 'C', 'D'], [2019], consumption, meters)
+
+    def test_order_skips_areas_without_values(self):
+        self.assertEqual(self.store.orders['total'][0, 0].tolist(), [1, 2, 0, -1])
+        self.assertEqual(int(self.store.counts['total'][0, 0]), 3)
+
+    def test_ties_share_rank(self):
+        ranks, percentiles = self.store.getranks([0, 1, 2], 0, 0, 'total')
+        self.assertEqual(ranks.tolist(), [3, 1, 1])
+        self.assertEqual(percentiles.tolist(), [0.0, 100.0, 100.0])
+
+    def test_all_equal_values(self):
+        ranks, percentiles = self.store.getranks([0, 1, 2, 3], 1, 0, 'total')
+        self.assertEqual(ranks.tolist(), [1, 1, 1, 1])
+
+    def test_permeter_skips_areas_without_meters(self):
+        # Gas per meter: B has no meters so is not ranked
+        self.assertEqual(int(self.store.counts['permeter'][1, 0]), 3)
+        self.assertTrue(np.isnan(self.store.getvalues('permeter', 1, 0)[1]))
+        ranks, percentiles = self.store.getranks([0, 2, 3], 1, 0, 'permeter')
+        self.assertEqual(ranks.tolist(), [1, 1, 1])
+
+    def test_roundtrip(self):
+        store = RankingStore.frombytes(self.store.tobytes())
+        np.testing.assert_array_equal(store.orders['permeter'], self.store.orders['permeter'])
+        self.assertEqual(store.codes.tolist(), ['A', 'B', 'C', 'D'])
+
+class ChangesTests(SimpleTestCase):
+
+    def test_encodearray_is_little_endian(self):
+        self.assertEqual(base64.b64decode(encodearray([1.0], 'f4')), b'\x00\x00\x80\x3f')
+
+    def test_encodearray_roundtrip(self):
+        values = np.array([[1.5, -2.25, np.nan], [0, 1e6, 3]])
+        decoded = np.frombuffer(base64.b64decode(encodearray(values, 'f4')), dtype='<f4').reshape(values.shape)
+        np.testing.assert_array_equal(decoded, values.astype(np.float32))
+        flags = np.frombuffer(base64.b64decode(encodearray(np.array([[True, False]]), 'u1')), dtype=np.uint8)
+        self.assertEqual(flags.tolist(), [1, 0])
+
+class PrecompressTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, 'snapshot.json')
+        with open(self.filepath, 'wb') as f: f.write(b'[1, 2, 3]' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_compressfile_writes_variant_with_source_time(self):
+        self.assertEqual(compressfile(self.filepath), 1)
+        with gzip.open(self.filepath + '.gz', 'rb') as f: self.assertEqual(f.read(), b'[1, 2, 3]' * 100)
+        self.assertAlmostEqual(os.path.getmtime(self.filepath + '.gz'), os.path.getmtime(self.filepath), places=3)
+
+    def test_compressfile_skips_up_to_date_variant(self):
+        compressfile(self.filepath)
+        self.assertEqual(compressfile(self.filepath), 0)
+
+    def test_compressfile_rewrites_outdated_variant(self):
+        compressfile(self.filepath)
+        with open(self.filepath, 'wb') as f: f.write(b'[4, 5, 6]' * 100)
+        newer = time.time() + 10
+        os.utime(self.filepath, (newer, newer))
+        self.assertEqual(compressfile(self.filepath), 1)
+        with gzip.open(self.filepath + '.gz', 'rb') as f: self.assertEqual(f.read(), b'[4, 5, 6]' * 100)
+
+@override_settings(SQL_REPLICA_MAXLAG=5)
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        routers._cache.clear()
+        self.router = routers.ReplicaRouter()
+        self.backendmodel = mock.Mock(_meta=mock.Mock(app_label='backend'))
+        self.othermodel = mock.Mock(_meta=mock.Mock(app_label='sessions'))
+
+    def tearDown(self):
+        routers._cache.clear()
+
+    def test_reads_outside_readreplica_views_use_primary(self):
+        self.assertEqual(self.router.db_for_read(self.backendmodel), 'default')
+
+    def test_reads_of_backend_models_use_chosen_replica(self):
+        token = routers._readdatabase.set('replica1')
+        try:
+            self.assertEqual(self.router.db_for_read(self.backendmodel), 'replica1')
+            self.assertEqual(self.router.db_for_read(self.othermodel), 'default')
+            self.assertEqual(self.router.db_for_write(self.backendmodel), 'default')
+        finally:
+            routers._readdatabase.reset(token)
+
+    def test_migrations_only_on_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'backend'))
+        self.assertFalse(self.router.allow_migrate('replica1', 'backend'))
+
+    @mock.patch.object(routers, 'getreplicas', return_value=['replica1'])
+    @mock.patch.object(routers, 'connections')
+    def test_unreachable_replica_falls_back_to_primary(self, connections, getreplicas):
+        with mock.patch.object(routers, 'getreplicalag', side_effect=DatabaseError):
+            self.assertEqual(routers.getreaddatabase(), 'default')
+        connections.__getitem__.return_value.close.assert_called_once()
+        # Failed replica is not checked again until failure interval has passed
+        with mock.patch.object(routers, 'getreplicalag', return_value=0) as getreplicalag:
+            self.assertEqual(routers.getreaddatabase(), 'default')
+            getreplicalag.assert_not_called()
+
+    @mock.patch.object(routers, 'getreplicas', return_value=['replica1'])
+    def test_lagging_replica_falls_back_to_primary(self, getreplicas):
+        with mock.patch.object(routers, 'getreplicalag', return_value=60):
+            self.assertEqual(routers.getreaddatabase(), 'default')
+        routers._cache.clear()
+        with mock.patch.object(routers, 'getreplicalag', return_value=1):
+            self.assertEqual(routers.getreaddatabase(), 'replica1')
+
+class ViewTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_batch_views_reject_json_that_is_not_object(self):
+        for view, path in [(views.Lookup, '/lookup/'), (views.LocationPositions, '/locationpositions/')]:
+            response = view(self.factory.post(path, data='[[0, 51]]', content_type='application/json'))
+            self.assertEqual(json.loads(response.content), {'result': 'failure'})
+
+    def test_export_requires_staff(self):
+        request = self.factory.get('/export/', {'geometrytype': 'lsoa', 'yearstart': 2010})
+        request.user = AnonymousUser()
+        self.assertEqual(views.Export(request).status_code, 302)
+
+    def test_geometries_delta_returns_new_features_and_evicted_codes(self):
+        # Client moves view one degree east, so A stays in view, B enters it and C leaves it
+        areas = {'A': ((1.2, 0.5, 1.4, 0.7), 0), 'B': ((2.5, 0.5, 2.7, 0.7), 0), 'C': ((0.2, 0.5, 0.4, 0.7), 0),
+                 'D': ((5, 5, 6, 6), 0), 'E': ((2.5, 0.5, 2.7, 0.7), 1)}
+        for code, (bbox, zoom) in areas.items():
+            shape = Shape.objects.create(hash=code, geometry=Polygon.from_bbox(bbox))
+            Geometry.objects.create(type='lsoa', name='Area ' + code, code=code, zoom=zoom, shape=shape, bbox=Polygon.from_bbox(bbox))
+
+        body = {'geometrytype': 1 + views.geometrytypecode.index('lsoa'), 'zoom': 0, 'xmin': 1, 'ymin': 0, 'xmax': 3, 'ymax': 2,
+                'previous': {'xmin': 0, 'ymin': 0, 'xmax': 2, 'ymax': 2}}
+        response = json.loads(views.Geometries(self.factory.post('/geometries/', data=json.dumps(body), content_type='application/json')).content)
+        self.assertTrue(response['delta'])
+        self.assertEqual([(feature['code'], feature['name'], feature['type']) for feature in response['features']], [('B', 'Area B', 'lsoa')])
+        self.assertEqual(json.loads(response['features'][0]['json'])['type'], 'Polygon')
+        self.assertEqual(response['evict'], ['C'])
+
+class ProfilingTests(TestCase):
+    """
+    Profiling middleware with every request sampled
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def slowview(self, request):
+        Area.objects.count()
+        time.sleep(0.1)
+        return HttpResponse('')
+
+    @override_settings(PROFILE_SAMPLE_RATE=1)
+    def test_sampled_request_saves_stacks_and_query_timings(self):
+        response = profiling.ProfilingMiddleware(self.slowview)(self.factory.get('/data/'))
+        profile = Profile.objects.get(id=int(response['X-Profile-Id']))
+        self.assertEqual((profile.method, profile.path, profile.reason), ('GET', '/data/', 'sample'))
+        self.assertGreaterEqual(profile.duration, 0.1)
+        self.assertGreater(profile.samples, 0)
+        self.assertIn('slowview (', profile.stacks)
+        self.assertEqual(sum([int(line.rsplit(' ', 1)[1]) for line in profile.stacks.splitlines()]), profile.samples)
+
+        queries = json.loads(profile.queries)
+        self.assertTrue(any(['backend_area' in query['sql'] for query in queries]))
+        self.assertAlmostEqual(profile.querytime, sum([query['duration'] for query in queries]))
+
+    @override_settings(PROFILE_SAMPLE_RATE=0)
+    def test_unsampled_request_not_profiled(self):
+        response = profiling.ProfilingMiddleware(self.slowview)(self.factory.get('/data/'))
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(Profile.objects.count(), 0)
@@ -11,32 +11,34 @@ importlocations: Imports location data from file that is used to geolocate speci
 generategeometries: Generates multiple geometries of boundaries for multiple zoom levels using simplification
 processspecialcases: Perform additional ad-hoc processing
 importdata: Imports data for specific area scale and year range (assuming BEIS data)
+pipeline: Runs full import as stages with dependencies, running independent stages in parallel
 """
 
 import os
-import pandas
+import sys
+import time
+import hashlib
+import multiprocessing
 import json
-import topojson as tp
-import geojson
 import csv
 import re
-from shapely.geometry import Polygon
 
 if __name__ == '__main__':
-    import sys
     import django
     parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
     sys.path.append(parent_dir)
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "carbonmap.settings")
     django.setup()
 
-from django.contrib.gis.db.models.functions import AsGeoJSON
-from django.core.serializers.json import DjangoJSONEncoder
-from django.contrib.gis.geos import GEOSException, GEOSGeometry, Point, fromstr
-from django.db import connection, transaction
+from django.contrib.gis.db.models.functions import AsWKB, PointOnSurface
+from django.contrib.gis.geos import GEOSGeometry, Point
+from django.conf import settings
+from django.db import connection, connections, transaction, DatabaseError
+from django.db.backends.utils import format_number
 from django.contrib.gis.db.models import Extent
-from backend.gis import get_degrees_per_pixel
-from backend.models import Location, Geometry, Data, DATATYPES_CHOICES
+from backend import precompress, profiling, routers
+from backend.gis import get_mercator_meters_per_pixel, get_shape_hash
+from backend.models import Location, Postcode, Shape, Geometry, Area, GeometryStaging, GeometrySource, GeometryCheckpoint, Data, DATATYPES_CHOICES
 
 # Number of zoom levels to cache geometries for
 # We generate a target-resolution-dependent simplification for each geometry object to minimize download size
@@ -55,6 +57,10 @@ subregions = {
 
 subregion_scotland_correction = "subregions/Counties_and_Unitary_Authorities_GB_2018.json"
 
+# Postgres advisory lock held while swapping geometries, so swaps of files generated in parallel
+# never remove shapes that another swap is about to reuse
+swaplockid = 762401
+
 non_decimal = re.compile(r'[^\d.]+')
 
 def getlargestpolygon(areatype):
@@ -65,9 +71,9 @@ def getlargestpolygon(areatype):
     """
     maxvalue = 0
     areacode = ''
-    geometries = Geometry.objects.filter(zoom=15, type=areatype).annotate(Extent('geometry')).values('code', 'geometry__extent')
+    geometries = Geometry.objects.filter(zoom=15, type=areatype).annotate(Extent('bbox')).values('code', 'bbox__extent')
     for geometry in geometries:
-        lng_west, lat_south, lng_east, lat_north = geometry['geometry__extent']
+        lng_west, lat_south, lng_east, lat_north = geometry['bbox__extent']
         lat_dif = lat_north - lat_south
         lng_dif = lng_east - lng_west
 
@@ -108,160 +114,279 @@ def get_feature_name_code(properties, yearsuffix):
 
     return {'name': name, 'code': code}
 
-def processspecialcases():
+def get_file_hash(filepath):
+    """
+    Get fingerprint of entire source file
     """
-    Perform additional ad-hoc processing
 
-    - Replace Scotland LAU1s with separate local authority boundaries as BEIS data uses non-standard LAU1 naming
+    from backend import simplify
+
+    filehash = hashlib.sha256(str(simplify.SIMPLIFICATIONVERSION).encode())
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            filehash.update(block)
+    return filehash.hexdigest()
+
+def get_feature_hash(feature):
+    """
+    Get fingerprint of single GeoJSON feature
     """
 
-    # Replace Scotland LAU1s with separate unitary authority boundaries as BEIS data uses unitary authorities for Scotland data at large scale
-    scottishareas = Geometry.objects.filter(code__startswith="S", type='lau1').delete()
-    print("Loading supplemental file for Scottish LAs", subregion_scotland_correction)
-    with open(subregion_scotland_correction) as f:
-        geojson_codes, topologysafe_codes = [], []
-        yearsuffix = get_yearsuffix_from_filepath(subregion_scotland_correction)
-        geometrydata = geojson.load(f)
+    from backend import simplify
+
+    return hashlib.sha256((str(simplify.SIMPLIFICATIONVERSION) + json.dumps(feature, sort_keys=True)).encode()).hexdigest()
 
-        # Create a list of all feature codes for entire file
-        for feature in geometrydata['features']:
-            feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-            if feature_namecode['code']: geojson_codes.append(feature_namecode['code'])
+def get_file_features(geometrydata, yearsuffix, codefilter):
+    """
+    Get dictionary of feature code to feature for all features in file accepted by codefilter
+    """
+
+    features = {}
+    for feature in geometrydata['features']:
+        feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
+        if feature_namecode['code'] is None: continue
+        if (codefilter is not None) and (not codefilter(feature_namecode['code'])): continue
+        features[feature_namecode['code']] = feature
+    return features
+
+def stagegeometries(areafile, areatype, filehash, zoom, codes, names, geometries):
+    """
+    Save geometries at particular zoom level into staging table, recording checkpoint once complete
+    """
 
-        geometrytopology = tp.Topology(geometrydata)
+    import shapely
 
-        # Create a list of all feature codes that topojson processed successfully
-        topologysafefeatures = json.loads(geometrytopology.to_geojson())
-        for feature in topologysafefeatures['features']:
-            feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-            if feature_namecode['code']: topologysafe_codes.append(feature_namecode['code'])
+    stagedgeometries = []
+    for code, wkb in zip(codes, shapely.to_wkb(geometries)):
+        geometry = GEOSGeometry(memoryview(wkb), srid=4326)
+        stagedgeometries.append(GeometryStaging(sourcefile=areafile, name=names[code], type=areatype, code=code, zoom=zoom, geometry=geometry, hash=get_shape_hash(wkb)))
 
-        # Get difference of feature codes between original file and topojson successfully processed feature codes
-        code_diff = list(set(geojson_codes) - set(topologysafe_codes))
+    with transaction.atomic():
+        GeometryStaging.objects.bulk_create(stagedgeometries, batch_size=1000)
+        GeometryCheckpoint.objects.create(sourcefile=areafile, hash=filehash, zoom=zoom)
 
-        # Create a custom feature set from the features that topojson failed to process
-        # TODO: investigate why topojson fails on certain polygons
-        diff_features = []
-        for feature in geometrydata['features']:
-            feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-            if feature_namecode['code'] in code_diff:
-                diff_features.append(feature)
+    print("Staged", len(stagedgeometries), "geometries for", areafile, "zoom level", zoom)
 
-        print("Number of polygons topojson failed on =", len(diff_features))
+def swapgeometries(areafile, areatype, filehash, featurehashes, removedcodes, areas):
+    """
+    Atomically replace live geometries and areas for staged and removed codes with staged geometries and new areas and store new fingerprints
+    Live geometries are replaced for every code in staging table, so codes staged by earlier interrupted run are never duplicated
+
+    Staged shapes not already stored are added to Shape table and shapes no longer used by any geometry are removed
+    """
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [swaplockid])
+        stagedcodes = GeometryStaging.objects.filter(sourcefile=areafile).values('code')
+        Geometry.objects.filter(type=areatype, code__in=stagedcodes).delete()
+        Geometry.objects.filter(type=areatype, code__in=list(removedcodes)).delete()
+        Area.objects.filter(type=areatype, code__in=[area.code for area in areas] + list(removedcodes)).delete()
+        Area.objects.bulk_create(areas, batch_size=1000)
+        cursor.execute("""
+        INSERT INTO """ + Shape._meta.db_table + """ (hash, geometry)
+        SELECT DISTINCT ON (hash) hash, geometry FROM """ + GeometryStaging._meta.db_table + """
+        WHERE sourcefile = %s
+        ON CONFLICT (hash) DO NOTHING
+        """, [areafile])
+        cursor.execute("""
+        INSERT INTO """ + Geometry._meta.db_table + """ (type, name, code, zoom, shape_id, bbox)
+        SELECT staging.type, staging.name, staging.code, staging.zoom, shape.id, ST_Envelope(staging.geometry)
+        FROM """ + GeometryStaging._meta.db_table + """ AS staging
+        JOIN """ + Shape._meta.db_table + """ AS shape ON shape.hash = staging.hash
+        WHERE staging.sourcefile = %s
+        """, [areafile])
+        cursor.execute("""
+        DELETE FROM """ + Shape._meta.db_table + """ AS shape
+        WHERE NOT EXISTS (SELECT 1 FROM """ + Geometry._meta.db_table + """ AS geometry WHERE geometry.shape_id = shape.id)
+        """)
+        GeometryStaging.objects.filter(sourcefile=areafile).delete()
+        GeometryCheckpoint.objects.filter(sourcefile=areafile).delete()
+        GeometrySource.objects.filter(sourcefile=areafile).delete()
+        sources = [GeometrySource(sourcefile=areafile, type=areatype, code='', hash=filehash)]
+        for code in featurehashes:
+            sources.append(GeometrySource(sourcefile=areafile, type=areatype, code=code, hash=featurehashes[code]))
+        GeometrySource.objects.bulk_create(sources, batch_size=1000)
+
+def generategeometriesforfile(areafile, areatype, codefilter=None, force=False):
+    """
+    Generates geometries for all zoom levels for features in single source file that have changed since last run
+
+    - Source file and each feature are fingerprinted so unchanged files are skipped and only removed features are deleted
+    - If any feature has changed, all features of file are regenerated, as simplified boundaries of its neighbours change too
+    - Each zoom level is staged and checkpointed so an interrupted run resumes from the last completed zoom level
+    - Staged geometries are swapped into live table in single transaction so the live site never sees partial dataset
+    """
+
+    import geojson
+    import shapely
+    from backend import simplify
+
+    print("Loading area file", areafile)
+    filehash = get_file_hash(areafile)
+    previoussources = {source['code']: source['hash'] for source in GeometrySource.objects.filter(sourcefile=areafile).values('code', 'hash')}
+
+    if (not force) and (previoussources.get('') == filehash):
+        print("Area file unchanged since last run, skipping", areafile)
+        return
+
+    # Discard staged geometries from interrupted run on different version of file
+    staleruns = GeometryCheckpoint.objects.filter(sourcefile=areafile).exclude(hash=filehash)
+    if force or staleruns.exists():
+        GeometryStaging.objects.filter(sourcefile=areafile).delete()
+        GeometryCheckpoint.objects.filter(sourcefile=areafile).delete()
+
+    completedzooms = set(GeometryCheckpoint.objects.filter(sourcefile=areafile, hash=filehash).values_list('zoom', flat=True))
+    if len(completedzooms) > 0: print("Resuming interrupted run, zoom levels already staged:", sorted(completedzooms))
+
+    with open(areafile) as f:
+        yearsuffix = get_yearsuffix_from_filepath(areafile)
+        geometrydata = geojson.load(f)
+
+    features = get_file_features(geometrydata, yearsuffix, codefilter)
+    featurehashes = {code: get_feature_hash(features[code]) for code in features}
+    changedcodes = set([code for code in featurehashes if force or (previoussources.get(code) != featurehashes[code])])
+    removedcodes = set(previoussources.keys()) - set(featurehashes.keys()) - set([''])
+
+    print("Features changed", len(changedcodes), "removed", len(removedcodes), "unchanged", len(featurehashes) - len(changedcodes))
+
+    areas = []
+    if len(changedcodes) > 0:
+        # Shared boundaries of changed features are simplified differently, so their unchanged neighbours are staged and swapped too
+        # Simplest set that includes every neighbour is whole file
+        codes = list(features.keys())
+        names = {code: get_feature_name_code(features[code]['properties'], yearsuffix)['name'] for code in codes}
+        geometries = simplify.loadgeometries([features[code] for code in codes])
+        topology = simplify.Topology(simplify.tomercator(geometries))
+
+        for code, bounds in zip(codes, shapely.bounds(geometries)):
+            areas.append(Area(type=areatype, name=names[code], code=code, xmin=bounds[0], ymin=bounds[1], xmax=bounds[2], ymax=bounds[3]))
 
         for zoom in range(0, zoomrange + 1):
+            if zoom in completedzooms: continue
+
+            zoomepsilon = get_mercator_meters_per_pixel(zoom)
+
+            print("Simplifying", areafile, "for zoom level", zoom, "equivalent to Web Mercator resolution", zoomepsilon)
+
+            simplifiedgeometries, stats = simplify.simplifyforzoom(topology, zoomepsilon, zoom)
+            simplify.printstats(stats)
+            simplifiedgeometries = simplify.frommercator(simplifiedgeometries)
+            stagegeometries(areafile, areatype, filehash, zoom, codes, names, simplifiedgeometries)
+
+    swapgeometries(areafile, areatype, filehash, featurehashes, removedcodes, areas)
+
+    print("Updated geometries for", areafile)
+
+def processspecialcases(force=False):
+    """
+    Perform additional ad-hoc processing
 
-            print("Creating identical polygons for all zoom levels for polygons topojson was not able to process", len(diff_features))
-
-            for feature in diff_features:
-                feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                if feature_namecode['code'][:1] == 'S': # Is scottish feature
-                    try:
-                        geometry = GEOSGeometry(str(feature['geometry']))
-                        print("Saving geometry for", feature_namecode['code'], "zoom level", zoom)
-                        geometryobject = Geometry(name=feature_namecode['name'], type='lau1', code=feature_namecode['code'], zoom=zoom, geometry=geometry)
-                        geometryobject.save()
-                    except:
-                        print("Failed to create geometry object - probably too small for zoom level", code, "zoom level", zoom, "degree resolution", zoomepsilon)
-       
-            zoomepsilon = get_degrees_per_pixel(zoom)
-
-            print("Simplifying", subregion_scotland_correction, "for zoom level", zoom, "equivalent to degree resolution", zoomepsilon)
-
-            simplifiedfeatures = json.loads(geometrytopology.toposimplify(
-                epsilon=zoomepsilon, 
-                simplify_algorithm='dp', 
-                prevent_oversimplify=True
-            ).to_geojson())
-
-            count = 0
-            for feature in simplifiedfeatures['features']:
-                feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                geometry = GEOSGeometry(str(feature['geometry']))
-                if feature_namecode['code'][:1] == 'S': # Is scottish feature
-                    print("Saving geometry for", feature_namecode['code'], feature_namecode['name'])
-                    geometryobject = Geometry(name=feature_namecode['name'], type='lau1', code=feature_namecode['code'], zoom=zoom, geometry=geometry)
-                    geometryobject.save() 
-
-def generategeometries():
+    - Replace Scotland LAU1s with separate local authority boundaries as BEIS data uses non-standard LAU1 naming
+    """
+
+    # Replace Scotland LAU1s with separate unitary authority boundaries as BEIS data uses unitary authorities for Scotland data at large scale
+    # Scottish LAU1s are excluded when LAU1 file is processed but may remain from earlier versions of generated geometries
+    print("Loading supplemental file for Scottish LAs", subregion_scotland_correction)
+    generategeometriesforfile(subregion_scotland_correction, 'lau1', codefilter=is_scottish_code, force=force)
+    correctioncodes = GeometrySource.objects.filter(sourcefile=subregion_scotland_correction).exclude(code='').values_list('code', flat=True)
+    Geometry.objects.filter(code__startswith="S", type='lau1').exclude(code__in=list(correctioncodes)).delete()
+    Area.objects.filter(code__startswith="S", type='lau1').exclude(code__in=list(correctioncodes)).delete()
+
+def is_scottish_code(code):
+    """
+    Whether area code is Scottish area code
+    """
+
+    return code[:1] == 'S'
+
+def is_not_scottish_code(code):
+    """
+    Whether area code is not Scottish area code
+    """
+
+    return code[:1] != 'S'
+
+def generategeometries(force=False):
     """
     Generates multiple geometries of boundaries for multiple zoom levels using simplification
+
+    Only source files and features that have changed since last run are regenerated unless force is set
     """
 
     for areatype in subregions:
-        Geometry.objects.filter(type=areatype).delete()
         for areafile in subregions[areatype]:
-            print("Loading area file", areafile)
-            with open(areafile) as f:
-                geojson_codes, topologysafe_codes = [], []
-                yearsuffix = get_yearsuffix_from_filepath(areafile)
-                geometrydata = geojson.load(f)
-
-                # Create a list of all feature codes for entire file
-                for feature in geometrydata['features']:
-                    feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                    if feature_namecode['code']: geojson_codes.append(feature_namecode['code'])
-
-                geometrytopology = tp.Topology(geometrydata)
-
-                # Create a list of all feature codes that topojson processed successfully
-                topologysafefeatures = json.loads(geometrytopology.to_geojson())
-                for feature in topologysafefeatures['features']:
-                    feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                    if feature_namecode['code']: topologysafe_codes.append(feature_namecode['code'])
-
-                # Get difference of feature codes between original file and topojson successfully processed feature codes
-                code_diff = list(set(geojson_codes) - set(topologysafe_codes))
-
-                # Create a custom feature set from the features that topojson failed to process
-                # TODO: investigate why topojson fails on certain polygons
-                diff_features = []
-                for feature in geometrydata['features']:
-                    feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                    if feature_namecode['code'] in code_diff:
-                        diff_features.append(feature)
-
-                print("Number of polygons topojson failed on =", len(diff_features))
-
-                for zoom in range(0, zoomrange + 1):
-
-                    print("Creating identical polygons for all zoom levels for polygons topojson was not able to process", len(diff_features))
-
-                    for feature in diff_features:
-                        feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                        try:
-                            geometry = GEOSGeometry(str(feature['geometry']))
-                            print("Saving geometry for", feature_namecode['code'], "zoom level", zoom)
-                            geometryobject = Geometry(name=feature_namecode['name'], type=areatype, code=feature_namecode['code'], zoom=zoom, geometry=geometry)
-                            geometryobject.save() 
-                        except:
-                            print("Failed to create geometry object - probably too small for zoom level", code, "zoom level", zoom, "degree resolution", zoomepsilon)
-
-                    zoomepsilon = get_degrees_per_pixel(zoom)
-
-                    print("Simplifying", areafile, "for zoom level", zoom, "equivalent to degree resolution", zoomepsilon)
-
-                    simplifiedfeatures = json.loads(geometrytopology.toposimplify(
-                        epsilon=zoomepsilon, 
-                        simplify_algorithm='dp', 
-                        prevent_oversimplify=True
-                    ).to_geojson())
-
-                    for feature in simplifiedfeatures['features']:
-                        feature_namecode = get_feature_name_code(feature['properties'], yearsuffix)
-                        try:
-                            geometry = GEOSGeometry(str(feature['geometry']))
-                            print("Saving geometry for", feature_namecode['code'], "zoom level", zoom, "degree resolution", zoomepsilon)
-                            geometryobject = Geometry(name=feature_namecode['name'], type=areatype, code=feature_namecode['code'], zoom=zoom, geometry=geometry)
-                            geometryobject.save() 
-                        except:
-                            print("Failed to create geometry object - probably too small for zoom level", code, "zoom level", zoom, "degree resolution", zoomepsilon)
-
-    processspecialcases()
+            codefilter = None
+            # Scottish LAU1s are replaced by unitary authorities in processspecialcases
+            if areatype == 'lau1': codefilter = is_not_scottish_code
+            generategeometriesforfile(areafile, areatype, codefilter=codefilter, force=force)
+
+    processspecialcases(force=force)
+    updateareaparents()
+
+def updateareaparents():
+    """
+    Update parent codes of all MSOA/IG and LSOA/DZ areas
+
+    Parent of area is larger area at zoom level 15 containing a point inside the area
+    """
+
+    import shapely
+
+    parenttypes = {'msoa': ['lau1'], 'lsoa': ['lau1', 'msoa']}
+    parentindexes = {}
+    for parenttype in ['lau1', 'msoa']:
+        parents = list(Geometry.objects.filter(zoom=15, type=parenttype, shape__isnull=False).annotate(wkb=AsWKB('shape__geometry')).values_list('code', 'wkb'))
+        parentindexes[parenttype] = ([parent[0] for parent in parents], shapely.STRtree(shapely.from_wkb([bytes(parent[1]) for parent in parents])))
+
+    for areatype in parenttypes:
+        print("Updating parent areas for", areatype)
+        areas = list(Geometry.objects.filter(zoom=15, type=areatype, shape__isnull=False).annotate(point=AsWKB(PointOnSurface('shape__geometry'))).values_list('code', 'point'))
+        points = shapely.from_wkb([bytes(area[1]) for area in areas])
+        parentcodes = [{} for area in areas]
+        for parenttype in parenttypes[areatype]:
+            codes, tree = parentindexes[parenttype]
+            pointindexes, parentgeometryindexes = tree.query(points, predicate='intersects')
+            for pointindex, parentgeometryindex in zip(pointindexes, parentgeometryindexes):
+                parentcodes[pointindex].setdefault(parenttype, codes[parentgeometryindex])
+
+        parentcodes = {area[0]: ' '.join([parents[parenttype] for parenttype in parenttypes[areatype] if parenttype in parents]) for area, parents in zip(areas, parentcodes)}
+        areaobjects = list(Area.objects.filter(type=areatype))
+        for areaobject in areaobjects: areaobject.parentcodes = parentcodes.get(areaobject.code, '')
+        Area.objects.bulk_update(areaobjects, ['parentcodes'], batch_size=1000)
+
+def generateareas():
+    """
+    Regenerate all areas from existing zoom level 15 geometries, eg. for geometries generated before areas were introduced
+    """
+
+    areas = []
+    for geometry in Geometry.objects.filter(zoom=15).annotate(Extent('bbox')).values('code', 'name', 'type', 'bbox__extent'):
+        xmin, ymin, xmax, ymax = geometry['bbox__extent']
+        areas.append(Area(type=geometry['type'], name=geometry['name'], code=geometry['code'], xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax))
+
+    with transaction.atomic():
+        Area.objects.all().delete()
+        Area.objects.bulk_create(areas, batch_size=1000)
+
+    updateareaparents()
+
+    print("Generated", len(areas), "areas")
+
+def get_data_hash(value, meters):
+    """
+    Get fingerprint of data values for single area/year/type, consistent with how values are stored in database
+    """
+
+    valuefield = Data._meta.get_field('value')
+    return format_number(valuefield.to_python(value), valuefield.max_digits, valuefield.decimal_places) + ':' + repr(float(meters))
 
 def importdatabygeometrytype(geometrytype, year, datatype):
     """
     Import data for a specific geometry type and year
+
+    Incoming rows are compared against existing rows and only new, changed or removed rows are written
+    Returns set of geometry codes whose data changed
     """
 
     datatypecode = 'ELEC'
@@ -279,88 +404,276 @@ def importdatabygeometrytype(geometrytype, year, datatype):
         multiplier_meter = 1000
         multiplier_value = 1000000
     filepath = 'BEIS/' + geometry_prefix + '_' + datatypecode + '_' + str(year) + '.csv'
-    Data.objects.filter(geometrytype=geometrytype, year=year, type=datatype).delete()
 
-    count = 0
-    if os.path.isfile(filepath):
-        with open(filepath, 'r' ) as fileobj:
-            reader = csv.DictReader(fileobj)
-            for row in reader:
-                count += 1
-                print("Importing line", count, filepath)
-                geometrycode = row[geometrycode_row].strip()
-                if geometrytype == 'lau1':
-                    if row['Total consumption'] == '..': continue
-                    if row['Total consumption'] == ' -   ': continue
-                    value = float(non_decimal.sub("", row['Total consumption']))
-                    meters = float(row['Total number of meters'])
-                else:            
-                    value = float(row['KWH'])
-                    meters = float(row['METERS'])
-                meters = meters * multiplier_meter
-                value = value * multiplier_value
-                data = Data(
-                    type=datatype,
-                    year=str(year), 
-                    value=value,
-                    meters=meters,
-                    geometrycode=geometrycode,
-                    geometrytype=geometrytype)
-                data.save()
-
-        print("Imported " + geometry_prefix + " for type " + str(datatype) + " for " + str(year))
-    else:
+    if not os.path.isfile(filepath):
         print(filepath, "not found")
+        return set()
+
+    incoming = {}
+    with open(filepath, 'r' ) as fileobj:
+        reader = csv.DictReader(fileobj)
+        for row in reader:
+            geometrycode = row[geometrycode_row].strip()
+            if geometrytype == 'lau1':
+                if row['Total consumption'] == '..': continue
+                if row['Total consumption'] == ' -   ': continue
+                value = float(non_decimal.sub("", row['Total consumption']))
+                meters = float(row['Total number of meters'])
+            else:            
+                value = float(row['KWH'])
+                meters = float(row['METERS'])
+            meters = meters * multiplier_meter
+            value = value * multiplier_value
+            incoming[geometrycode] = (value, meters)
+
+    existing, duplicateids = {}, []
+    for data in Data.objects.filter(geometrytype=geometrytype, year=str(year), type=datatype).values('id', 'geometrycode', 'value', 'meters'):
+        if data['geometrycode'] in existing:
+            duplicateids.append(data['id'])
+            continue
+        existing[data['geometrycode']] = data
+
+    createddata, updateddata, updatedcodes = [], [], set()
+    for geometrycode in incoming:
+        value, meters = incoming[geometrycode]
+        if geometrycode not in existing:
+            createddata.append(Data(type=datatype, year=str(year), value=value, meters=meters, geometrycode=geometrycode, geometrytype=geometrytype))
+        elif get_data_hash(existing[geometrycode]['value'], existing[geometrycode]['meters']) != get_data_hash(value, meters):
+            updateddata.append(Data(id=existing[geometrycode]['id'], value=value, meters=meters))
+            updatedcodes.add(geometrycode)
+
+    removedcodes = set(existing.keys()) - set(incoming.keys())
+    removedids = [existing[geometrycode]['id'] for geometrycode in removedcodes]
+
+    with transaction.atomic():
+        Data.objects.filter(id__in=removedids + duplicateids).delete()
+        Data.objects.bulk_update(updateddata, ['value', 'meters'], batch_size=1000)
+        Data.objects.bulk_create(createddata, batch_size=1000)
+
+    changedcodes = set([data.geometrycode for data in createddata]) | updatedcodes | removedcodes
+
+    print("Imported " + geometry_prefix + " for type " + str(datatype) + " for " + str(year) + ":",
+            len(createddata), "created,", len(updateddata), "updated,", len(removedcodes), "removed,", 
+            len(incoming) - len(createddata) - len(updateddata), "unchanged")
+
+    return changedcodes
 
 def importdata(geometrytype, yearstart, yearend):
     """
     Import data for specify geometry type and year range
+
+    Returns set of geometry codes whose data changed
     """
 
+    from backend.carbonmodel import computeforecasts
+    from backend.rankings import computerankings
+
+    changedcodes = set()
     for year in range(int(yearstart), 1 + int(yearend)):
         print ("Importing data for year", year)
         for datatype in DATATYPES_CHOICES:
-            importdatabygeometrytype(geometrytype, year, datatype[0])
+            changedcodes |= importdatabygeometrytype(geometrytype, year, datatype[0])
+
+    print("Data changed for", len(changedcodes), "areas")
+    if len(changedcodes) > 0:
+        print("Changed areas:", ' '.join(sorted(changedcodes)))
+        print("Updating forecasts for changed areas")
+        computeforecasts(changedcodes)
+        print("Updating rankings for", geometrytype)
+        computerankings([geometrytype])
+
+    return changedcodes
+
+# Rows of BEIS flat file conversion factors used for each fuel, as (Level 1, Level 2, Level 3, Column Text)
+beisfuels = {
+                'electricity':  ('UK electricity', 'Electricity generated', 'Electricity: UK', ''),
+                'gas':          ('Fuels', 'Gaseous fuels', 'Natural gas', 'Gross CV'),
+                'lpg':          ('Fuels', 'Gaseous fuels', 'LPG', 'Gross CV'),
+                'oil':          ('Fuels', 'Liquid fuels', 'Burning oil', 'Gross CV'),
+                'coal':         ('Fuels', 'Solid fuels', 'Coal (domestic)', 'Gross CV'),
+            }
+
+def readconversionfactors(filepath):
+    """
+    Read conversion factors from CSV file as dictionary of {fuel: {year: value}}
+
+    Accepts either BEIS flat file of conversion factors saved as CSV, using kg CO2e per kWh rows of fuels in beisfuels,
+    or CSV file with 'fuel', 'year' and 'value' columns (kg CO2e per kWh)
+    """
 
-def checkgeometries():
+    conversionfactors = {}
+    with open(filepath, 'r', encoding='utf-8-sig') as fileobj:
+        reader = csv.DictReader(fileobj)
+        factorcolumns = [column for column in reader.fieldnames if column.startswith('GHG Conversion Factor')]
+
+        if len(factorcolumns) == 0:
+            for row in reader:
+                conversionfactors.setdefault(row['fuel'].strip().lower(), {})[int(row['year'])] = float(row['value'])
+            return conversionfactors
+
+        year = int(non_decimal.sub("", factorcolumns[0]))
+        for row in reader:
+            if (row['UOM'].strip() != 'kWh') or (row['GHG/Unit'].strip() != 'kg CO2e'): continue
+            levels = (row['Level 1'].strip(), row['Level 2'].strip(), row['Level 3'].strip(), row['Column Text'].strip())
+            for fuel in beisfuels:
+                if levels == beisfuels[fuel]:
+                    conversionfactors.setdefault(fuel, {})[year] = float(row[factorcolumns[0]])
+
+    return conversionfactors
+
+def importconversionfactors(filepath, version=None):
+    """
+    Import conversion factors from file as new version
+
+    New version contains all factors of latest version with factors from file added or replaced
+    Version name defaults to name of file
+    """
+
+    from backend import factors
+
+    if not os.path.isfile(filepath):
+        print(filepath, "not found")
+        return
+
+    if version is None: version = os.path.splitext(os.path.basename(filepath))[0]
+    incoming = readconversionfactors(filepath)
+    if len(incoming) == 0:
+        print("No conversion factors found in", filepath)
+        return
+
+    latestversion = factors.getlatestversion()
+    if latestversion is None: conversionfactors = factors.getdefaultfactors()
+    else: conversionfactors = factors.loadfactors(latestversion)
+
+    for fuel in incoming:
+        conversionfactors.setdefault(fuel, {}).update(incoming[fuel])
+        print("Imported", fuel, "conversion factors for", ', '.join([str(year) for year in sorted(incoming[fuel])]))
+
+    factors.savefactors(version, conversionfactors)
+    print("Saved conversion factors as version", version)
+
+def analysegeometries(reportfile='geometrysizes.json'):
+    """
+    Report bytes sent by /geometries/ per map tile and per viewport for each zoom level and area type
+    Writes machine-readable report
+    """
+
+    from backend import analysis
+
+    results = []
+    for result in analysis.analysegeometries(zoomrange):
+        analysis.printanalysis(result)
+        results.append(result)
+
+    with open(reportfile, 'w') as f:
+        json.dump({'viewport': analysis.viewportsize, 'results': results}, f, indent=2)
+
+    print("Written report to", reportfile)
+
+def precompressstatic(snapshots=True):
+    """
+    Write snapshots of hottest API responses to static folder and precompress all static files for serving by nginx
+    """
+
+    if snapshots:
+        written = precompress.writesnapshots(settings.STATIC_ROOT)
+        print("Written", len(written), "snapshots to", os.path.join(settings.STATIC_ROOT, precompress.snapshotfolder))
+
+    checked, written = precompress.compressfolder(settings.STATIC_ROOT)
+    print("Checked", checked, "static files, written", written, "compressed files")
+
+def exportdata(geometrytype, yearstart, yearend, filepath):
+    """
+    Export recorded and predicted energy use and emissions of all areas of geometry type for year range
+    File format (CSV or Parquet) is determined from file extension
+    """
+
+    from backend.export import streamexport, isformatavailable
+
+    exportformat = os.path.splitext(filepath)[1].lstrip('.').lower()
+    if not isformatavailable(exportformat):
+        print("Unable to export", exportformat, "- use .csv or .parquet file (Parquet export requires pyarrow)")
+        return
+
+    start = time.time()
+    mode = 'wb' if exportformat == 'parquet' else 'w'
+    with open(filepath, mode) as fileobj:
+        for part in streamexport(exportformat, geometrytype, yearstart, yearend):
+            fileobj.write(part)
+
+    print("Exported", geometrytype, "for", yearstart, "to", yearend, "to", filepath, "in", "{:.1f}".format(time.time() - start), "seconds")
+
+def checkgeometries(reportfile='geometryreport.json', processes=None):
     """
     Check to see if any geometries corrupted
+
+    Geometries are checked in parallel for GEOS validity, self-intersections, emptiness and excessive vertex counts
+    and every area code is checked for geometries at all zoom levels
+    Writes machine-readable report and returns number of problems found
+    """
+
+    from backend import validation
+
+    start = time.time()
+    chunks = validation.getchunks(2000)
+
+    problems, checked = validation.checknullshapes()
+
+    # Worker processes must open their own database connections
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        for chunkproblems, chunkchecked in pool.imap_unordered(validation.checkchunk, chunks):
+            problems += chunkproblems
+            checked += chunkchecked
+            print("Checked", checked, "geometries, problems found", len(problems))
+
+    problems += validation.checkzoomlevels(zoomrange)
+
+    summary = {}
+    for problem in problems: summary[problem['check']] = summary.get(problem['check'], 0) + 1
+
+    report = {'checked': checked, 'duration': time.time() - start, 'summary': summary, 'problems': problems}
+    with open(reportfile, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("Checked", checked, "geometries in", "{:.1f}s".format(report['duration']), "- problems:", summary if len(summary) > 0 else "none")
+    print("Report written to", reportfile)
+
+    return len(problems)
+
+def checkreplicas():
+    """
+    Print replication lag of each read replica and whether it is used by API views
     """
 
-    allgeometries = Geometry.objects.all().annotate(json=AsGeoJSON('geometry')).values('name', 'code', 'zoom', 'type', 'json').order_by('code', 'type', 'zoom')
-    for geometry in allgeometries:
-        print("Checking geometry", geometry['code'], geometry['type'], geometry['zoom'])
-        json_data = json.dumps(list(geometry), cls=DjangoJSONEncoder)
+    replicas = routers.getreplicas()
+    if len(replicas) == 0: print("No read replicas configured, set SQL_REPLICA_HOSTS to use read replicas")
 
-def renameduplicateshortcodes():
+    for alias in replicas:
+        host = settings.DATABASES[alias]['HOST'] + ':' + str(settings.DATABASES[alias]['PORT'])
+        try:
+            lag = routers.getreplicalag(alias)
+        except DatabaseError as error:
+            print(alias, host, "unreachable, not used:", str(error).strip())
+            continue
+        print(alias, host, "lag {:.1f}s".format(lag), "used" if lag <= settings.SQL_REPLICA_MAXLAG else "lagging, not used")
+
+def deduplicateshortcodes(locations):
     """
-    Runs custom piece of SQL to rename duplicate shortcodes in location table
+    Rename shortcodes shared by more than one location by appending location's county
     """
 
-    cursor = connection.cursor()
-    cursor.execute("""
-    UPDATE backend_location  
-    SET shortcode = CONCAT(shortcode, REPLACE(LOWER(county), ' ', '')) 
-    WHERE shortcode IN 
-    (
-        SELECT s.shortcode 
-        FROM 
-        (
-            SELECT shortcode,COUNT(*) AS num 
-            FROM backend_location GROUP BY shortcode
-        ) AS s 
-        WHERE s.num > 1
-    );
-    """, [])
-    transaction.commit()
+    counts = {}
+    for location in locations: counts[location.shortcode] = counts.get(location.shortcode, 0) + 1
+    for location in locations:
+        if counts[location.shortcode] > 1: location.shortcode = location.shortcode + location.county.lower().replace(' ', '')
 
 def computescale(population):
     """
     Computes appropriate scale to show locations with specific population
     """
 
-    if population == '': population = 0
-    population = int(population)
+    if population is None: population = 0
 
     if population < 20000: return 15
     if population < 40000: return 14.5
@@ -375,77 +688,227 @@ def computescale(population):
 
     return 10
 
+def parsenumber(text, numbertype):
+    """
+    Convert text to number of particular type, or None if text is blank
+    """
+
+    text = text.strip().replace(',', '')
+    if text == '': return None
+    return numbertype(text)
+
 def importlocations():
     """
     Imports location data from file that is used to geolocate specific locations
+
+    All locations are built in memory and replace existing locations in single transaction
     """
 
+    locations = []
     with open('Towns_List_Extended.csv') as csvfile:
         reader = csv.DictReader(csvfile)
-        count = 0
-        Location.objects.all().delete()
         for row in reader:
             shortcode = row['Town'].lower()
             shortcode = re.sub("[ ]", "", shortcode)
-            scale = computescale(row['Population'])
-            p = Location(   shortcode=shortcode, 
-                            town=row['Town'], 
-                            county=row['County'], 
-                            country=row['Country'], 
-                            population=row['Population'], 
-                            longitude=row['Longitude'], 
-                            latitude=row['Latitude'], 
-                            url=row['url'],
-                            scale=scale)
-            p.save()
-            count += 1
-
-    renameduplicateshortcodes()
-
-    print("Import locations finished, imported: " + str(count))
-
-if len(sys.argv) == 1:
-    print("""
+            population = parsenumber(row['Population'], int)
+            longitude, latitude = parsenumber(row['Longitude'], float), parsenumber(row['Latitude'], float)
+            location = None
+            if (longitude is not None) and (latitude is not None): location = Point(longitude, latitude)
+            locations.append(Location( shortcode=shortcode, 
+                                        town=row['Town'], 
+                                        county=row['County'], 
+                                        country=row['Country'], 
+                                        population=population, 
+                                        longitude=longitude, 
+                                        latitude=latitude, 
+                                        url=row['url'],
+                                        scale=computescale(population),
+                                        location=location))
+
+    deduplicateshortcodes(locations)
+
+    with transaction.atomic():
+        Location.objects.all().delete()
+        Location.objects.bulk_create(locations, batch_size=1000)
+
+    print("Import locations finished, imported: " + str(len(locations)))
+
+def importpostcodes(filepath):
+    """
+    Imports postcode coordinates used to geocode postcodes locally, replacing existing postcodes
+
+    Accepts ONS Postcode Directory CSV ('pcds', 'lat', 'long' columns) or CSV with 'postcode', 'latitude', 'longitude' columns
+    """
+
+    from backend.geocode import normalisepostcode
+
+    if not os.path.isfile(filepath):
+        print(filepath, "not found")
+        return
+
+    postcodes, seen = [], set()
+    with open(filepath, 'r', encoding='utf-8-sig') as csvfile:
+        reader = csv.DictReader(csvfile)
+        postcodefield, latitudefield, longitudefield = ('pcds', 'lat', 'long') if 'pcds' in reader.fieldnames else ('postcode', 'latitude', 'longitude')
+        for row in reader:
+            postcode = normalisepostcode(row[postcodefield])
+            latitude, longitude = float(row[latitudefield]), float(row[longitudefield])
+            # ONS Postcode Directory uses latitude of 99.999999 for postcodes without coordinates
+            if (postcode in seen) or (abs(latitude) > 90): continue
+            seen.add(postcode)
+            postcodes.append(Postcode(postcode=postcode, latitude=latitude, longitude=longitude))
+
+    with transaction.atomic():
+        Postcode.objects.all().delete()
+        Postcode.objects.bulk_create(postcodes, batch_size=5000)
+
+    print("Import postcodes finished, imported: " + str(len(postcodes)))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 1:
+        print("""
 ****** Carbon Map Batch Processing *******
 
 Possible arguments are:
 
-checkgeometries
-  Check whether any geometries are corrupted
+checkgeometries [reportfile]
+  Check whether any geometries are corrupted, invalid, self-intersecting, have too many vertices or are missing zoom levels
+  Writes JSON report to [reportfile], default 'geometryreport.json', and exits with error status if problems found
 
 importlocations
   Imports location data from file that is used to geolocate specific locations
 
-generategeometries
+importpostcodes [file]
+  Imports postcode coordinates from ONS Postcode Directory CSV file used to geocode postcodes without remote API
+
+generategeometries [force]
   Generates multiple geometries of boundaries for multiple zoom levels using simplification
+  Only boundary files and features that have changed since last run are regenerated unless 'force' is given
+  Interrupted runs resume from last completed zoom level when rerun
 
-processspecialcases
+processspecialcases [force]
   Perform additional ad-hoc processing
 
+analysegeometries [reportfile]
+  Reports bytes per map tile and per viewport for each zoom level and area type
+  and writes report to [reportfile], defaults to geometrysizes.json
+
+generateareas
+  Regenerates area names, bounds and parent areas from existing geometries
+
 importdata [lsoa/msoa/lau1] [yearstart] [yearend]
   Imports data for specific area scale and year range (assuming BEIS data)
   Leaving off [yearend] will only import for [yearstart]
+  Forecasts are updated for areas whose data changed and rankings for area scale
+
+computeforecasts
+  Precomputes forecasts for all areas from existing data
+
+computerankings
+  Precomputes rankings of all areas by energy use and energy use per meter from existing data
+
+precompress [nosnapshots]
+  Writes snapshots of national-zoom LAU1 geometries to static folder
+  and writes gzip versions of all static files for nginx to serve directly
+  Rerun after collectstatic, 'nosnapshots' only compresses static files
+  Snapshots are refreshed automatically by generategeometries and processspecialcases
+
+export [lsoa/msoa/lau1] [yearstart] [yearend] [file]
+  Exports recorded and predicted energy use and emissions of all areas for year range
+  File format is CSV or Parquet depending on file extension, eg. lsoa.csv or lsoa.parquet
+
+pipeline [yearstart] [yearend]
+  Runs full import of locations, geometries and data for year range as stages, running independent stages in parallel
+  Records status, timing and row count of each stage in pipeline.json
+
+pipeline resume
+  Resumes last pipeline, rerunning only stages that did not complete
+
+checkreplicas
+  Prints replication lag of each read replica set by SQL_REPLICA_HOSTS and whether API views use it
+
+profiletoken [hours]
+  Prints signed token that enables profiling of requests sending it in 'X-Profile-Token' header
+  Token expires after [hours], default 24
+
+importconversionfactors [file] [version]
+  Imports GHG conversion factors from BEIS flat file (saved as CSV) or CSV with fuel, year, value columns
+  Saved as new version containing all existing factors plus those in file, named [version] or file name
 """)
 
-else:
-    primaryargument = sys.argv[1]
-
-    if primaryargument == "checkgeometries":
-        checkgeometries()
-    if primaryargument == "importlocations":
-        importlocations()
-    if primaryargument == "generategeometries":
-        generategeometries()
-    if primaryargument == "processspecialcases":
-        processspecialcases()
-    if primaryargument == "importdata":
-        if len(sys.argv) >= 4:
-            yearstart = sys.argv[3]
-            yearend = yearstart
-            if len(sys.argv) == 5: yearend = sys.argv[4]
-            geometrytype = sys.argv[2]
-            importdata(geometrytype, yearstart, yearend)    
-        else:
-            print("Not enough arguments provided for importdata. Format is importdata lsoa/msoa/lau1 yearstart yearend")
+    else:
+        primaryargument = sys.argv[1]
+
+        if primaryargument == "checkgeometries":
+            reportfile = 'geometryreport.json'
+            if len(sys.argv) >= 3: reportfile = sys.argv[2]
+            if checkgeometries(reportfile) > 0: sys.exit(1)
+        if primaryargument == "analysegeometries":
+            reportfile = 'geometrysizes.json'
+            if len(sys.argv) >= 3: reportfile = sys.argv[2]
+            analysegeometries(reportfile)
+        if primaryargument == "importlocations":
+            importlocations()
+        if primaryargument == "importpostcodes":
+            if len(sys.argv) >= 3: importpostcodes(sys.argv[2])
+            else: print("No file provided for importpostcodes. Format is importpostcodes file")
+        force = (len(sys.argv) >= 3) and (sys.argv[2] == "force")
+        if primaryargument == "generategeometries":
+            generategeometries(force=force)
+            precompressstatic()
+        if primaryargument == "processspecialcases":
+            processspecialcases(force=force)
+            precompressstatic()
+        if primaryargument == "generateareas":
+            generateareas()
+        if primaryargument == "computeforecasts":
+            from backend.carbonmodel import computeforecasts
+            computeforecasts()
+            print("Computed forecasts")
+        if primaryargument == "computerankings":
+            from backend.rankings import computerankings
+            computerankings()
+            print("Computed rankings")
+        if primaryargument == "precompress":
+            precompressstatic(snapshots=not ((len(sys.argv) >= 3) and (sys.argv[2] == "nosnapshots")))
+        if primaryargument == "export":
+            if len(sys.argv) == 6:
+                exportdata(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+            else:
+                print("Wrong arguments provided for export. Format is export lsoa/msoa/lau1 yearstart yearend file")
+        if primaryargument == "pipeline":
+            from backend.pipeline import runpipeline
+            if (len(sys.argv) >= 3) and (sys.argv[2] == "resume"):
+                if runpipeline(resume=True) > 0: sys.exit(1)
+            elif len(sys.argv) >= 3:
+                yearstart = sys.argv[2]
+                yearend = yearstart
+                if len(sys.argv) >= 4: yearend = sys.argv[3]
+                if runpipeline(yearstart, yearend) > 0: sys.exit(1)
+            else:
+                print("Not enough arguments provided for pipeline. Format is pipeline yearstart [yearend] or pipeline resume")
+        if primaryargument == "checkreplicas":
+            checkreplicas()
+        if primaryargument == "profiletoken":
+            hours = 24
+            if len(sys.argv) >= 3: hours = float(sys.argv[2])
+            print(profiling.createtoken(hours))
+        if primaryargument == "importconversionfactors":
+            if len(sys.argv) >= 3:
+                version = None
+                if len(sys.argv) >= 4: version = sys.argv[3]
+                importconversionfactors(sys.argv[2], version)
+            else:
+                print("No file provided for importconversionfactors. Format is importconversionfactors file [version]")
+        if primaryargument == "importdata":
+            if len(sys.argv) >= 4:
+                yearstart = sys.argv[3]
+                yearend = yearstart
+                if len(sys.argv) == 5: yearend = sys.argv[4]
+                geometrytype = sys.argv[2]
+                importdata(geometrytype, yearstart, yearend)    
+            else:
+                print("Not enough arguments provided for importdata. Format is importdata lsoa/msoa/lau1 yearstart yearend")
 
 
@@ -0,0 +1,94 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+backend/validation.py
+Validation of generated geometries
+
+Shapes are read in chunks of ids and each chunk is checked in separate worker process using
+GEOS validity, self-intersection and vertex-count checks. Shapes shared by several geometries,
+eg. same area at several zoom levels, are checked once.
+"""
+
+import shapely
+from django.db.models import Count, Max, Min
+from django.contrib.gis.db.models.functions import AsWKB
+from django.contrib.postgres.aggregates import ArrayAgg
+
+from .models import Geometry, Shape
+
+# Maximum number of vertices allowed in single geometry at each zoom level
+# Higher zoom levels are allowed more vertices as less of each geometry is visible at once
+maxvertices = {zoom: 5000 * (2 ** max(0, zoom - 8)) for zoom in range(0, 16)}
+
+def getchunks(chunksize):
+    """
+    Get list of (start, end) id ranges covering whole Shape table
+    """
+
+    bounds = Shape.objects.aggregate(Min('id'), Max('id'))
+    if bounds['id__min'] is None: return []
+    return [(start, start + chunksize) for start in range(bounds['id__min'], bounds['id__max'] + 1, chunksize)]
+
+def checkchunk(idrange):
+    """
+    Check all shapes with ids within range and geometries using them, returning list of problems found and number of geometries checked
+    Each shape is validated once, however many geometries share it, and its problems reported for each of those geometries
+
+    Run in worker process, each of which opens its own database connection
+    """
+
+    start, end = idrange
+    shapes = list(Shape.objects.filter(id__gte=start, id__lt=end, geometry__isnull=False).annotate(wkb=AsWKB('geometry')).values_list('id', 'wkb'))
+    rows = list(Geometry.objects.filter(shape_id__gte=start, shape_id__lt=end).values_list('id', 'code', 'type', 'zoom', 'shape_id'))
+    if len(rows) == 0: return [], 0
+
+    geometries = shapely.from_wkb([bytes(shape[1]) for shape in shapes])
+    shapeindex = {shape[0]: index for index, shape in enumerate(shapes)}
+    reasons = shapely.is_valid_reason(geometries)
+    empty = shapely.is_empty(geometries)
+    vertices = shapely.get_num_coordinates(geometries)
+
+    problems = []
+    for row in rows:
+        problem = {'id': row[0], 'code': row[1], 'type': row[2], 'zoom': row[3]}
+        index = shapeindex.get(row[4])
+        if index is None:
+            problems.append(dict(problem, check='null'))
+            continue
+        if empty[index]:
+            problems.append(dict(problem, check='empty'))
+        elif reasons[index].startswith('Self-intersection'):
+            problems.append(dict(problem, check='selfintersection', reason=reasons[index]))
+        elif reasons[index] != 'Valid Geometry':
+            problems.append(dict(problem, check='invalid', reason=reasons[index]))
+        if vertices[index] > maxvertices.get(row[3], maxvertices[15]):
+            problems.append(dict(problem, check='vertices', vertices=int(vertices[index])))
+
+    return problems, len(rows)
+
+def checknullshapes():
+    """
+    Check every geometry has shape, returning list of problems found and number of geometries checked
+    """
+
+    rows = list(Geometry.objects.filter(shape__isnull=True).values_list('id', 'code', 'type', 'zoom'))
+    return [{'check': 'null', 'id': row[0], 'code': row[1], 'type': row[2], 'zoom': row[3]} for row in rows], len(rows)
+
+def checkzoomlevels(zoomrange):
+    """
+    Check every area code has geometry at every zoom level from 0 to zoomrange
+    Returns list of problems found
+    """
+
+    incomplete = Geometry.objects.values('type', 'code') \
+        .annotate(count=Count('zoom', distinct=True), zooms=ArrayAgg('zoom', distinct=True)).filter(count__lt=zoomrange + 1)
+
+    problems = []
+    for area in incomplete:
+        missing = [zoom for zoom in range(0, zoomrange + 1) if zoom not in area['zooms']]
+        problems.append({'check': 'zoomlevels', 'code': area['code'], 'type': area['type'], 'missing': missing})
+
+    return problems
@@ -9,26 +9,41 @@ Django views for rendering default React page and delivering data to frontend
 """
 
 import json
-import re
+import numpy as np
 
 from django.shortcuts import render
 from django.contrib.gis.geos import Polygon
-from django.contrib.gis.db.models import Extent
-from django.core.serializers import serialize
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.gis.db.models.functions import AsGeoJSON
 from django.core.serializers.json import DjangoJSONEncoder
-from rest_framework import serializers
-from ukpostcodeutils import validation
 
-from .models import Location, Geometry
-from .carbonmodel import retrievecarbondata
-from .gis import get_postcode_point
+from .models import Geometry, Profile
+from .carbonmodel import retrievecarbondata, getstore, MODELS, TRAJECTORIES, FUELS
+from .areas import getarea
+from .coalesce import coalesce, getkey
+from .profiling import sessionkey as profilesessionkey
+from .routers import readreplica
 
 # Array of geometry type codes used to determine numerical geometry type to send back to server, ie. 1, 2, or 3
 geometrytypecode = ['lau1', 'msoa', 'lsoa']
 
+# Maximum number of points in single batch lookup
+maxlookuppoints = 100000
+
+# Maximum number of locations in single batch geocoding
+maxgeocodelocations = 100000
+
+# Earliest and latest years that can be exported
+exportyears = (2000, 2100)
+
+# Maximum number of areas in single page of rankings
+maxrankinglimit = 1000
+
+# Content types of export formats
+exportcontenttypes = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
 def home(request):
     """
     Shows default home page or other frontend-specific pages to be rendered by frontend React app
@@ -36,9 +51,15 @@ def home(request):
     return render(request, 'index.html')
 
 @csrf_exempt
+@readreplica
 def Geometries(request):
     """
     Get all geometries within boundary box for particular zoom level
+
+    If client provides 'previous' boundary box of its last request for same zoom level and type,
+    only geometries not within previous boundary box are returned, as client already holds the others.
+    Response is then {'delta': true, 'features': [...], 'evict': [...]} where 'evict' lists codes
+    of geometries within previous boundary box but not current one, which client can discard.
     """
 
     data = json.loads(request.body)
@@ -48,14 +69,30 @@ def Geometries(request):
     # print(type, zoom, xmin, ymin, xmax, ymax)
 
     bbox = (xmin, ymin, xmax, ymax)
-    geometry = Polygon.from_bbox(bbox)
+    previous = data.get('previous')
+
+    def compute():
+        geometry = Polygon.from_bbox(bbox)
+        geometries = Geometry.objects.filter(zoom=zoom, type=type)
+
+        if previous is None:
+            allfeatures = geometries.filter(bbox__bboverlaps=geometry).annotate(json=AsGeoJSON('shape__geometry')).values('name', 'code', 'type', 'json')
+            return json.dumps(list(allfeatures), cls=DjangoJSONEncoder)
+
+        previousgeometry = Polygon.from_bbox((previous['xmin'], previous['ymin'], previous['xmax'], previous['ymax']))
+        newfeatures = geometries.filter(bbox__bboverlaps=geometry).exclude(bbox__bboverlaps=previousgeometry).annotate(json=AsGeoJSON('shape__geometry')).values('name', 'code', 'type', 'json')
+        evictedcodes = geometries.filter(bbox__bboverlaps=previousgeometry).exclude(bbox__bboverlaps=geometry).values_list('code', flat=True)
+        return json.dumps({'delta': True, 'features': list(newfeatures), 'evict': list(evictedcodes)}, cls=DjangoJSONEncoder)
 
-    allfeatures = Geometry.objects.filter(zoom=zoom, type=type, geometry__bboverlaps=geometry).annotate(json=AsGeoJSON('geometry')).values('name', 'code', 'type', 'json')
-    json_data = json.dumps(list(allfeatures), cls=DjangoJSONEncoder)
+    # Identical concurrent requests, eg. national view when many users arrive at once, share single query
+    # Delta requests depend on each user's previous view so rarely match and are computed directly
+    if previous is not None: json_data = compute()
+    else: json_data = coalesce(getkey('geometries', type, zoom, bbox), compute)
 
     return HttpResponse(json_data, content_type="text/json")
 
 @csrf_exempt
+@readreplica
 def Data(request):
     """
     Get data and properties of particular area
@@ -64,47 +101,226 @@ def Data(request):
     data = json.loads(request.body)
     result = {'result': 'failure'}
     periodstart, periodend, area = data['periodstart'], data['periodend'], data['area']
+    model, trajectory = data.get('model', 'linear'), data.get('trajectory', 'linear')
 
-    if periodstart is not None and periodend is not None and area is not None:
-        data = retrievecarbondata(periodstart, periodend, area)
-        geometry = Geometry.objects.filter(zoom=15, code=area).values('name', 'type').first()
-        geometrytype = 1 + geometrytypecode.index(geometry['type'])
-        area = {'name': geometry['name'], 'code': area, 'type': geometry['type'], 'geometrytype': geometrytype}
-        result = {'result': 'success', 'area': area, 'data': data}
+    if periodstart is not None and periodend is not None and area is not None and model in MODELS and trajectory in TRAJECTORIES:
+        areaattributes = getarea(area)
+        if areaattributes is not None:
+            def compute():
+                data = retrievecarbondata(periodstart, periodend, area, model, trajectory)
+                geometrytype = 1 + geometrytypecode.index(areaattributes['type'])
+                areaproperties = {'name': areaattributes['name'], 'code': area, 'type': areaattributes['type'], 'geometrytype': geometrytype}
+                return json.dumps({'result': 'success', 'area': areaproperties, 'data': data})
+
+            return HttpResponse(coalesce(getkey('data', periodstart, periodend, area, model, trajectory), compute), content_type="text/json-comment-filtered")
 
     return HttpResponse(json.dumps(result), content_type="text/json-comment-filtered")
 
 @csrf_exempt
+@readreplica
+def Lookup(request):
+    """
+    Get codes of areas of every type containing point
+
+    GET with 'lat' and 'lng' looks up single point
+    POST with JSON {'points': [[lng, lat], ...]} looks up batch of points, returning list of results in same order
+    """
+
+    from .lookup import lookuppoint, lookuppoints
+
+    result = {'result': 'failure'}
+
+    if request.method == 'POST':
+        body = json.loads(request.body)
+        points = body.get('points') if isinstance(body, dict) else None
+        if isinstance(points, list) and (len(points) <= maxlookuppoints):
+            try:
+                coordinates = np.array(points, dtype=np.float64).reshape(-1, 2)
+            except (TypeError, ValueError):
+                coordinates = None
+            if coordinates is not None:
+                codes = lookuppoints(coordinates[:, 0], coordinates[:, 1])
+                data = [{areatype: codes[areatype][index] for areatype in codes} for index in range(len(coordinates))]
+                result = {'result': 'success', 'data': data}
+    else:
+        try:
+            lng, lat = float(request.GET.get('lng')), float(request.GET.get('lat'))
+        except (TypeError, ValueError):
+            lng, lat = None, None
+        if lng is not None:
+            result = {'result': 'success', 'data': lookuppoint(lng, lat)}
+
+    return HttpResponse(json.dumps(result), content_type="text/json")
+
+@staff_member_required
+@readreplica
+def Export(request):
+    """
+    Stream recorded and predicted energy use and emissions of all areas of particular type as CSV or Parquet file, staff only
+    Each export reads every area of type, so files for public download are written offline with 'tools.py export'
+    """
+
+    from .export import streamexport, isformatavailable
+
+    geometrytype = request.GET.get('geometrytype', '')
+    exportformat = request.GET.get('format', 'csv')
+    model, trajectory = request.GET.get('model', 'linear'), request.GET.get('trajectory', 'linear')
+    try:
+        yearstart = int(request.GET.get('yearstart', ''))
+        yearend = int(request.GET.get('yearend', yearstart))
+    except ValueError:
+        yearstart, yearend = None, None
+
+    if  (geometrytype not in geometrytypecode) or (yearstart is None) or (exportyears[0] > yearstart) or (yearstart > yearend) or (yearend > exportyears[1]) or \
+        (model not in MODELS) or (trajectory not in TRAJECTORIES) or (not isformatavailable(exportformat)):
+        return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=400)
+
+    response = StreamingHttpResponse(streamexport(exportformat, geometrytype, yearstart, yearend, model, trajectory), content_type=exportcontenttypes[exportformat])
+    filename = 'opencarbonmap-' + geometrytype + '-' + str(yearstart) + '-' + str(yearend) + '.' + exportformat
+    response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    return response
+
+@readreplica
+def Rankings(request):
+    """
+    Get areas of particular type ranked by recorded energy use or energy use per meter for fuel and year
+
+    GET with 'geometrytype', 'year', 'fuel' and 'metric' ('total' or 'permeter') returns page of areas, largest first,
+    starting at 'offset' (default 0) with up to 'limit' areas (default 100)
+    Adding 'area' returns rank and percentile of single area instead
+    """
+
+    from .rankings import gettopareas, getarearanking, METRICS
+
+    geometrytype, fuel, metric, area = request.GET.get('geometrytype', ''), request.GET.get('fuel', ''), request.GET.get('metric', 'total'), request.GET.get('area')
+    try:
+        year = int(request.GET.get('year', ''))
+        offset, limit = int(request.GET.get('offset', 0)), int(request.GET.get('limit', 100))
+    except ValueError:
+        year = None
+
+    if (geometrytype not in geometrytypecode) or (fuel not in FUELS) or (metric not in METRICS) or (year is None) or (offset < 0) or not (0 < limit <= maxrankinglimit):
+        return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=400)
+
+    if area is not None: ranking = getarearanking(geometrytype, area, year, fuel, metric)
+    else: ranking = gettopareas(geometrytype, year, fuel, metric, offset, limit)
+
+    if ranking is None: return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=404)
+    ranking.update({'result': 'success', 'geometrytype': geometrytype, 'year': year, 'fuel': fuel, 'metric': metric})
+    return HttpResponse(json.dumps(ranking), content_type="text/json")
+
+@readreplica
+def Changes(request):
+    """
+    Get change in emissions of all areas of particular type between two years, which may be predicted years
+
+    GET with 'geometrytype', 'yearfrom' and 'yearto', and optionally 'model', 'trajectory' and bounding box
+    'xmin', 'ymin', 'xmax', 'ymax' to only include areas overlapping it
+    Returns area codes and base64-encoded typed arrays of emissions in each year, change and percentage change, see changes.getchanges
+    """
+
+    from .changes import getchanges
+
+    geometrytype = request.GET.get('geometrytype', '')
+    model, trajectory = request.GET.get('model', 'linear'), request.GET.get('trajectory', 'linear')
+    try:
+        yearfrom, yearto = int(request.GET.get('yearfrom', '')), int(request.GET.get('yearto', ''))
+        bbox = [request.GET.get(name) for name in ['xmin', 'ymin', 'xmax', 'ymax']]
+        bbox = None if all([value is None for value in bbox]) else tuple([float(value) for value in bbox])
+    except (TypeError, ValueError):
+        yearfrom, yearto, bbox = None, None, None
+
+    if  (geometrytype not in geometrytypecode) or (yearfrom is None) or not (exportyears[0] <= yearfrom <= exportyears[1]) or \
+        not (exportyears[0] <= yearto <= exportyears[1]) or (model not in MODELS) or (trajectory not in TRAJECTORIES):
+        return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=400)
+
+    # Changes are only calculated from precomputed forecasts, as calculating all areas from Data table would be slow
+    if getstore() is None: return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=404)
+
+    def compute():
+        changes = getchanges(geometrytype, yearfrom, yearto, model, trajectory, bbox)
+        changes.update({'result': 'success', 'geometrytype': geometrytype, 'yearfrom': yearfrom, 'yearto': yearto, 'model': model, 'trajectory': trajectory})
+        return json.dumps(changes)
+
+    json_data = coalesce(getkey('changes', geometrytype, yearfrom, yearto, model, trajectory, bbox), compute)
+    return HttpResponse(json_data, content_type="text/json")
+
+@csrf_exempt
+@readreplica
 def GeometryBounds(request):
     """
     Get bounds of particular area
     """
 
     data = json.loads(request.body)
-    area = Geometry.objects.filter(zoom=15, code=data['areacode']).annotate(Extent('geometry')).values('type', 'geometry__extent').first()
+    area = getarea(data['areacode'])
+    if area is None: return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=404)
     geometrytype = 1 + geometrytypecode.index(area['type'])
-    return HttpResponse(json.dumps({'geometrytype': geometrytype, 'rect': area['geometry__extent']}), content_type="text/json")
+    return HttpResponse(json.dumps({'geometrytype': geometrytype, 'rect': area['bounds']}), content_type="text/json")
 
 @csrf_exempt
+@readreplica
 def LocationPosition(request):
     """
     Get coordinates for location or postcode
     """
 
+    from .geocode import geocode
+
     locationtext = request.GET.get('location').strip()
 
-    location, zoom, result = None, 15, {'result': 'failure'}
-    postcodetext = re.sub("[^0-9a-zA-Z]+", "", locationtext).upper()   
+    result = {'result': 'failure'}
+    location = geocode([locationtext], includeareas=False)[0]
+    if location['result'] == 'success':
+        result = {'result': 'success', 'data': {'lat': location['lat'], 'lng': location['lng'], 'zoom': location['zoom']}}
 
-    if validation.is_valid_postcode(postcodetext):
-        location = get_postcode_point(postcodetext)
-    else:
-        locationrecord = Location.objects.filter(town__iexact=locationtext).first()
-        if (locationrecord is not None):
-            location = locationrecord.location
-            zoom = locationrecord.scale
+    return HttpResponse(json.dumps(result), content_type="text/json-comment-filtered")
 
-    if location:
-        result = {'result': 'success', 'data': {'lat': location[1], 'lng': location[0], 'zoom': zoom}}
+@csrf_exempt
+@readreplica
+def LocationPositions(request):
+    """
+    Get coordinates and containing area codes for list of locations or postcodes
 
-    return HttpResponse(json.dumps(result), content_type="text/json-comment-filtered")
+    POST with JSON {'locations': [...]} returns list of results in same order
+    """
+
+    from .geocode import geocode
+
+    result = {'result': 'failure'}
+    body = json.loads(request.body)
+    locations = body.get('locations') if isinstance(body, dict) else None
+    if isinstance(locations, list) and (len(locations) <= maxgeocodelocations):
+        result = {'result': 'success', 'data': geocode(locations)}
+
+    return HttpResponse(json.dumps(result), content_type="text/json")
+
+@staff_member_required
+def Profiles(request):
+    """
+    List most recent request profiles, staff only
+
+    'enable' of 1 or 0 turns profiling of all requests of current staff user on or off
+    """
+
+    if request.GET.get('enable') is not None: request.session[profilesessionkey] = (request.GET.get('enable') == '1')
+
+    fields = ['id', 'created', 'method', 'path', 'reason', 'duration', 'querytime', 'samples']
+    profiles = list(Profile.objects.order_by('-id').values(*fields)[:100])
+    result = {'result': 'success', 'enabled': request.session.get(profilesessionkey, False), 'data': profiles}
+    return HttpResponse(json.dumps(result, cls=DjangoJSONEncoder), content_type="text/json")
+
+@staff_member_required
+def ProfileDownload(request, profileid, part):
+    """
+    Download folded stacks (for flamegraph.pl or speedscope) or SQL query timings of request profile, staff only
+    """
+
+    profile = Profile.objects.filter(id=profileid).first()
+    if profile is None: return HttpResponse(json.dumps({'result': 'failure'}), content_type="text/json", status=404)
+
+    if part == 'stacks': response = HttpResponse(profile.stacks, content_type="text/plain")
+    else: response = HttpResponse(profile.queries, content_type="text/json")
+    extension = {'stacks': '.folded', 'queries': '.json'}[part]
+    response['Content-Disposition'] = 'attachment; filename="profile-' + str(profile.id) + '-' + part + extension + '"'
+    return response
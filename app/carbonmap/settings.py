@@ -9,7 +9,9 @@ Loads environment variables from environment files ('.env', '.env.dev', '.env.pr
 """
 
 import os
+import importlib.util
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 from pathlib import Path  # Python 3.6+ only
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -63,8 +65,12 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'backend.profiling.ProfilingMiddleware',
 ]
 
+# Profile 1 in PROFILE_SAMPLE_RATE requests, see backend/profiling.py. 0 only profiles requests with profiling token or from staff who enable it
+PROFILE_SAMPLE_RATE = int(os.environ.get("PROFILE_SAMPLE_RATE", default=0))
+
 ROOT_URLCONF = 'carbonmap.urls'
 
 TEMPLATES = [
@@ -100,6 +106,41 @@ DATABASES = {
     }
 }
 
+# Read replicas used by read-only API views, see backend/routers.py
+# SQL_REPLICA_HOSTS is space-separated list of 'host' or 'host:port', each using same database name, user and password as primary
+# Replicas lagging behind primary by more than SQL_REPLICA_MAXLAG seconds are not used
+
+for index, replicahost in enumerate(os.environ.get("SQL_REPLICA_HOSTS", "").split()):
+    host, port = (replicahost.split(':', 1) + [DATABASES['default']['PORT']])[:2]
+    DATABASES['replica' + str(index + 1)] = dict(DATABASES['default'], HOST=host, PORT=port, OPTIONS={'connect_timeout': 5}, TEST={'MIRROR': 'default'})
+
+SQL_REPLICA_MAXLAG = float(os.environ.get("SQL_REPLICA_MAXLAG", default=5))
+
+DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+
+# Caches
+# Shared cache is used to coalesce identical heavy requests across workers, see backend/coalesce.py
+# Disabled unless COALESCE_CACHE_LOCATION is set to memcached 'host:port', which requires optional python-memcached package
+# Whole responses are stored, so memcached must allow large items, eg. 'memcached -I 16m'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+COALESCE_CACHE_LOCATION = os.environ.get("COALESCE_CACHE_LOCATION", default="")
+
+if COALESCE_CACHE_LOCATION:
+    if importlib.util.find_spec('memcache') is None:
+        raise ImproperlyConfigured("COALESCE_CACHE_LOCATION is set but python-memcached is not installed - install it with 'pip install python-memcached' or unset COALESCE_CACHE_LOCATION")
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': COALESCE_CACHE_LOCATION,
+    }
+
+COALESCE_ACROSS_WORKERS = 'shared' in CACHES
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -28,5 +28,13 @@ urlpatterns = [
     path('geometries/', views.Geometries, name='geometries'),
     path('geometrybounds/', views.GeometryBounds, name='geometrybounds'),
     path('locationposition', views.LocationPosition, name='locationposition'),
+    path('locationpositions/', views.LocationPositions, name='locationpositions'),
     path('data/', views.Data, name='data'),
+    path('export/', views.Export, name='export'),
+    path('lookup/', views.Lookup, name='lookup'),
+    path('rankings/', views.Rankings, name='rankings'),
+    path('changes/', views.Changes, name='changes'),
+    path('profiles/', views.Profiles, name='profiles'),
+    path('profiles/<int:profileid>/stacks/', views.ProfileDownload, {'part': 'stacks'}, name='profilestacks'),
+    path('profiles/<int:profileid>/queries/', views.ProfileDownload, {'part': 'queries'}, name='profilequeries'),
 ]
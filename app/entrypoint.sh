@@ -1,5 +1,8 @@
 #!/bin/sh
 
+# Stop if any startup task fails, rather than serving site with missing tables or static files
+set -e
+
 # If using postgres, then wait for it to start
 if [ "$DATABASE" = "postgres" ]
 then
@@ -15,7 +18,6 @@ fi
 # Once postgres (or non-postgres) db is ready, run a once-only series of tasks
 CONTAINER_ALREADY_STARTED="CONTAINER_ALREADY_STARTED_PLACEHOLDER"
 if [ ! -e $CONTAINER_ALREADY_STARTED ]; then
-    touch $CONTAINER_ALREADY_STARTED
     echo "-- First container startup --"
 
     # Apply database migrations
@@ -30,6 +32,14 @@ if [ ! -e $CONTAINER_ALREADY_STARTED ]; then
     # Import locations
     echo "Import locations"
     python3 backend/tools.py importlocations
+
+    # Write snapshots of API responses and precompress static files for nginx, once tables exist
+    # Import tools refresh both when geometries change
+    echo "Precompress static files"
+    python3 backend/tools.py precompress
+
+    # Only mark container as started once every task has succeeded, so failed tasks are retried on restart
+    touch $CONTAINER_ALREADY_STARTED
 else
     echo "-- Not first container startup --"
 fi
@@ -11,7 +11,64 @@
  * Actions for map redux object
  */ 
 
-import { API_URL } from "../constants";
+import { API_URL, SNAPSHOT_URL, ZOOM_SHOWLEVEL_2, WORLD_BOUNDS } from "../constants";
+
+/**
+ * requestGeometries
+ * 
+ * Requests geometry data for map view
+ * National-zoom Local Authority geometries are fetched from precompressed snapshot containing all geometries for zoom level,
+ * falling back to backend server if snapshot unavailable or empty
+ * If 'previous' area properties are provided, backend server only returns geometries not already downloaded for them
+ * 
+ * Returns promise of response and area properties that response covers
+ * 
+ * @param {*} areaproperties 
+ * @param {*} previous 
+ */
+const requestGeometries = (areaproperties, previous) => {
+  let headers = {"Content-Type": "application/json"};
+  let request = {...areaproperties};
+  if (previous !== null) request.previous = {xmin: previous.xmin, ymin: previous.ymin, xmax: previous.xmax, ymax: previous.ymax};
+  let body = JSON.stringify(request);
+  const requestServer = () => fetch(API_URL + "/geometries/", {headers, method: "POST", body}).then(res => ({res, areaproperties}));
+
+  if ((parseInt(areaproperties.geometrytype) === 1) && Number.isInteger(areaproperties.zoom) && (areaproperties.zoom < ZOOM_SHOWLEVEL_2)) {
+    return fetch(SNAPSHOT_URL + "/geometries-lau1-" + areaproperties.zoom + ".json", {method: "GET"})
+      .then(res => {
+        if (res.status !== 200) return requestServer();
+        // Snapshot without geometries, eg. written before geometries were generated, does not cover anything
+        return res.clone().json().then(features => {
+          if (!Array.isArray(features) || (features.length === 0)) return requestServer();
+          return {res, areaproperties: {...areaproperties, ...WORLD_BOUNDS}};
+        });
+      })
+      .catch(() => requestServer());
+  }
+
+  return requestServer();
+}
+
+/**
+ * convertGeometries
+ * 
+ * Converts geometries returned by backend server into GeoJSON features
+ * 
+ * @param {*} segments 
+ * @param {*} geometrytype 
+ */
+const convertGeometries = (segments, geometrytype) => {
+  return segments.map(segment =>({
+    'type':'Feature',
+    'geometry': JSON.parse(segment.json),
+    'properties': {
+        'name': segment.name,
+        'code': segment.code,
+        'type': segment.type,
+        'geometrytype': geometrytype
+      }
+  }));
+}
 
 /**
  * fetchGeometries
@@ -19,18 +76,22 @@ import { API_URL } from "../constants";
  * Fetches geometry data from backend server and carries out basic data processing
  * (due to optimized delivery of GeoJSON data)
  * 
+ * When map is moved without changing zoom level or geometry type, only geometries not already held are fetched
+ * and geometries no longer in view are discarded
+ * 
  * @param {*} areaproperties 
  */
 export const fetchGeometries = (areaproperties) => {
   return (dispatch, getState) => {
-    let headers = {"Content-Type": "application/json"};
-    let body = JSON.stringify(areaproperties);
+    const mapstate = getState().map;
+    let previous = mapstate.areaproperties;
+    if ((previous === null) || (mapstate.geometries === null) || (previous.zoom !== areaproperties.zoom) || (previous.geometrytype !== areaproperties.geometrytype)) previous = null;
 
-    return fetch(API_URL + "/geometries/", {headers, method: "POST", body})
-      .then(res => {
+    return requestGeometries(areaproperties, previous)
+      .then(({res, areaproperties}) => {
         if (res.status < 500) {
           return res.json().then(data => {
-            return {status: res.status, data};
+            return {status: res.status, data, areaproperties};
           })
         } else {
           console.log("Server Error!");
@@ -39,20 +100,19 @@ export const fetchGeometries = (areaproperties) => {
       })
       .then(res => {
         if (res.status === 200) {
+          const areaproperties = res.areaproperties;
+
+          if (res.data.delta) {
+            // Geometries have changed since request was made so changes can't be applied - fetch again 
+            if (getState().map.areaproperties !== previous) return dispatch(fetchGeometries(areaproperties));
+
+            const features = convertGeometries(res.data.features, areaproperties['geometrytype']);
+            return dispatch({type: 'FETCH_GEOMETRIES_DELTA', areaproperties: areaproperties, features: features, evict: res.data.evict});
+          }
+
           const geometries = {
             type: 'FeatureCollection',
-            features:
-               (res.data).map(segment =>({
-                  'type':'Feature',
-                  'geometry': JSON.parse(segment.json),
-                  'properties': {
-                     'name': segment.name,
-                     'code': segment.code,
-                     'type': segment.type,
-                     'geometrytype': areaproperties['geometrytype']
-                    }
-               })
-            )
+            features: convertGeometries(res.data, areaproperties['geometrytype'])
           }
 
           return dispatch({type: 'FETCH_GEOMETRIES', areaproperties: areaproperties, geometries: geometries});
@@ -45,8 +45,8 @@ export class Menu extends Component {
     submitGeometry = (e) => {
         const newgeometrytype = e.target.value;
         this.props.setGeometry(newgeometrytype, this.props.history, this.props.location).then(() => {
-            let areaproperties = this.props.map.areaproperties;
-            areaproperties.geometrytype = newgeometrytype;
+            // Copy area properties as geometries held for current area properties are still of previous type
+            let areaproperties = {...this.props.map.areaproperties, geometrytype: newgeometrytype};
             this.props.fetchGeometries(areaproperties);            
         });
     }
@@ -15,6 +15,9 @@
 // export const API_URL = "http://localhost:8000";
 export const API_URL = "";
 
+// URL of precompressed snapshots of API responses, see 'tools.py precompress'
+export const SNAPSHOT_URL = API_URL + "/static/snapshots";
+
 // Default year start
 export const periodstart = 2010; 
 
@@ -39,6 +42,9 @@ export const ZOOM_SHOWLEVEL_2 = 8;
 // Zoom level at which to reveal 'Level 3' geographies, ie. LSOA/DZ
 export const ZOOM_SHOWLEVEL_3 = 9; 
 
+// Bounds covering whole world, used where all geometries for zoom level have been downloaded
+export const WORLD_BOUNDS = {xmin: -180, ymin: -90, xmax: 180, ymax: 90};
+
 // Short text for each of level geographies, 1, 2, 3
 export const LEVELS = [
     'Local Authority',
@@ -11,6 +11,7 @@
  * Reducer for map redux object
  * 
  * FETCH_GEOMETRIES: Updates state with data from backend and triggers redraw of GeoJSON layer by incrementing 'geojsoncounter'
+ * FETCH_GEOMETRIES_DELTA: Adds newly visible geometries from backend, discards evicted geometries and triggers redraw of GeoJSON layer
  * REDRAW_GEOJSON: Trigger redraw of GeoJSON layer by incrementing 'geojsoncounter'
  */ 
 
@@ -27,6 +28,13 @@ export default function map(state=initialStateMap, action) {
             newState = {...newState, geojsoncounter: (1 + state.geojsoncounter), areaproperties: action.areaproperties, geometries: action.geometries};
             return newState;
 
+        case 'FETCH_GEOMETRIES_DELTA': {
+            const evicted = new Set(action.evict);
+            const features = state.geometries.features.filter(feature => !evicted.has(feature.properties.code)).concat(action.features);
+            newState = {...newState, geojsoncounter: (1 + state.geojsoncounter), areaproperties: action.areaproperties, geometries: {...state.geometries, features: features}};
+            return newState;
+        }
+
         case 'REDRAW_GEOJSON':
             newState = {...newState, geojsoncounter: (1 + state.geojsoncounter)};
             return newState;
@@ -0,0 +1,373 @@
+"""
+Copyright (c) Open Carbon, 2020
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+
+loadtest.py
+Load tests a running Open Carbon Map stack by replaying realistic map sessions
+
+Each simulated user starts at the national view, zooms in from Local Authority (LAU1) level
+down to LSOA/Datazone level, pans around, clicks on areas and searches for towns, issuing the
+same requests to the backend as the frontend React app, including snapshot and delta geometry requests.
+
+Sessions are run at one or more concurrency levels and latency percentiles are reported per
+endpoint, together with throughput and number of in-flight requests, to show the point at which
+the application server workers become saturated.
+
+Example:
+python3 loadtest.py --url http://localhost --concurrency 1 2 4 8 16 --duration 60
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import random
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+
+# Default map position and zoom, consistent with frontend 'constants/index.js'
+DEFAULT_LAT = 55.69142309402058
+DEFAULT_LNG = -3.7832450866699223
+DEFAULT_ZOOM = 5
+
+# Zoom levels at which MSOA/IG and LSOA/DZ geometries are revealed, consistent with frontend
+ZOOM_SHOWLEVEL_2 = 8
+ZOOM_SHOWLEVEL_3 = 9
+
+# Bounds recorded by frontend for snapshot geometries, which cover whole country, consistent with frontend
+WORLD_BOUNDS = {'xmin': -180, 'ymin': -90, 'xmax': 180, 'ymax': 90}
+
+# Size of simulated browser viewport in pixels
+VIEWPORT_WIDTH = 1280
+VIEWPORT_HEIGHT = 800
+
+# Period requested when user clicks area, consistent with frontend
+PERIODSTART = 2010
+PERIODEND = 2050
+
+# Towns used if towns list cannot be loaded
+DEFAULT_TOWNS = ['London', 'Manchester', 'Birmingham', 'Leeds', 'Glasgow', 'Edinburgh', 'Cardiff', 'Bristol', 'Norwich', 'Inverness']
+
+# Fraction of throughput gain below which increasing concurrency is considered saturated
+SATURATION_GAIN = 0.1
+
+def loadtowns(townsfile):
+    """
+    Load list of towns and coordinates to use as session destinations and searches
+    """
+
+    towns = []
+    if os.path.isfile(townsfile):
+        with open(townsfile) as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                try:
+                    towns.append({'town': row['Town'], 'lat': float(row['Latitude']), 'lng': float(row['Longitude'])})
+                except ValueError:
+                    continue
+
+    if len(towns) == 0:
+        towns = [{'town': town, 'lat': None, 'lng': None} for town in DEFAULT_TOWNS]
+
+    return towns
+
+def getbbox(lat, lng, zoom):
+    """
+    Get bounding box of viewport centred on lat/lng at particular zoom level, including padding used by frontend
+    """
+
+    degrees_per_pixel = 360 / (2 ** (zoom + 8))
+    halfwidth = (VIEWPORT_WIDTH + 80) * degrees_per_pixel / 2
+    halfheight = (VIEWPORT_HEIGHT + 80) * degrees_per_pixel * math.cos(math.radians(lat)) / 2
+    return {'xmin': lng - halfwidth, 'ymin': lat - halfheight, 'xmax': lng + halfwidth, 'ymax': lat + halfheight}
+
+def getgeometrytype(zoom, preferredtype):
+    """
+    Get geometry type shown at particular zoom level, consistent with frontend
+    """
+
+    geometrytype = preferredtype
+    if (zoom < ZOOM_SHOWLEVEL_2) and (geometrytype >= 2): geometrytype = 1
+    if (zoom < ZOOM_SHOWLEVEL_3) and (geometrytype >= 3): geometrytype = 2
+    return geometrytype
+
+class Recorder:
+    """
+    Records latency of every request and number of requests in flight
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+        self.inflight = 0
+        self.inflightsamples = []
+
+    def start(self):
+        with self.lock:
+            self.inflight += 1
+            self.inflightsamples.append(self.inflight)
+
+    def finish(self, endpoint, duration, success):
+        with self.lock:
+            self.inflight -= 1
+            if endpoint not in self.timings:
+                self.timings[endpoint] = []
+                self.errors[endpoint] = 0
+            self.timings[endpoint].append(duration)
+            if not success: self.errors[endpoint] += 1
+
+class Session:
+    """
+    Simulates single user session on map, issuing the same requests as frontend
+    """
+
+    def __init__(self, baseurl, recorder, towns, thinktime, generator):
+        self.baseurl = baseurl.rstrip('/')
+        self.recorder = recorder
+        self.towns = towns
+        self.thinktime = thinktime
+        self.generator = generator
+        self.areacodes = []
+        self.areaproperties = None
+
+    def request(self, endpoint, body=None, query=None, name=None):
+        """
+        Issue request to backend and record timing under name, or endpoint if none, returning decoded JSON or None on failure
+        """
+
+        url = self.baseurl + endpoint
+        if query is not None: url += '?' + urllib.parse.urlencode(query)
+        data, headers = None, {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers = {'Content-Type': 'application/json'}
+
+        self.recorder.start()
+        start = time.perf_counter()
+        result, success = None, False
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers), timeout=60) as response:
+                result = json.loads(response.read().decode())
+                success = True
+        except Exception:
+            pass
+        self.recorder.finish(endpoint if name is None else name, time.perf_counter() - start, success)
+        return result
+
+    def think(self):
+        if self.thinktime > 0: time.sleep(self.generator.expovariate(1 / self.thinktime))
+
+    def view(self, lat, lng, zoom, geometrytype):
+        """
+        Request geometries for current view and remember area codes that user could click on
+
+        Mirrors frontend fetchGeometries: Local Authority geometries below ZOOM_SHOWLEVEL_2 are read from
+        static snapshot, falling back to backend if snapshot is unavailable or empty, and when zoom level and
+        geometry type are unchanged only geometries outside previous view are requested with 'previous'
+        """
+
+        areaproperties = {'zoom': zoom, 'geometrytype': geometrytype}
+        areaproperties.update(getbbox(lat, lng, zoom))
+
+        if (geometrytype == 1) and (zoom < ZOOM_SHOWLEVEL_2):
+            result = self.request('/static/snapshots/geometries-lau1-' + str(zoom) + '.json', name='/static/snapshots/')
+            if isinstance(result, list) and len(result) > 0:
+                self.areaproperties = dict(areaproperties, **WORLD_BOUNDS)
+                self.areacodes = [feature['code'] for feature in result]
+                return
+
+        previous = self.areaproperties
+        if (previous is None) or (previous['zoom'] != zoom) or (previous['geometrytype'] != geometrytype): previous = None
+
+        body = dict(areaproperties)
+        if previous is not None: body['previous'] = {key: previous[key] for key in ['xmin', 'ymin', 'xmax', 'ymax']}
+        result = self.request('/geometries/', body=body, name='/geometries/ delta' if previous is not None else None)
+
+        if isinstance(result, dict) and result.get('delta'):
+            evicted = set(result['evict'])
+            self.areacodes = [code for code in self.areacodes if code not in evicted] + [feature['code'] for feature in result['features']]
+            self.areaproperties = areaproperties
+        elif isinstance(result, list):
+            self.areacodes = [feature['code'] for feature in result]
+            self.areaproperties = areaproperties
+        else:
+            # Failed request leaves nothing held, so next request fetches whole view
+            self.areacodes, self.areaproperties = [], None
+
+    def click(self):
+        """
+        Click on random visible area, retrieving its data and occasionally zooming to its bounds
+        """
+
+        if len(self.areacodes) == 0: return
+        areacode = self.generator.choice(self.areacodes)
+        self.request('/data/', body={'periodstart': PERIODSTART, 'periodend': PERIODEND, 'area': areacode})
+        if self.generator.random() < 0.3:
+            self.request('/geometrybounds/', body={'areacode': areacode})
+
+    def run(self):
+        """
+        Run complete session: search, zoom in towards destination, pan and click around
+        """
+
+        destination = self.generator.choice(self.towns)
+        preferredtype = self.generator.choice([1, 2, 3])
+        lat, lng, zoom = DEFAULT_LAT, DEFAULT_LNG, DEFAULT_ZOOM
+
+        self.view(lat, lng, zoom, getgeometrytype(zoom, preferredtype))
+        self.think()
+
+        # Roughly half of users search for town first, others zoom in manually
+        if self.generator.random() < 0.5:
+            self.request('/locationposition', query={'location': destination['town']})
+            self.think()
+
+        targetzoom = self.generator.randint(10, 15)
+        targetlat, targetlng = destination['lat'], destination['lng']
+        if targetlat is None: targetlat, targetlng = DEFAULT_LAT - 3, DEFAULT_LNG + 2
+
+        # Zoom in one level at a time, moving towards destination
+        steps = targetzoom - zoom
+        for step in range(1, steps + 1):
+            zoom += 1
+            lat += (targetlat - lat) / (steps - step + 1)
+            lng += (targetlng - lng) / (steps - step + 1)
+            self.view(lat, lng, zoom, getgeometrytype(zoom, preferredtype))
+            if self.generator.random() < 0.3: self.click()
+            self.think()
+
+        # Pan around destination and click on areas
+        for pan in range(self.generator.randint(2, 8)):
+            bbox = getbbox(lat, lng, zoom)
+            lng += (bbox['xmax'] - bbox['xmin']) * self.generator.uniform(-0.5, 0.5)
+            lat += (bbox['ymax'] - bbox['ymin']) * self.generator.uniform(-0.5, 0.5)
+            self.view(lat, lng, zoom, getgeometrytype(zoom, preferredtype))
+            for click in range(self.generator.randint(0, 2)): self.click()
+            self.think()
+
+def percentile(values, fraction):
+    """
+    Get percentile of sorted list of values using nearest rank
+    """
+
+    if len(values) == 0: return 0
+    index = min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)
+    return values[max(0, index)]
+
+def runlevel(baseurl, concurrency, duration, towns, thinktime, seed):
+    """
+    Run sessions continuously with fixed number of concurrent users for duration in seconds
+    """
+
+    recorder = Recorder()
+    deadline = time.time() + duration
+    sessioncount = [0]
+    countlock = threading.Lock()
+
+    def user(index):
+        generator = random.Random(seed + index)
+        while time.time() < deadline:
+            Session(baseurl, recorder, towns, thinktime, generator).run()
+            with countlock: sessioncount[0] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(concurrency)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+
+    return {'recorder': recorder, 'elapsed': elapsed, 'sessions': sessioncount[0]}
+
+def report(concurrency, result):
+    """
+    Print latency percentiles per endpoint for single concurrency level, returning summary
+    """
+
+    recorder, elapsed = result['recorder'], result['elapsed']
+    total = sum([len(timings) for timings in recorder.timings.values()])
+    samples = recorder.inflightsamples
+    summary = {
+        'concurrency': concurrency,
+        'sessions': result['sessions'],
+        'requests': total,
+        'throughput': total / elapsed if elapsed > 0 else 0,
+        'inflight_mean': sum(samples) / len(samples) if len(samples) > 0 else 0,
+        'inflight_max': max(samples) if len(samples) > 0 else 0,
+        'endpoints': {}
+    }
+
+    print("")
+    print("Concurrency", concurrency, "-", result['sessions'], "sessions,", total, "requests in", "{:.1f}s".format(elapsed),
+            "- {:.1f} requests/s,".format(summary['throughput']),
+            "in flight mean {:.1f} max {}".format(summary['inflight_mean'], summary['inflight_max']))
+    print("Endpoint".ljust(20), "Count".rjust(8), "Errors".rjust(8), "p50 ms".rjust(10), "p95 ms".rjust(10), "p99 ms".rjust(10))
+
+    for endpoint in sorted(recorder.timings):
+        timings = sorted(recorder.timings[endpoint])
+        endpointsummary = {
+            'count': len(timings),
+            'errors': recorder.errors[endpoint],
+            'p50_ms': 1000 * percentile(timings, 0.50),
+            'p95_ms': 1000 * percentile(timings, 0.95),
+            'p99_ms': 1000 * percentile(timings, 0.99),
+        }
+        summary['endpoints'][endpoint] = endpointsummary
+        print(endpoint.ljust(20), str(endpointsummary['count']).rjust(8), str(endpointsummary['errors']).rjust(8),
+                "{:10.1f}".format(endpointsummary['p50_ms']),
+                "{:10.1f}".format(endpointsummary['p95_ms']),
+                "{:10.1f}".format(endpointsummary['p99_ms']))
+
+    return summary
+
+def reportsaturation(summaries):
+    """
+    Report concurrency level beyond which throughput stops increasing, ie. workers are saturated
+    """
+
+    if len(summaries) < 2: return None
+
+    print("")
+    saturation = None
+    for previous, current in zip(summaries, summaries[1:]):
+        if previous['throughput'] <= 0: continue
+        gain = (current['throughput'] - previous['throughput']) / previous['throughput']
+        print("Concurrency", str(previous['concurrency']).rjust(4), "->", str(current['concurrency']).rjust(4), "throughput change {:+.1%}".format(gain))
+        if (saturation is None) and (gain < SATURATION_GAIN): saturation = previous['concurrency']
+
+    if saturation is not None:
+        print("Workers saturated at around", saturation, "concurrent users - additional users only increase latency")
+    else:
+        print("Workers not saturated at highest concurrency tested")
+
+    return saturation
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Load test Open Carbon Map by replaying realistic map sessions")
+    parser.add_argument('--url', default='http://localhost:8000', help="Base URL of running Open Carbon Map stack")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16], help="Numbers of concurrent users to test, in turn")
+    parser.add_argument('--duration', type=int, default=60, help="Duration in seconds to run each concurrency level")
+    parser.add_argument('--thinktime', type=float, default=1.0, help="Mean pause in seconds between user actions, 0 for none")
+    parser.add_argument('--towns', default='app/Towns_List_Extended.csv', help="CSV file of towns to use as session destinations")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed so sessions can be replayed identically")
+    parser.add_argument('--output', default=None, help="Optional JSON file to write results to")
+    args = parser.parse_args()
+
+    towns = loadtowns(args.towns)
+    summaries = []
+    for concurrency in args.concurrency:
+        print("Running", concurrency, "concurrent users for", args.duration, "seconds against", args.url)
+        result = runlevel(args.url, concurrency, args.duration, towns, args.thinktime, args.seed)
+        summaries.append(report(concurrency, result))
+
+    saturation = reportsaturation(summaries)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'url': args.url, 'levels': summaries, 'saturation': saturation}, f, indent=2)